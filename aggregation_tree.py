@@ -0,0 +1,141 @@
+#####################
+# aggregation_tree.py
+# Hierarchical (tree-reduce) aggregation of a category's extraction observations.
+#
+# A category whose observations fit in AGGREGATION_CHUNK_MAX_TOKENS is aggregated by one call, as
+# before. A larger one is split into token-bounded chunks that are grouped in parallel; the groups
+# of every chunk become the items of the next level, until a level fits in one chunk. Items are
+# sent with their uid list replaced by a reference to the item ([index]); the model groups the
+# references and the groups get the union of their items' uid lists back locally. Uid lists are
+# therefore kept exactly, prompts and responses stay small, and the number of levels grows with the
+# logarithm of the observations. A chunk whose call fails passes its items on unmerged, and so do
+# the items the model leaves out of every group.
+import asyncio
+import json
+import logging
+import os
+
+from reviews_data_processing_utils import num_tokens_from_string
+
+AGGREGATION_CHUNK_MAX_TOKENS = int(os.getenv('AGGREGATION_CHUNK_MAX_TOKENS', 6000))
+AGGREGATION_MAX_LEVELS = 8
+
+
+def aggregation_content(key, observations):
+    """The single-call aggregation prompt of a category's observations."""
+    return [
+        {"role": "user", "content": f"You are the most awesome product researcher. Please process the results for key: {key}.  \n Aggregated observations are here: {observations}"}
+    ]
+
+
+def merge_content(key, items):
+    """The prompt grouping items whose 'uid' holds a reference to the item instead of review uids."""
+    return [
+        {"role": "user", "content": f"You are the most awesome product researcher. Please process the results for key: {key}. Each observation below is a group of reviews; its uid is the id of the group, not of a review. Group the observations and return the ids of the groups in each category.  \n Aggregated observations are here: {items}"}
+    ]
+
+
+def chunk_items(items, maxTokens):
+    """Split items into consecutive chunks of at most maxTokens tokens (an item over the budget gets a chunk of its own)."""
+    chunks = []
+    current = []
+    currentTokens = 0
+    for item in items:
+        itemTokens = num_tokens_from_string(str(item), encoding_name="cl100k_base")
+        if current and currentTokens + itemTokens > maxTokens:
+            chunks.append(current)
+            current = []
+            currentTokens = 0
+        current.append(item)
+        currentTokens += itemTokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def parse_labels(response, key):
+    """The labels of category key in a function call response, or None if it has none."""
+    try:
+        labels = json.loads(response['function_call']['arguments'])[key]
+        return labels if isinstance(labels, list) else None
+    except Exception as e:
+        logging.error(f"Error parsing the aggregation response for {key}: {e}")
+        return None
+
+
+def expand_references(labels, itemUids):
+    """Replace each label's item references with the union of the items' uid lists, in order; labels without valid references are dropped."""
+    groups = []
+    for label in labels:
+        if not isinstance(label, dict):
+            continue
+        uids = []
+        seen = set()
+        for reference in label.get('uid') or []:
+            if isinstance(reference, (int, float)) and reference == int(reference) and 0 <= reference < len(itemUids):
+                for uid in itemUids[int(reference)]:
+                    if uid not in seen:
+                        seen.add(uid)
+                        uids.append(uid)
+        if uids:
+            groups.append(dict(label, uid=uids))
+    return groups
+
+
+def unreferenced_items(labels, chunk):
+    """The references of chunk that no label refers to."""
+    referenced = set()
+    for label in labels:
+        if isinstance(label, dict):
+            referenced.update(int(reference) for reference in label.get('uid') or [] if isinstance(reference, (int, float)) and reference == int(reference))
+    return [reference for reference in chunk if reference['uid'][0] not in referenced]
+
+
+def function_call_response(functionName, key, labels):
+    """A function call response carrying the labels of category key, as get_completion() returns one."""
+    return {'role': 'assistant', 'content': None, 'function_call': {'name': functionName, 'arguments': json.dumps({key: labels})}}
+
+
+async def tree_reduce(key, observations, complete, functionName, maxTokens=None):
+    """
+    Aggregate a category's observations level by level.
+
+    Parameters:
+    - key (str): The category.
+    - observations (list): Label dicts with a 'uid' list of review uids.
+    - complete (callable): Coroutine function taking the messages of one call and returning its
+      response (None on failure).
+    - functionName (str): Function name of the returned response.
+    - maxTokens (int, optional): Token budget of the items of one call (AGGREGATION_CHUNK_MAX_TOKENS).
+
+    Returns:
+    - dict: A function call response with the category's final labels, or None if there are none.
+    - int: Levels run.
+    """
+    maxTokens = maxTokens or AGGREGATION_CHUNK_MAX_TOKENS
+    items = [item for item in observations if isinstance(item, dict) and item.get('uid')]
+    level = 0
+    while items:
+        level += 1
+        itemUids = [item['uid'] for item in items]
+        references = [dict({field: value for field, value in item.items() if field != 'uid'}, uid=[index]) for index, item in enumerate(items)]
+        chunks = chunk_items(references, maxTokens)
+        responses = await asyncio.gather(*[complete(merge_content(key, chunk)) for chunk in chunks])
+
+        merged = []
+        for chunk, response in zip(chunks, responses):
+            labels = parse_labels(response, key) if response is not None else None
+            if labels is None:
+                # Keep the chunk's items rather than lose their reviews
+                merged.extend(items[reference['uid'][0]] for reference in chunk)
+            else:
+                merged.extend(expand_references(labels, itemUids))
+                # Items the model left out of every group are kept, as for a failed chunk
+                merged.extend(items[reference['uid'][0]] for reference in unreferenced_items(labels, chunk))
+
+        if len(chunks) == 1 or len(merged) >= len(items) or level >= AGGREGATION_MAX_LEVELS:
+            if len(chunks) > 1:
+                logging.warning(f"Aggregation of {key} stopped at level {level} with {len(merged)} labels.")
+            return function_call_response(functionName, key, merged), level
+        items = merged
+    return None, level
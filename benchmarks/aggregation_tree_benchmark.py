@@ -0,0 +1,125 @@
+#####################
+# benchmarks/aggregation_tree_benchmark.py
+# One aggregation call per category against the tree reduce of aggregation_tree.py, on categories
+# of growing size.
+#
+# The model is the offline fake of storage_benchmark, which groups the uids (or item references)
+# of a prompt into 10 labels. Each call sleeps for a simulated latency of --call-seconds plus
+# --input-seconds per prompt token and --output-seconds per response token, scaled down by
+# --time-scale; at most --concurrency calls run at once. Simulated time is wall time less the CPU
+# time of the run (the fake model and tokenizer), scaled back up. The single call is also checked against the
+# --context-tokens window (prompt plus response). The tree is also run on a lossy model that puts
+# only the first item of each prompt in a group and leaves the others out. The tree must return
+# every uid of the observations with both models; the script exits non-zero otherwise.
+#
+# Run from the repository root:
+#   python -m benchmarks.aggregation_tree_benchmark --observations 500 2000 8000 32000
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from aggregation_tree import AGGREGATION_CHUNK_MAX_TOKENS, aggregation_content, function_call_response, tree_reduce
+from benchmarks.storage_benchmark import fake_function_call
+from function_schemas import get_function_schemas
+from reviews_data_processing_utils import num_tokens_from_string
+
+KEY = 'useCase'
+UIDS_PER_OBSERVATION = 4
+
+
+def synthetic_observations(count):
+    """Extraction labels of a category, each with its own reviews' uids."""
+    return [
+        {'headerOfCategory (7 words)': f"Used for {('smoothies', 'soups', 'baby food', 'ice', 'coffee', 'sauces')[index % 6]} in batch {index}", 'uid': list(range(index * UIDS_PER_OBSERVATION, (index + 1) * UIDS_PER_OBSERVATION))}
+        for index in range(count)
+    ]
+
+
+class SimulatedModel:
+    def __init__(self, args):
+        self.args = args
+        self.semaphore = asyncio.Semaphore(args.concurrency)
+        self.function = get_function_schemas()[KEY]
+        self.calls = 0
+        self.maxPromptTokens = 0
+        self.promptTokens = 0
+        self.callSeconds = 0.0
+        self.maxWindowTokens = 0
+
+    async def complete(self, contentList):
+        args = self.args
+        async with self.semaphore:
+            response = fake_function_call(contentList, self.function)
+            promptTokens = num_tokens_from_string(contentList[0]['content'], encoding_name="cl100k_base")
+            responseTokens = num_tokens_from_string(response['function_call']['arguments'], encoding_name="cl100k_base")
+            self.calls += 1
+            self.maxPromptTokens = max(self.maxPromptTokens, promptTokens)
+            self.promptTokens += promptTokens
+            self.maxWindowTokens = max(self.maxWindowTokens, promptTokens + responseTokens)
+            seconds = args.call_seconds + promptTokens * args.input_seconds + responseTokens * args.output_seconds
+            self.callSeconds += seconds
+            await asyncio.sleep(seconds * args.time_scale)
+            return response
+
+
+class LossyModel(SimulatedModel):
+    """A model that groups only the first item of each prompt and leaves the rest out of every group."""
+
+    async def complete(self, contentList):
+        response = await super().complete(contentList)
+        labels = json.loads(response['function_call']['arguments'])[KEY]
+        first = min((reference for label in labels for reference in label['uid']), default=0)
+        return function_call_response(response['function_call']['name'], KEY, [dict(labels[0], uid=[first])] if labels else [])
+
+
+def simulated_seconds(start, cpuStart, timeScale):
+    return max(0.0, (time.perf_counter() - start) - (time.process_time() - cpuStart)) / timeScale
+
+
+async def run_single(observations, args):
+    model = SimulatedModel(args)
+    start, cpuStart = time.perf_counter(), time.process_time()
+    await model.complete(aggregation_content(KEY, observations))
+    return simulated_seconds(start, cpuStart, args.time_scale), model
+
+
+async def run_tree(observations, args, modelClass=SimulatedModel):
+    model = modelClass(args)
+    start, cpuStart = time.perf_counter(), time.process_time()
+    response, levels = await tree_reduce(KEY, observations, model.complete, model.function[0]['name'], maxTokens=args.chunk_tokens)
+    return simulated_seconds(start, cpuStart, args.time_scale), model, levels, json.loads(response['function_call']['arguments'])[KEY]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Single-call vs tree-reduce aggregation')
+    parser.add_argument('--observations', type=int, nargs='+', default=[500, 2000, 8000, 32000])
+    parser.add_argument('--chunk-tokens', type=int, default=AGGREGATION_CHUNK_MAX_TOKENS)
+    parser.add_argument('--context-tokens', type=int, default=16385)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--call-seconds', type=float, default=1.0)
+    parser.add_argument('--input-seconds', type=float, default=0.0002)
+    parser.add_argument('--output-seconds', type=float, default=0.01)
+    parser.add_argument('--time-scale', type=float, default=0.002, help='Real seconds slept per simulated second')
+    args = parser.parse_args()
+
+    print('observations\tsinglePromptTokens\tsingleFitsContext\tsingleSeconds\ttreeLevels\ttreeCalls\ttreeMaxWindowTokens\ttreeSeconds\ttreeLabels\tuidsPreserved\tlossyUidsPreserved')
+    preserved = True
+    for count in args.observations:
+        observations = synthetic_observations(count)
+        singleSeconds, single = asyncio.run(run_single(observations, args))
+        treeSeconds, tree, levels, labels = asyncio.run(run_tree(observations, args))
+        allUids = sorted(uid for observation in observations for uid in observation['uid'])
+        uidsPreserved = sorted(uid for label in labels for uid in label['uid']) == allUids
+        _, _, _, lossyLabels = asyncio.run(run_tree(observations, args, LossyModel))
+        lossyUidsPreserved = sorted(uid for label in lossyLabels for uid in label['uid']) == allUids
+        preserved = preserved and uidsPreserved and lossyUidsPreserved
+        print(f"{count}\t{single.maxPromptTokens}\t{single.maxWindowTokens <= args.context_tokens}\t{singleSeconds:.1f}\t{levels}\t{tree.calls}\t{tree.maxWindowTokens}\t{treeSeconds:.1f}\t{len(labels)}\t{uidsPreserved}\t{lossyUidsPreserved}")
+    if not preserved:
+        print('the tree reduce lost or duplicated uids')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#####################
+# benchmarks/checkpoint_resume_benchmark.py
+# LLM calls paid again when an investigation is rerun after failing partway, with and without checkpoints.
+#
+# Uses the offline fakes of storage_benchmark. The first run of each investigation fails at the
+# --fail-at-th completion (an extraction call by default; pass a larger value to fail during
+# aggregation); the rerun goes through run_investigation_stages again, like a recovered job.
+#
+# Run from the repository root:
+#   python -m benchmarks.checkpoint_resume_benchmark --asins 3 --reviews-per-asin 500 --fail-at 20
+import argparse
+import os
+
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+os.environ.setdefault('OPENAI_API_KEY', 'offline-benchmark')
+# The synthetic reviews are filled-in templates: near-duplicate collapsing would leave a handful to extract
+os.environ.setdefault('NEAR_DUPLICATE_THRESHOLD', '0')
+# The fake model answers function calls only: aggregate with it rather than with embeddings
+os.environ.setdefault('AGGREGATION_MODE', 'llm')
+
+import firebase_utils
+import reviews_processing
+from benchmarks.storage_benchmark import install_offline_fakes
+from run_investigation import run_investigation_stages
+
+
+def run_mode(checkpoints, args):
+    firebase_utils.CHECKPOINTS_ENABLED = checkpoints
+    fakeGetCompletion = reviews_processing.get_completion
+    fakeGetCompletionList = reviews_processing.get_completion_list_multifunction
+    calls = {'count': 0, 'failAt': args.fail_at}
+
+    def count_calls(number):
+        failed = calls['failAt'] is not None and calls['count'] < calls['failAt'] <= calls['count'] + number
+        calls['count'] += number
+        if failed:
+            raise RuntimeError('Injected failure')
+
+    async def counting_get_completion(*callArgs, **kwargs):
+        count_calls(1)
+        return await fakeGetCompletion(*callArgs, **kwargs)
+
+    async def counting_get_completion_list_multifunction(content_list, functions_list, *callArgs, **kwargs):
+        # Without checkpoints every extraction call is paid for, even those that completed before the failure
+        count_calls(len(content_list) * len(functions_list))
+        return await fakeGetCompletionList(content_list, functions_list, *callArgs, **kwargs)
+
+    reviews_processing.get_completion = counting_get_completion
+    reviews_processing.get_completion_list_multifunction = counting_get_completion_list_multifunction
+    try:
+        asinList = [f"B0RESUME{'C' if checkpoints else 'N'}{index:03d}" for index in range(args.asins)]
+        investigation = firebase_utils.start_investigation({'userId': 'benchmark-user', 'asinList': asinList, 'name': f"resume-{checkpoints}"})
+
+        firstResult = run_investigation_stages('benchmark-user', investigation['id'], asinList)
+        firstCalls = calls['count']
+
+        calls['count'] = 0
+        calls['failAt'] = None
+        rerunResult = run_investigation_stages('benchmark-user', investigation['id'], asinList)
+        return {
+            'checkpoints': checkpoints,
+            'firstRunSucceeded': bool(firstResult),
+            'firstRunCalls': firstCalls,
+            'rerunSucceeded': bool(rerunResult),
+            'rerunCalls': calls['count'],
+        }
+    finally:
+        reviews_processing.get_completion = fakeGetCompletion
+        reviews_processing.get_completion_list_multifunction = fakeGetCompletionList
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rerun cost after a partial failure')
+    parser.add_argument('--asins', type=int, default=3)
+    parser.add_argument('--reviews-per-asin', type=int, default=500)
+    parser.add_argument('--fail-at', type=int, default=20, help='Completion (1-based) the first run fails at')
+    args = parser.parse_args()
+
+    install_offline_fakes(args.reviews_per_asin)
+    results = [run_mode(False, args), run_mode(True, args)]
+
+    columns = list(results[0].keys())
+    print('\t'.join(columns))
+    for row in results:
+        print('\t'.join(str(row[column]) for column in columns))
+
+
+if __name__ == '__main__':
+    main()
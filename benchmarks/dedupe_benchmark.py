@@ -0,0 +1,168 @@
+#####################
+# benchmarks/dedupe_benchmark.py
+# Extraction work saved by deduplicating reviews that variants of the same parent product share.
+#
+# Each parent product has --variants ASINs that return the same pool of reviews, plus a few reviews
+# of their own. The dict pipeline (add_uid_to_reviews + generate_batches) sends every (ASIN, review)
+# row; the ReviewTable sends each distinct review once. The script also tags the reviews with
+# synthetic labels and checks that every row gets its review's tags, that a shared review counts
+# once per label and once in each of its ASINs; it exits non-zero if not.
+#
+# A second corpus mixes short stock reviews, each repeated with small edits (case, punctuation, a
+# word added or dropped), with reviews of random words. It is loaded with near-duplicate collapsing
+# at --near-duplicate-threshold and reports the reviews and tokens not sent, the share of edited
+# copies that joined their stock review's cluster, and reviews merged into a cluster of another
+# review (false merges; none at the default threshold). Tags and counts must reach every member.
+#
+# Run from the repository root:
+#   python -m benchmarks.dedupe_benchmark --parents 3 --variants 4 --reviews-per-parent 500
+import argparse
+import random
+import sys
+import time
+
+from benchmarks.synthetic_corpus import synthetic_review_pages
+from postprocessing import postprocess_extraction_results
+from review_table import ReviewTable
+from reviews_data_processing_utils import add_uid_to_reviews, generate_batches, num_tokens_from_string
+
+MAX_TOKENS = 6000
+
+STOCK_REVIEWS = (
+    'Great product, works as expected!!',
+    'Terrible quality, broke after one week.',
+    'Exactly as described, fast shipping.',
+    'Does the job, nothing special.',
+    'Love it, would buy again!',
+    'Stopped working after a month, very disappointed.',
+    'Good value for the money.',
+    'Too small, returned it.',
+)
+EDITS = (
+    lambda text: text.lower(),
+    lambda text: text.upper(),
+    lambda text: text.rstrip('.!') + '!!!',
+    lambda text: text.replace(',', ''),
+    lambda text: text + ' Thanks',
+    lambda text: 'Really ' + text[0].lower() + text[1:],
+)
+WORDS = (
+    'battery screen handle blade motor lid cable strap button sound colour weight grip charger case '
+    'sturdy flimsy quiet loud bright dull heavy light smooth rough cheap pricey solid wobbly sharp'
+).split()
+
+
+def load_reviews(parents, variants, reviewsPerParent):
+    """Reviews as acquired, one row per (ASIN, review): variants repeat their parent's pool."""
+    reviews = []
+    for parent in range(parents):
+        pool = [review for page in synthetic_review_pages(f"B0PARENT{parent:03d}", reviewsPerParent) for review in page]
+        for variant in range(variants):
+            asin = f"B0VAR{parent:03d}{variant:03d}"
+            reviews += [dict(review, asin=asin) for review in pool]
+            own = [review for page in synthetic_review_pages(asin, 10) for review in page]
+            reviews += [dict(review, asin=asin) for review in own]
+    return reviews
+
+
+def batch_tokens(batches):
+    return sum(num_tokens_from_string(text) for batch in batches for _, _, text in batch)
+
+
+def near_duplicate_reviews(copiesPerStock, randomReviews, seed=0):
+    """Edited copies of STOCK_REVIEWS and random-word reviews, shuffled, each with its stock review index (None when random)."""
+    rng = random.Random(seed)
+    reviews = []
+    for stockIndex, text in enumerate(STOCK_REVIEWS):
+        for copy in range(copiesPerStock):
+            reviews.append((rng.choice(EDITS)(text) if copy else text, stockIndex))
+    for _ in range(randomReviews):
+        reviews.append((' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))), None))
+    rng.shuffle(reviews)
+    return [
+        ({'id': f"R{index:06d}", 'asin': f"B0NEAR{index % 3:04d}", 'rating': rng.randint(1, 5), 'text': text}, stockIndex)
+        for index, (text, stockIndex) in enumerate(reviews)
+    ]
+
+
+def clustering_quality(table, stockIndexes):
+    """Share of stock review copies in their stock review's largest cluster, and reviews whose cluster is mostly another review's."""
+    clusterStock = {}
+    for uid, stockIndex in enumerate(stockIndexes):
+        clusterStock.setdefault(table.representativeByUid[uid], []).append(stockIndex)
+    majority = {representative: max(set(stocks), key=stocks.count) for representative, stocks in clusterStock.items()}
+    falseMerges = sum(1 for uid, stockIndex in enumerate(stockIndexes) if majority[table.representativeByUid[uid]] != stockIndex or (stockIndex is None and table.representativeByUid[uid] != uid))
+    largest = {}
+    for representative, stocks in clusterStock.items():
+        for stockIndex in set(stocks) - {None}:
+            largest[stockIndex] = max(largest.get(stockIndex, 0), stocks.count(stockIndex))
+    copies = sum(1 for stockIndex in stockIndexes if stockIndex is not None)
+    return round(sum(largest.values()) / copies, 4) if copies else 0.0, falseMerges
+
+
+def check_fan_out(table, seed=0):
+    """Tag representatives with synthetic labels and check tags and counts against the rows."""
+    rng = random.Random(seed)
+    representatives = table.representatives.tolist()
+    labels = [{'label': f"label {index}", 'uid': rng.sample(representatives, min(len(representatives), 40))} for index in range(8)]
+    table, frontendOutput, asinBreakdowns = postprocess_extraction_results([{'useCase': labels}], table)
+
+    taggedRows = table.to_dicts()
+    tagsOk = all(row['tags'] == table.tags.get(table.representativeByUid[row['uid']], {}) for row in taggedRows)
+    members = {}
+    for uid in range(table.uidCount):
+        members.setdefault(table.representativeByUid[uid], []).append(uid)
+    countsOk = all(entry['numberOfObservations'] == sum(len(members[uid]) for uid in set(label['uid'])) for entry, label in zip(sorted(frontendOutput['useCase'], key=lambda entry: entry['label']), sorted(labels, key=lambda label: label['label'])))
+
+    expected = {}
+    for label in labels:
+        uids = set(label['uid'])
+        for row in taggedRows:
+            if table.representativeByUid[row['uid']] in uids:
+                expected.setdefault((row['asin'], label['label']), set()).add(row['uid'])
+    byAsinOk = {(entry['asin'], entry['label']): entry['numberOfObservations'] for entry in asinBreakdowns} == {key: len(uids) for key, uids in expected.items()}
+    return tagsOk and countsOk and byAsinOk
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Duplicate reviews across variants')
+    parser.add_argument('--parents', type=int, default=3)
+    parser.add_argument('--variants', type=int, default=4)
+    parser.add_argument('--reviews-per-parent', type=int, default=500)
+    parser.add_argument('--copies-per-stock-review', type=int, default=150)
+    parser.add_argument('--random-reviews', type=int, default=1000)
+    parser.add_argument('--near-duplicate-threshold', type=float, default=0.8)
+    args = parser.parse_args()
+
+    reviews = load_reviews(args.parents, args.variants, args.reviews_per_parent)
+    dictReviews, _ = add_uid_to_reviews([dict(review) for review in reviews])
+    dictBatches = generate_batches(dictReviews, max_tokens=MAX_TOKENS)
+    table = ReviewTable.from_reviews(reviews)
+    tableBatches = table.batches(MAX_TOKENS)
+
+    dictTokens = batch_tokens(dictBatches)
+    tableTokens = batch_tokens(tableBatches)
+    report = table.dedupe_report()
+    fanOutOk = check_fan_out(table)
+
+    print('rows\tuniqueReviews\tsavingsRatio\tdictBatches\ttableBatches\tdictTokens\ttableTokens\tfanOutOk')
+    print(f"{report['rows']}\t{report['uniqueReviews']}\t{report['savingsRatio']}\t{len(dictBatches)}\t{len(tableBatches)}\t{dictTokens}\t{tableTokens}\t{fanOutOk}")
+
+    nearReviews = near_duplicate_reviews(args.copies_per_stock_review, args.random_reviews)
+    start = time.perf_counter()
+    nearTable = ReviewTable.from_reviews([review for review, _ in nearReviews], args.near_duplicate_threshold)
+    loadSeconds = time.perf_counter() - start
+    nearReport = nearTable.dedupe_report()
+    clustered, falseMerges = clustering_quality(nearTable, [stockIndex for _, stockIndex in nearReviews])
+    nearFanOutOk = check_fan_out(nearTable)
+
+    print()
+    print('threshold\treviews\trepresentatives\tnearDuplicateReviews\ttokensSent\tnearDuplicateTokensSaved\tclusteredCopies\tfalseMerges\tloadSeconds\tfanOutOk')
+    print(f"{args.near_duplicate_threshold}\t{nearReport['uniqueReviews']}\t{nearReport['representatives']}\t{nearReport['nearDuplicateReviews']}\t{nearReport['tokensSent']}\t{nearReport['nearDuplicateTokensSaved']}\t{clustered}\t{falseMerges}\t{loadSeconds:.3f}\t{nearFanOutOk}")
+    if not fanOutOk or not nearFanOutOk:
+        print('tags or counts of shared reviews are wrong')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#####################
+# benchmarks/import_time_report.py
+# Per-module import-time report of the API worker, from `python -X importtime`.
+#
+# Imports the target module in a fresh interpreter (clients are not warmed up, so only import
+# cost is measured) and prints the cumulative import time of this repo's modules and the self
+# time summed per third-party package. With --budget-ms it exits non-zero when the total import
+# time is over budget, so it can gate a deploy.
+#
+# Run from the repository root:
+#   python -m benchmarks.import_time_report
+#   python -m benchmarks.import_time_report --module main --top 15 --budget-ms 1000
+import argparse
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def repo_modules():
+    return {name[:-3] for name in os.listdir(REPO_ROOT) if name.endswith('.py')}
+
+
+def collect_import_times(module, env=None):
+    """
+    Import module in a fresh interpreter with -X importtime.
+
+    Returns:
+    - list: (module name, self microseconds, cumulative microseconds, depth) in import order.
+    """
+    runEnv = dict(os.environ, **(env or {}))
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], cwd=REPO_ROOT, env=runEnv, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{completed.stderr[-2000:]}")
+    rows = []
+    for line in completed.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            selfUs, cumulativeUs, indent, name = match.groups()
+            rows.append((name, int(selfUs), int(cumulativeUs), len(indent) // 2))
+    return rows
+
+
+def summarize(rows, ownModules):
+    ownCumulative = {name: cumulativeUs for name, _, cumulativeUs, _ in rows if name in ownModules}
+    packageSelf = defaultdict(int)
+    for name, selfUs, _, _ in rows:
+        if name.split('.')[0] not in ownModules:
+            packageSelf[name.split('.')[0]] += selfUs
+    total = sum(selfUs for _, selfUs, _, _ in rows)
+    return ownCumulative, dict(packageSelf), total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-module import time of the API worker')
+    parser.add_argument('--module', default='app', help='Module to import (app is what gunicorn loads)')
+    parser.add_argument('--top', type=int, default=10, help='Number of third-party packages to list')
+    parser.add_argument('--budget-ms', type=float, default=None, help='Fail when the total import time exceeds this')
+    args = parser.parse_args()
+
+    env = {'CLIENT_WARMUP': 'off'}
+    rows = collect_import_times(args.module, env)
+    ownCumulative, packageSelf, total = summarize(rows, repo_modules())
+
+    print('repo module\tcumulativeMs')
+    for name, cumulativeUs in sorted(ownCumulative.items(), key=lambda item: -item[1]):
+        print(f"{name}\t{cumulativeUs / 1000:.1f}")
+    print()
+    print('package\tselfMs')
+    for name, selfUs in sorted(packageSelf.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{name}\t{selfUs / 1000:.1f}")
+    print()
+    for heavy in ('pandas', 'numpy', 'tiktoken', 'sklearn'):
+        print(f"{heavy} imported: {heavy in packageSelf}")
+    print(f"total import time: {total / 1000:.1f} ms")
+
+    if args.budget_ms is not None and total / 1000 > args.budget_ms:
+        print(f"over budget ({args.budget_ms} ms)")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
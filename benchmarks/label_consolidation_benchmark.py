@@ -0,0 +1,148 @@
+#####################
+# benchmarks/label_consolidation_benchmark.py
+# Model aggregation (one call, or the tree reduce of aggregation_tree.py) against the local
+# consolidation of label_consolidation.py, on categories of growing size.
+#
+# The extraction labels are paraphrases of a few themes (a theme's words plus filler), each with its
+# own reviews' uids. Embeddings are offline stand-ins: the sum of a fixed random vector per word,
+# EMBEDDING_BATCH_SIZE texts per simulated request of --embedding-seconds. The model is the
+# simulated one of aggregation_tree_benchmark (same latency flags). For both paths the script
+# reports the calls, prompt tokens and simulated seconds; consolidation's are its embedding request
+# and naming call plus the real CPU seconds of the clustering (localSeconds, which includes the
+# first import of scikit-learn). For consolidation it also reports the labels and their purity (the
+# share of uids whose label's majority theme is their own; the fake model groups by uid, so its
+# purity is not meaningful). It exits non-zero if consolidation loses or duplicates uids, or its
+# purity is under --min-purity.
+#
+# Run from the repository root:
+#   python -m benchmarks.label_consolidation_benchmark --observations 500 2000 4000
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import sys
+import time
+
+from aggregation_tree import AGGREGATION_CHUNK_MAX_TOKENS, aggregation_content, tree_reduce
+from benchmarks.aggregation_tree_benchmark import KEY, UIDS_PER_OBSERVATION, SimulatedModel, simulated_seconds
+from label_consolidation import consolidate_labels
+from reviews_data_processing_utils import num_tokens_from_string
+from openai_utils import EMBEDDING_BATCH_SIZE
+
+THEMES = {
+    'smoothies': 'smoothies fruit shakes morning blend frozen berries',
+    'soups': 'soups hot vegetables puree winter soup',
+    'babyFood': 'baby food infant puree toddler meals',
+    'ice': 'ice crushing crushed cocktails frozen drinks',
+    'nutButter': 'nut butter peanut almond spread',
+    'coffee': 'coffee beans grinding espresso grind',
+    'sauces': 'sauces salsa pesto dressing dips',
+    'protein': 'protein powder gym workout shakes',
+}
+FILLER = 'used for making great daily easy quick at home every day often family kitchen'.split()
+DIMENSIONS = 256
+
+
+def synthetic_observations(count, seed=0):
+    """Extraction labels paraphrasing THEMES, each with its own reviews' uids, and the theme of each uid."""
+    rng = random.Random(seed)
+    names = sorted(THEMES)
+    observations, themeByUid = [], {}
+    for index in range(count):
+        theme = names[rng.randrange(len(names))]
+        words = rng.sample(THEMES[theme].split(), 3) + rng.sample(FILLER, 2)
+        rng.shuffle(words)
+        uids = list(range(index * UIDS_PER_OBSERVATION, (index + 1) * UIDS_PER_OBSERVATION))
+        observations.append({'headerOfCategory (7 words)': ' '.join(words).capitalize(), 'uid': uids})
+        themeByUid.update((uid, theme) for uid in uids)
+    return observations, themeByUid
+
+
+def word_vector(word):
+    import numpy as np
+    seed = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'big')
+    return np.random.default_rng(seed).standard_normal(DIMENSIONS).astype(np.float32)
+
+
+class SimulatedEmbeddings:
+    def __init__(self, args):
+        self.args = args
+        self.requests = 0
+        self.seconds = 0.0
+        self.cpuSeconds = 0.0
+
+    async def embed(self, texts):
+        import numpy as np
+        batches = [texts[start:start + EMBEDDING_BATCH_SIZE] for start in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+        self.requests += len(batches)
+        # The batches are requested concurrently
+        self.seconds += self.args.embedding_seconds
+        await asyncio.gather(*[asyncio.sleep(self.args.embedding_seconds * self.args.time_scale) for _ in batches])
+        cpuStart = time.process_time()
+        embeddings = np.vstack([sum(word_vector(word) for word in text.lower().split()) for text in texts])
+        self.cpuSeconds += time.process_time() - cpuStart
+        return embeddings
+
+
+def purity(labels, themeByUid):
+    majority = 0
+    for label in labels:
+        counts = {}
+        for uid in label['uid']:
+            counts[themeByUid[uid]] = counts.get(themeByUid[uid], 0) + 1
+        majority += max(counts.values())
+    return majority / len(themeByUid)
+
+
+async def run_model(observations, args):
+    model = SimulatedModel(args)
+    start, cpuStart = time.perf_counter(), time.process_time()
+    contentList = aggregation_content(KEY, observations)
+    if num_tokens_from_string(contentList[0]['content'], encoding_name="cl100k_base") <= args.chunk_tokens:
+        await model.complete(contentList)
+    else:
+        await tree_reduce(KEY, observations, model.complete, model.function[0]['name'], maxTokens=args.chunk_tokens)
+    return simulated_seconds(start, cpuStart, args.time_scale), model
+
+
+async def run_consolidation(observations, args):
+    """Consolidation's simulated seconds are its embedding request and naming call (one each, in turn), plus the local CPU time of the clustering."""
+    model = SimulatedModel(args)
+    embeddings = SimulatedEmbeddings(args)
+    cpuStart = time.process_time()
+    response = await consolidate_labels(KEY, observations, embeddings.embed, model.complete, model.function[0]['name'])
+    localSeconds = time.process_time() - cpuStart - embeddings.cpuSeconds
+    return embeddings.seconds + model.callSeconds + localSeconds, localSeconds, model, embeddings, json.loads(response['function_call']['arguments'])[KEY]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Model aggregation vs local label consolidation')
+    parser.add_argument('--observations', type=int, nargs='+', default=[500, 2000, 4000])
+    parser.add_argument('--chunk-tokens', type=int, default=AGGREGATION_CHUNK_MAX_TOKENS)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--call-seconds', type=float, default=1.0)
+    parser.add_argument('--input-seconds', type=float, default=0.0002)
+    parser.add_argument('--output-seconds', type=float, default=0.01)
+    parser.add_argument('--embedding-seconds', type=float, default=0.5, help='Simulated seconds of one embeddings request')
+    parser.add_argument('--time-scale', type=float, default=0.002, help='Real seconds slept per simulated second')
+    parser.add_argument('--min-purity', type=float, default=0.9)
+    args = parser.parse_args()
+
+    print('observations\tmodelCalls\tmodelPromptTokens\tmodelSeconds\tconsolidationCalls\tembeddingRequests\tconsolidationPromptTokens\tlocalSeconds\tconsolidationSeconds\tlabels\tpurity\tuidsPreserved')
+    ok = True
+    for count in args.observations:
+        observations, themeByUid = synthetic_observations(count)
+        modelSeconds, model = asyncio.run(run_model(observations, args))
+        consolidationSeconds, localSeconds, consolidation, embeddings, labels = asyncio.run(run_consolidation(observations, args))
+        uidsPreserved = sorted(uid for label in labels for uid in label['uid']) == sorted(themeByUid)
+        labelPurity = purity(labels, themeByUid)
+        ok = ok and uidsPreserved and labelPurity >= args.min_purity
+        print(f"{count}\t{model.calls}\t{model.promptTokens}\t{modelSeconds:.1f}\t{consolidation.calls}\t{embeddings.requests}\t{consolidation.promptTokens}\t{localSeconds:.1f}\t{consolidationSeconds:.1f}\t{len(labels)}\t{labelPurity:.2f}\t{uidsPreserved}")
+    if not ok:
+        print('consolidation lost or duplicated uids, or grouped labels of different themes')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
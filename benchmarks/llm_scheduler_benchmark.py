@@ -0,0 +1,73 @@
+#####################
+# benchmarks/llm_scheduler_benchmark.py
+# Wait times of small investigations queued behind a large one, with and without fair sharing.
+#
+# One large investigation submits --large-requests completions at once; --small-tenants small
+# investigations of --small-requests completions each arrive shortly after. Completions are fake
+# (--request-ms each) and share --capacity slots of a FairShareScheduler. In 'fifo' mode every
+# request is queued under one tenant, which reproduces first-come-first-served gather() ordering.
+#
+# Run from the repository root:
+#   python -m benchmarks.llm_scheduler_benchmark --large-requests 300 --small-tenants 5
+import argparse
+import asyncio
+import statistics
+import time
+
+from llm_scheduler import FairShareScheduler, run_as_tenant
+
+
+async def run_mode(mode, args):
+    scheduler = FairShareScheduler(capacity=args.capacity, quantum=args.quantum)
+    finished = {}
+
+    async def fake_completion(tenantId):
+        async with scheduler.slot(args.request_tokens):
+            await asyncio.sleep(args.request_ms / 1000)
+
+    async def investigation(tenantId, requests, priority):
+        start = time.monotonic()
+        queueId = 'shared' if mode == 'fifo' else tenantId
+
+        async def completions():
+            await asyncio.gather(*[fake_completion(tenantId) for _ in range(requests)])
+
+        await run_as_tenant(completions(), queueId, priority=priority)
+        finished[tenantId] = time.monotonic() - start
+
+    async def small(index):
+        await asyncio.sleep(args.small_delay_ms / 1000)
+        priority = 'paid' if index < args.paid_tenants else 'standard'
+        await investigation(f"small-{index}", args.small_requests, priority)
+
+    await asyncio.gather(investigation('large', args.large_requests, 'standard'), *[small(index) for index in range(args.small_tenants)])
+    return finished, scheduler.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fair-share vs FIFO LLM scheduling')
+    parser.add_argument('--capacity', type=int, default=6)
+    parser.add_argument('--quantum', type=float, default=4000)
+    parser.add_argument('--large-requests', type=int, default=300)
+    parser.add_argument('--small-tenants', type=int, default=5)
+    parser.add_argument('--small-requests', type=int, default=6)
+    parser.add_argument('--paid-tenants', type=int, default=1)
+    parser.add_argument('--small-delay-ms', type=float, default=100)
+    parser.add_argument('--request-ms', type=float, default=20)
+    parser.add_argument('--request-tokens', type=float, default=3000)
+    args = parser.parse_args()
+
+    print('mode\tlargeSeconds\tsmallMedianSeconds\tsmallMaxSeconds')
+    for mode in ('fifo', 'fair'):
+        finished, stats = asyncio.run(run_mode(mode, args))
+        smallTimes = [seconds for tenantId, seconds in finished.items() if tenantId != 'large']
+        print(f"{mode}\t{finished['large']:.2f}\t{statistics.median(smallTimes):.2f}\t{max(smallTimes):.2f}")
+        if mode == 'fair':
+            print()
+            print('tenant\tpriority\tgranted\tmeanWaitSeconds\tp95WaitSeconds')
+            for tenantId, tenantStats in stats['tenants'].items():
+                print(f"{tenantId}\t{tenantStats['priority']}\t{tenantStats['granted']}\t{tenantStats['meanWaitSeconds']}\t{tenantStats['p95WaitSeconds']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#####################
+# benchmarks/offline_clustering_benchmark.py
+# Speed and agreement of the offline label clustering (label_consolidation.consolidate_labels_offline)
+# against the model aggregation.
+#
+# The fixed corpus is a category of extraction labels drawn (seeded) from hand-written phrasings of
+# a few use cases, with or without a common suffix, each label with its own reviews' uids. The use
+# case each phrasing was written for is the reference grouping, standing in for the model's
+# aggregation. With --recorded, the
+# corpus and reference are instead a real run's: a JSON object of category to {"observations":
+# [...], "aggregation": [...]}, the category's aggregate_all_categories() labels and the labels of
+# its model aggregation (the 'aggregatedCategories' and 'aggregation' checkpoint entries).
+#
+# For every --similarity the script reports the offline labels, their CPU seconds and their
+# agreement with the reference: the adjusted Rand index of the uids' groups (1 is the same
+# grouping, 0 no better than chance). The model aggregation of the same labels runs on the
+# simulated model of aggregation_tree_benchmark (same latency flags) for its calls, prompt tokens
+# and simulated seconds. It exits non-zero if the offline path loses or duplicates uids, or the
+# agreement at the default similarity is under --min-agreement.
+#
+# Run from the repository root:
+#   python -m benchmarks.offline_clustering_benchmark --labels 500 2000
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+from aggregation_tree import AGGREGATION_CHUNK_MAX_TOKENS
+from benchmarks.aggregation_tree_benchmark import KEY, UIDS_PER_OBSERVATION, SimulatedModel
+from benchmarks.label_consolidation_benchmark import run_model
+from label_consolidation import LOCAL_CONSOLIDATION_SIMILARITY, consolidate_labels_offline
+
+PHRASINGS = {
+    'smoothies': ('Making fruit smoothies every morning', 'Blending smoothies for breakfast', 'Smoothie maker for daily use',
+                  'Fruit smoothies and shakes', 'Green smoothies with spinach', 'Morning smoothie routine'),
+    'soups': ('Pureeing hot soups', 'Making creamy vegetable soups', 'Soup blending in winter',
+              'Blending soups straight from the pot', 'Homemade soup puree', 'Creamy soups and bisques'),
+    'babyFood': ('Preparing baby food purees', 'Homemade baby food', 'Pureed meals for toddlers',
+                 'Baby food for infants', 'Making puree for the baby', 'Toddler meals and baby purees'),
+    'ice': ('Crushing ice for cocktails', 'Ice crushing for drinks', 'Crushed ice and frozen drinks',
+            'Making frozen margaritas', 'Frozen cocktails with crushed ice', 'Crushing ice cubes'),
+    'nutButter': ('Making peanut butter', 'Homemade almond butter', 'Nut butter from roasted nuts',
+                  'Grinding nuts into butter', 'Peanut and almond butter spreads', 'Nut butters at home'),
+    'coffee': ('Grinding coffee beans', 'Coffee bean grinding', 'Grinding beans for espresso',
+               'Fresh ground coffee every morning', 'Coffee grinder replacement', 'Grinds coffee and spices'),
+    'protein': ('Protein shakes after the gym', 'Mixing protein powder shakes', 'Post workout protein drinks',
+                'Protein smoothies for workouts', 'Blending protein powder', 'Gym shakes with protein'),
+    'sauces': ('Making pesto and sauces', 'Blending salsa and dips', 'Homemade salad dressings',
+               'Sauces, dips and dressings', 'Pesto sauce from basil', 'Fresh salsa for tacos'),
+}
+SUFFIXES = ('', '', '', ' for the family', ' on weekends', ' every day', ' at home', ' in a small kitchen')
+
+
+def fixed_corpus(count, seed=0):
+    """A category of count extraction labels, and the reference labels grouping their uids by use case."""
+    rng = random.Random(seed)
+    names = sorted(PHRASINGS)
+    observations, reference = [], {name: [] for name in names}
+    for index in range(count):
+        name = names[rng.randrange(len(names))]
+        uids = list(range(index * UIDS_PER_OBSERVATION, (index + 1) * UIDS_PER_OBSERVATION))
+        observations.append({'headerOfCategory (7 words)': rng.choice(PHRASINGS[name]) + rng.choice(SUFFIXES), 'uid': uids})
+        reference[name].extend(uids)
+    return observations, [{'headerOfCategory (7 words)': name, 'uid': uids} for name, uids in reference.items() if uids]
+
+
+def recorded_corpora(path):
+    with open(path) as file:
+        recorded = json.load(file)
+    return [(key, entry['observations'], entry['aggregation']) for key, entry in recorded.items()]
+
+
+def agreement(labels, reference):
+    """Adjusted Rand index of the groups of the uids in both labels and reference (a uid in several labels counts in its first)."""
+    from sklearn.metrics import adjusted_rand_score
+    groupOf = lambda labels: {uid: index for index, label in reversed(list(enumerate(labels))) for uid in label['uid']}
+    ours, theirs = groupOf(labels), groupOf(reference)
+    uids = [uid for uid in ours if uid in theirs]
+    return adjusted_rand_score([theirs[uid] for uid in uids], [ours[uid] for uid in uids]) if uids else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline label clustering vs the model aggregation')
+    parser.add_argument('--labels', type=int, nargs='+', default=[500, 2000], help='Sizes of the fixed corpus')
+    parser.add_argument('--recorded', help='JSON of recorded categories to use instead of the fixed corpus')
+    parser.add_argument('--similarity', type=float, nargs='+', default=[LOCAL_CONSOLIDATION_SIMILARITY, 0.5, 0.8])
+    parser.add_argument('--min-agreement', type=float, default=0.5)
+    parser.add_argument('--chunk-tokens', type=int, default=AGGREGATION_CHUNK_MAX_TOKENS)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--call-seconds', type=float, default=1.0)
+    parser.add_argument('--input-seconds', type=float, default=0.0002)
+    parser.add_argument('--output-seconds', type=float, default=0.01)
+    parser.add_argument('--time-scale', type=float, default=0.002, help='Real seconds slept per simulated second')
+    args = parser.parse_args()
+
+    corpora = recorded_corpora(args.recorded) if args.recorded else [(KEY, *fixed_corpus(count)) for count in args.labels]
+    functionName = SimulatedModel(args).function[0]['name']
+    # Load scikit-learn before timing anything
+    consolidate_labels_offline(KEY, fixed_corpus(20)[0], functionName)
+    print('category\tlabels\tmodelCalls\tmodelPromptTokens\tmodelSeconds\tsimilarity\tofflineLabels\tofflineSeconds\tagreement\tuidsPreserved')
+    ok = True
+    for key, observations, reference in corpora:
+        modelSeconds, model = asyncio.run(run_model(observations, args))
+        for similarity in args.similarity:
+            cpuStart = time.process_time()
+            response = consolidate_labels_offline(key, observations, functionName, similarity=similarity)
+            offlineSeconds = time.process_time() - cpuStart
+            labels = json.loads(response['function_call']['arguments'])[key] if response is not None else []
+            uidsPreserved = sorted(uid for label in labels for uid in label['uid']) == sorted({uid for observation in observations for uid in observation.get('uid') or []})
+            labelAgreement = agreement(labels, reference)
+            ok = ok and uidsPreserved and (similarity != args.similarity[0] or labelAgreement >= args.min_agreement)
+            print(f"{key}\t{len(observations)}\t{model.calls}\t{model.promptTokens}\t{modelSeconds:.1f}\t{similarity}\t{len(labels)}\t{offlineSeconds:.3f}\t{labelAgreement:.2f}\t{uidsPreserved}")
+    if not ok:
+        print('the offline clustering lost or duplicated uids, or agrees too little with the reference')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
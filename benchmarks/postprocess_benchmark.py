@@ -0,0 +1,467 @@
+#####################
+# benchmarks/postprocess_benchmark.py
+# Golden-output check and timing of the single-pass post-processor against the step-by-step one.
+#
+# legacy_postprocess() is the post-processing that process_reviews_with_gpt ran before
+# postprocessing.py, and legacy_quantify_category_data() the loop-based quantify_category_data,
+# both kept verbatim as the reference. Both run on deterministic synthetic aggregation
+# results that include the awkward cases: uids outside the investigation, duplicate labels, every
+# label key variant, responses repeating a category, empty and non-dict responses and uids shared
+# by reviews with the same id. The tagged reviews and frontend output must be identical, the
+# per-ASIN breakdowns must match the legacy post-processing of each ASIN's reviews alone, and the
+# vectorised quantify_category_data must match the loop-based one; the script exits non-zero on
+# any difference. quantifyVectorisedSeconds times it without the per-ASIN breakdowns, which the
+# loop-based one does not compute, and quantifyWithAsinsSeconds with them. The single-pass side runs on a ReviewTable of the reviews; its tagged rows are
+# turned back into dicts for the comparison, outside the timing.
+#
+# Run from the repository root:
+#   python -m benchmarks.postprocess_benchmark --reviews 5000 --repeat 5
+import argparse
+import contextlib
+import copy
+import io
+import json
+import random
+import sys
+import time
+
+from benchmarks.synthetic_corpus import synthetic_review_pages
+from postprocessing import postprocess_extraction_results
+from review_table import ReviewTable
+from reviews_data_processing_utils import quantify_category_data
+
+CATEGORIES = [
+    "useCase", "productComparison", "featureRequest", "painPoints", "usageFrequency", "usageTime",
+    "usageLocation", "customerDemographics", "functionalJob", "socialJob", "emotionalJob", "supportingJob",
+]
+LABEL_KEY_VARIANTS = ['headerOfCategory (7 words)', 'objectiveStatement', 'headerOfCategory', 'label']
+
+
+def legacy_quantify_category_data(inputData):
+    processedData = {}
+    
+    for categoryKey, labels in inputData.items():
+        categoryTotalObservations = sum([len(labelData['uid']) for labelData in labels])
+        processedLabels = []
+        
+        for labelData in labels:
+            labelObservations = len(labelData['uid'])
+            
+            # Calculate label percentage
+            labelPercentage = (labelObservations / categoryTotalObservations) * 100 if categoryTotalObservations != 0 else 0
+            formattedLabelPercentage = int("{:.0f}".format(labelPercentage))
+            
+            # Count ratings 1-3 and 4-5
+            ratings_1_2_3_count = sum(1 for rating in labelData['rating'] if rating >= 1 and rating <= 3)
+            ratings_4_5_count = sum(1 for rating in labelData['rating'] if rating >= 4 and rating <= 5)
+            
+            # Calculate average rating
+            if len(labelData['rating']) != 0:
+                averageRating = sum(labelData['rating']) / len(labelData['rating'])
+                formattedAverageRating = float("{:.1f}".format(averageRating))
+                
+                processedLabelData = {
+                    'label': labelData['label'],
+                    'uid': labelData['uid'],
+                    'asin': list(set(labelData['asin'])),
+                    'numberOfObservations': labelObservations,
+                    'percentage': formattedLabelPercentage,
+                    'rating': formattedAverageRating,
+                    'negativeRatingsCount': ratings_1_2_3_count,
+                    'positiveRatingsCount': ratings_4_5_count
+                }
+                
+                processedLabels.append(processedLabelData)
+            else:
+                # Skip if no ratings
+                continue
+        
+        processedData[categoryKey] = processedLabels
+    
+    return processedData
+
+
+def legacy_postprocess(processedResults, updatedReviewsList, uid_to_id_mapping):
+    def filter_uids(processedResults, uid_to_id_mapping):
+        filteredResults = []
+
+        for result_dict in processedResults:
+            if not isinstance(result_dict, dict):
+                continue
+            new_dict = {}
+            for key, value in result_dict.items():
+                new_value_list = []
+                for sub_dict in value:
+                    filtered_uids = [uid for uid in sub_dict['uid'] if uid in uid_to_id_mapping.keys()]
+                    if filtered_uids:
+                        new_sub_dict = sub_dict.copy()
+                        new_sub_dict['uid'] = filtered_uids
+                        new_value_list.append(new_sub_dict)
+                new_dict[key] = new_value_list
+            filteredResults.append(new_dict)
+        return filteredResults
+
+    filteredResults = filter_uids(processedResults, uid_to_id_mapping)
+
+    
+
+    # Initialize an empty list to hold the new filtered results
+    newFilteredResults = []
+
+    # Loop through each dictionary in the original filteredResults list
+    for result_dict in filteredResults:
+        # Create a new dictionary to store the de-duplicated lists for each key
+        new_dict = {}
+        
+        for key, value_list in result_dict.items():
+            # Initialize a set to keep track of seen items
+            seen = set()
+            
+            # Initialize a list to keep the unique items
+            unique_list = []
+            
+            for item in value_list:
+                # Serialize the dictionary to a string to make it hashable
+                item_str = json.dumps(item, sort_keys=True)
+                
+                # Add item to unique_list if not seen before
+                if item_str not in seen:
+                    unique_list.append(item)
+                    seen.add(item_str)
+            
+            # Update the list for the current key with the de-duplicated list
+            new_dict[key] = unique_list
+        
+        # Add the new dictionary with all de-duplicated lists to the new filtered list
+        newFilteredResults.append(new_dict)
+
+    # Update filteredResults with the de-duplicated results
+    filteredResults = newFilteredResults
+
+    ##################
+    
+
+    # Rezultatul este o lista de dictionare in loc de un dictionar
+
+    
+    # Creeaza un dictionar cu un array de dictionare fiecare
+    processedData = {}
+    for item in filteredResults:
+        try:
+            key = list(item.keys())[0]
+            value = list(item.values())[0]
+            processedData[key] = value
+        except IndexError:
+            try:
+                new_item = item[0]
+                key = list(new_item.keys())[0]
+                value = list(new_item.values())[0]
+                processedData[key] = value
+            except IndexError:
+                print("Error: Item does not have keys or values.")
+                print(item)
+            except Exception as e:
+                print(f"Unexpected error: {e}")
+                print(item)
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+            print(item)
+
+    
+
+    # Redenumeste cheile in 'header;
+    updatedOuterData = {}
+    for outer_key, inner_list in processedData.items():
+        updatedInnerList = []
+        for inner_dict in inner_list:
+            updatedInnerDict = {}
+
+            for key, value in inner_dict.items():
+                if key == 'headerOfCategory (7 words)' or key == 'objectiveStatement' or key == 'headerOfCategory':
+                    new_key = 'label'
+                else:
+                    new_key = key
+                updatedInnerDict[new_key] = value
+            
+            updatedInnerList.append(updatedInnerDict)
+        updatedOuterData[outer_key] = updatedInnerList
+    processedData = updatedOuterData.copy()
+
+    ###############
+    
+    result = {}
+    for key, value_list in processedData.items():
+        try:
+            for value in value_list:
+                try:
+                    label = value['headerOfCategory (7 words)']
+                except:
+                    try:
+                        label = value['objectiveStatement']
+                    except:
+                        try:
+                            label = value['label']
+                        except:
+                            pass
+                for uid in value['uid']:
+                    if uid in result:
+                        if key in result[uid]:
+                            result[uid][key].append(label)
+                        else:
+                            result[uid][key] = [label]
+                    else:
+                        result[uid] = {key: [label]}
+        except KeyError as e:
+            print(f"KeyError: Missing key {e} in dictionary.")
+        
+    # Sort the result dictionary by 'uid' keys
+    sortedResult = {k: result[k] for k in sorted(result)}
+
+    
+    tagedReviews = updatedReviewsList.copy()
+
+    for review in tagedReviews:
+        # Get uid from the review
+        uid = review.get('uid')
+        # Fetch tags for the given uid from sortedResults
+        tags = sortedResult.get(uid, {})
+        # Add tags to the review
+        review['tags'] = tags
+
+    
+
+    # get the asin and review text for each uid
+    uid_to_asin = {review['uid']: review['asin'] for review in tagedReviews}
+    uid_to_text = {review['uid']: review['text'] for review in tagedReviews}
+    uid_to_rating = {review['uid']: review['rating'] for review in tagedReviews}
+
+    
+    # Add asin to each uid
+    for key, value_list in processedData.items():
+        for item in value_list:
+            item['asin'] = [uid_to_asin[uid] for uid in item['uid']]
+
+    
+
+    # Add rating to each uid
+    for key, value_list in processedData.items():
+        for item in value_list:
+            item['rating'] = [int(uid_to_rating[uid]) for uid in item['uid']]
+
+    
+    try:
+        quantifiedData = legacy_quantify_category_data(processedData)
+    except Exception as e:
+        print(f"Error in quantifying data: {e}")
+        quantifiedData = {}
+
+    
+    # Add the text from the reviews to each header
+    uid_to_text = {review['uid']: review['text'] for review in tagedReviews}
+
+    for key, value_list in quantifiedData.items():
+        for item in value_list:
+            item['customerVoice'] = [uid_to_text[uid] for uid in item['uid']]
+
+    # Add id to each uid
+    quantifiedDataId = quantifiedData.copy()
+    for key, value_list in quantifiedDataId.items():
+        for item in value_list:
+            item['id'] = [uid_to_id_mapping[uid] for uid in item['uid']]
+
+    
+    # Prepare the Frontend dataset
+    try:
+        frontendOutput = {
+            key: [
+                {
+                    k: entry[k] if k != 'uid' else entry[k][:5]
+                    for k in ['label', 'numberOfObservations', 'percentage', 'rating', 'uid', 'negativeRatingsCount','positiveRatingsCount']
+                }
+                for entry in value
+            ]
+            for key, value in quantifiedData.items()
+        }
+    except KeyError as e:
+        print(f"KeyError: Missing key {e} in dictionary.")
+        frontendOutput = {}
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        frontendOutput = {}
+
+    try:
+        for key, value_list in frontendOutput.items():
+            for item in value_list:
+                item['customerVoice'] = [uid_to_text[uid] for uid in item['uid']]
+    except KeyError as e:
+        print(f"KeyError: Missing key {e} in dictionary.")
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+
+    try:
+        frontendOutput = {
+            key: [
+                {
+                    k: entry[k]
+                    for k in ['label', 'numberOfObservations', 'percentage', 'rating', 'customerVoice', 'negativeRatingsCount','positiveRatingsCount' ]
+                }
+                for entry in value
+            ]
+            for key, value in frontendOutput.items()
+        }
+    except KeyError as e:
+        print(f"KeyError: Missing key {e} in dictionary.")
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+
+    # Sort each category's list based on 'numberOfObservations'
+    try:
+        for key, value_list in frontendOutput.items():
+            sorted_value_list = sorted(value_list, key=lambda x: x['numberOfObservations'], reverse=True)
+            frontendOutput[key] = sorted_value_list
+    except KeyError as e:
+        print(f"KeyError: Missing key {e} in dictionary.")
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+
+    return tagedReviews, frontendOutput
+
+
+def synthetic_case(reviewCount, labelsPerCategory, seed):
+    """Reviews (with uids) and aggregation results exercising the edge cases listed above."""
+    rng = random.Random(seed)
+    asinCount = max(1, reviewCount // 500)
+    reviews = [dict(review, asin=f"B0POST{index:04d}") for index in range(asinCount) for page in synthetic_review_pages(f"B0POST{index:04d}", reviewCount // asinCount) for review in page]
+    # A few reviews repeated under the same id, which then share a uid
+    reviews += [dict(review) for review in rng.sample(reviews, min(5, len(reviews)))]
+    table = ReviewTable.from_reviews(reviews)
+    reviews, uid_to_id_mapping = table.to_dicts(), dict(table.uid_to_id_mapping)
+    uids = sorted(uid_to_id_mapping)
+
+    processedResults = []
+    for categoryIndex, category in enumerate(CATEGORIES):
+        labelKey = LABEL_KEY_VARIANTS[categoryIndex % len(LABEL_KEY_VARIANTS)]
+        labels = []
+        for labelIndex in range(labelsPerCategory):
+            labelUids = rng.sample(uids, min(len(uids), rng.randint(1, 60)))
+            if labelIndex % 7 == 0:
+                labelUids += [len(reviews) + 10, -1]  # Hallucinated uids
+            if labelIndex % 11 == 0:
+                labelUids = [len(reviews) + 20]  # Nothing left after filtering
+            labels.append({labelKey: f"{category} label {labelIndex}", 'uid': labelUids})
+            if labelIndex % 5 == 0:
+                labels.append(copy.deepcopy(labels[-1]))  # Duplicate label
+        processedResults.append({category: labels})
+        if categoryIndex % 4 == 0:
+            processedResults.append({category: labels[:2], 'extraCategory': labels[2:4]})  # Repeated category
+    processedResults += [{}, None]
+    return reviews, uid_to_id_mapping, processedResults
+
+
+def timed(function, repeat, reviews, uid_to_id_mapping, processedResults):
+    best = None
+    for _ in range(repeat):
+        reviewsCopy = copy.deepcopy(reviews)
+        resultsCopy = copy.deepcopy(processedResults)
+        # The legacy code prints the edge cases it skips
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            output = function(resultsCopy, reviewsCopy, uid_to_id_mapping)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return output, best
+
+
+def legacy_asin_breakdowns(reviews, uid_to_id_mapping, processedResults):
+    """Per-ASIN breakdowns as the legacy post-processing of each ASIN's uids alone computes them."""
+    breakdowns = []
+    for asin in sorted({review['asin'] for review in reviews}):
+        asinMapping = {review['uid']: uid_to_id_mapping[review['uid']] for review in reviews if review['asin'] == asin}
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, frontendOutput = legacy_postprocess(copy.deepcopy(processedResults), copy.deepcopy(reviews), asinMapping)
+        for category, insights in frontendOutput.items():
+            for insight in insights:
+                entry = {'asin': asin, 'category': category}
+                entry.update({key: value for key, value in insight.items() if key != 'customerVoice'})
+                breakdowns.append(entry)
+    breakdowns.sort(key=lambda entry: (entry['asin'], entry['category'], -entry['numberOfObservations']))
+    return breakdowns
+
+
+def quantify_input(reviews, uid_to_id_mapping, processedResults):
+    """quantify_category_data input: category -> labels with the uid, rating and asin of each observation."""
+    reviewByUid = {review['uid']: review for review in reviews}
+    inputData = {}
+    for result in processedResults:
+        if not isinstance(result, dict):
+            continue
+        for category, labels in result.items():
+            inputData[category] = []
+            for labelIndex, item in enumerate(labels):
+                uids = [uid for uid in item['uid'] if uid in uid_to_id_mapping]
+                inputData[category].append({
+                    'label': f"{category} {labelIndex}",
+                    'uid': uids,
+                    'rating': [int(reviewByUid[uid]['rating']) for uid in uids],
+                    'asin': [reviewByUid[uid]['asin'] for uid in uids],
+                })
+    return inputData
+
+
+def same_quantified(legacyData, vectorisedData):
+    """Equal apart from the byAsin breakdowns and the order of the distinct asins."""
+    def comparable(data):
+        return {
+            category: [dict({key: value for key, value in label.items() if key != 'byAsin'}, asin=sorted(label['asin'])) for label in labels]
+            for category, labels in data.items()
+        }
+    return json.dumps(comparable(legacyData)) == json.dumps(comparable(vectorisedData))
+
+
+def best_of(repeat, function, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Single-pass vs step-by-step post-processing')
+    parser.add_argument('--reviews', type=int, default=5000)
+    parser.add_argument('--labels-per-category', type=int, default=25)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seeds', type=int, default=3, help='Synthetic cases checked for identical output')
+    args = parser.parse_args()
+
+    print('seed\tlegacySeconds\tsinglePassSeconds\tspeedup\tidentical\tasinBreakdownsMatch\tquantifyLegacySeconds\tquantifyVectorisedSeconds\tquantifyWithAsinsSeconds\tquantifyMatch')
+    identical = True
+    for seed in range(args.seeds):
+        reviews, uid_to_id_mapping, processedResults = synthetic_case(args.reviews, args.labels_per_category, seed)
+        legacyOutput, legacySeconds = timed(legacy_postprocess, args.repeat, reviews, uid_to_id_mapping, processedResults)
+        # The pipeline holds the reviews in a ReviewTable from loading on, so it is built outside the timing
+        table = ReviewTable.from_reviews(reviews)
+        singlePassOutput, singlePassSeconds = timed(lambda results, _, mapping: postprocess_extraction_results(results, table, mapping), args.repeat, reviews, uid_to_id_mapping, processedResults)
+        singlePassOutput = (table.to_dicts(),) + singlePassOutput[1:]
+        same = json.dumps(legacyOutput) == json.dumps(singlePassOutput[:2])
+        sameBreakdowns = json.dumps(legacy_asin_breakdowns(reviews, uid_to_id_mapping, processedResults)) == json.dumps(singlePassOutput[2])
+
+        inputData = quantify_input(reviews, uid_to_id_mapping, processedResults)
+        sameQuantified = same_quantified(legacy_quantify_category_data(inputData), quantify_category_data(inputData)) and same_quantified(legacy_quantify_category_data(inputData), quantify_category_data(inputData, byAsin=False))
+        quantifyLegacySeconds = best_of(args.repeat, legacy_quantify_category_data, inputData)
+        # Like for like: the legacy loops have no per-ASIN breakdowns
+        quantifyVectorisedSeconds = best_of(args.repeat, lambda data: quantify_category_data(data, byAsin=False), inputData)
+        quantifyWithAsinsSeconds = best_of(args.repeat, quantify_category_data, inputData)
+
+        identical = identical and same and sameBreakdowns and sameQuantified
+        print(f"{seed}\t{legacySeconds:.4f}\t{singlePassSeconds:.4f}\t{legacySeconds / singlePassSeconds:.1f}x\t{same}\t{sameBreakdowns}\t{quantifyLegacySeconds:.4f}\t{quantifyVectorisedSeconds:.4f}\t{quantifyWithAsinsSeconds:.4f}\t{sameQuantified}")
+
+    if not identical:
+        print('output differs from the legacy output')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
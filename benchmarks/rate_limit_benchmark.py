@@ -0,0 +1,87 @@
+#####################
+# benchmarks/rate_limit_benchmark.py
+# Checks that a shared RPM / in-flight budget holds across worker processes.
+#
+# Starts --processes processes (standing in for gunicorn workers), each firing --requests-per-process
+# fake requests of --request-ms through one RateLimiter on the chosen backend, and reports the
+# achieved request rate and the peak number of requests in flight across all of them.
+#
+# Run from the repository root:
+#   python -m benchmarks.rate_limit_benchmark --processes 4 --rpm 600 --max-concurrency 6
+#   python -m benchmarks.rate_limit_benchmark --backend local   # per-process budgets, for comparison
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+from rate_limiter import FileRateLimitBackend, LocalRateLimitBackend, RedisRateLimitBackend, RateLimiter
+
+
+def build_backend(kind, statePath, redisUrl):
+    if kind == 'file':
+        return FileRateLimitBackend(statePath)
+    if kind == 'redis':
+        return RedisRateLimitBackend(redisUrl, prefix=f"rateLimitBenchmark{os.getppid()}")
+    return LocalRateLimitBackend()
+
+
+def worker(args, statePath, inFlight, peak, lock, events):
+    limiter = RateLimiter('benchmark', rpm=args.rpm, tpm=0, max_concurrency=args.max_concurrency, backend=build_backend(args.backend, statePath, args.redis_url))
+
+    async def fake_request():
+        async with limiter.limit():
+            with lock:
+                inFlight.value += 1
+                peak.value = max(peak.value, inFlight.value)
+            events.append(time.time())
+            await asyncio.sleep(args.request_ms / 1000)
+            with lock:
+                inFlight.value -= 1
+
+    async def run():
+        await asyncio.gather(*[fake_request() for _ in range(args.requests_per_process)])
+
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shared rate limit across processes')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--requests-per-process', type=int, default=40)
+    parser.add_argument('--rpm', type=float, default=600)
+    parser.add_argument('--max-concurrency', type=int, default=6)
+    parser.add_argument('--request-ms', type=float, default=50)
+    parser.add_argument('--backend', default='file', choices=['file', 'redis', 'local'])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/0')
+    args = parser.parse_args()
+
+    statePath = os.path.join(tempfile.mkdtemp(), 'rate-limits.json')
+    manager = multiprocessing.Manager()
+    events = manager.list()
+    inFlight = multiprocessing.Value('i', 0)
+    peak = multiprocessing.Value('i', 0)
+    lock = multiprocessing.Lock()
+
+    start = time.time()
+    processes = [multiprocessing.Process(target=worker, args=(args, statePath, inFlight, peak, lock, events)) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.time() - start
+
+    startTimes = sorted(events)
+    # The bucket starts full, so the first rpm requests may go out at once; measure the steady state after it
+    burst = int(args.rpm)
+    steady = startTimes[burst:]
+    steadyRpm = (len(steady) - 1) / (steady[-1] - steady[0]) * 60 if len(steady) > 1 and steady[-1] > steady[0] else None
+    print(f"backend: {args.backend}")
+    print(f"requests: {len(startTimes)} in {elapsed:.2f} s")
+    print(f"budget rpm: {args.rpm}, steady-state rpm: {round(steadyRpm, 1) if steadyRpm else '-'}")
+    print(f"max concurrency: {args.max_concurrency}, peak in flight: {peak.value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#####################
+# benchmarks/request_payload_benchmark.py
+# Cost of preparing an extraction request: building the schemas and serialising the whole payload
+# on every call, against the schema registry and a pre-serialised RequestTemplate.
+#
+# Both sides must produce the same request (equal once parsed) and the same token estimate; the
+# script exits non-zero otherwise.
+#
+# Run from the repository root:
+#   python -m benchmarks.request_payload_benchmark --requests 2000
+import argparse
+import json
+import sys
+import time
+
+from benchmarks.synthetic_corpus import synthetic_review_pages
+from function_schemas import get_function_schemas, get_request_template, get_schema_version
+from rate_limiter import estimate_request_tokens
+from reviews_data_processing_utils import export_functions_for_reviews
+
+MODEL = 'gpt-3.5-turbo-0125'
+
+
+def synthetic_messages(count):
+    reviews = [review for page in synthetic_review_pages('B0PAYLOAD01', 40) for review in page]
+    return [
+        [{"role": "user", "content": "\n\n".join(f"<{index + offset}>\n,<{review['rating']}*>\n,`{review['text']}`" for offset, review in enumerate(reviews))}]
+        for index in range(count)
+    ]
+
+
+def per_call(messages):
+    """What get_completion did before: build the schemas and serialise everything for each request."""
+    marketFunctions = export_functions_for_reviews.__wrapped__()[0]
+    estimatedTokens = estimate_request_tokens(messages, marketFunctions)
+    json_data = {"model": MODEL, "messages": messages, "temperature": 0}
+    json_data.update({"functions": marketFunctions})
+    json_data.update({"function_call": {"name": "market"}})
+    return json.dumps(json_data).encode('utf-8'), estimatedTokens
+
+
+def templated(messages):
+    template = get_request_template(MODEL, 0, get_function_schemas()['market'], {"name": "market"})
+    return template.render(messages), template.estimate_tokens(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-call payloads vs request templates')
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    messagesList = synthetic_messages(args.requests)
+    results = {}
+    for name, function in (('perCall', per_call), ('templated', templated)):
+        start = time.perf_counter()
+        outputs = [function(messages) for messages in messagesList]
+        results[name] = (time.perf_counter() - start, outputs)
+
+    same = all(
+        json.loads(perCallBody) == json.loads(templatedBody) and perCallTokens == templatedTokens
+        for (perCallBody, perCallTokens), (templatedBody, templatedTokens) in zip(results['perCall'][1], results['templated'][1])
+    )
+    perCallSeconds, templatedSeconds = results['perCall'][0], results['templated'][0]
+    print('requests\tschemaVersion\tperCallSeconds\ttemplatedSeconds\tspeedup\tsameRequests')
+    print(f"{args.requests}\t{get_schema_version()}\t{perCallSeconds:.3f}\t{templatedSeconds:.3f}\t{perCallSeconds / templatedSeconds:.1f}x\t{same}")
+    if not same:
+        print('templated requests differ from the per-call ones')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#####################
+# benchmarks/review_table_benchmark.py
+# Memory and time of numbering and batching an investigation's reviews: review dicts
+# (add_uid_to_reviews + generate_batches) against the columnar ReviewTable (from_reviews + batches).
+#
+# Memory is what each side still holds once its batches are built, measured with tracemalloc. The
+# dicts side holds the review dicts, the uid -> id dict and the batch tuples; the table side holds
+# only the table and its BatchViews, since the loaded dicts can be dropped. Review texts are the
+# same strings on both sides and are not counted. Both must produce the
+# same batches (the texts of each batch); the script exits non-zero otherwise.
+#
+# Run from the repository root:
+#   python -m benchmarks.review_table_benchmark --asins 10 --reviews-per-asin 2000
+import argparse
+import copy
+import gc
+import sys
+import time
+import tracemalloc
+
+from benchmarks.synthetic_corpus import synthetic_review_pages
+from review_table import ReviewTable
+from reviews_data_processing_utils import add_uid_to_reviews, generate_batches, num_tokens_from_string
+
+MAX_TOKENS = 6000
+
+
+def load_reviews(asinCount, reviewsPerAsin):
+    """Review dicts as the acquisition stores them, with the extra fields the API returns."""
+    reviews = []
+    for index in range(asinCount):
+        asin = f"B0TABLE{index:04d}"
+        for page in synthetic_review_pages(asin, reviewsPerAsin):
+            for review in page:
+                reviews.append(dict(review, asin=asin, date='2024-01-01', verified=True, helpfulVotes=index % 7, country='US'))
+    return reviews
+
+
+def with_dicts(reviews):
+    reviews, uid_to_id_mapping = add_uid_to_reviews(reviews)
+    batches = generate_batches(reviews, max_tokens=MAX_TOKENS)
+    return reviews, uid_to_id_mapping, batches
+
+
+def with_table(reviews):
+    table = ReviewTable.from_reviews(reviews)
+    batches = table.batches(MAX_TOKENS)
+    return table, batches
+
+
+def measure(function, reviews):
+    """Seconds taken and bytes still held by function(reviews)'s result, the input included."""
+    gc.collect()
+    tracemalloc.start()
+    reviews = copy.deepcopy(reviews)
+    start = time.perf_counter()
+    result = function(reviews)
+    elapsed = time.perf_counter() - start
+    del reviews  # The table side no longer needs the loaded dicts
+    gc.collect()
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, held
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Review dicts vs ReviewTable')
+    parser.add_argument('--asins', type=int, default=10)
+    parser.add_argument('--reviews-per-asin', type=int, default=2000)
+    args = parser.parse_args()
+
+    reviews = load_reviews(args.asins, args.reviews_per_asin)
+    for review in reviews[:200]:
+        num_tokens_from_string(review['text'])  # Load the tokenizer outside the measurements
+
+    (_, _, dictBatches), dictSeconds, dictBytes = measure(with_dicts, reviews)
+    (table, tableBatches), tableSeconds, tableBytes = measure(with_table, reviews)
+    sameBatches = [[text for _, _, text in batch] for batch in dictBatches if batch] == [[text for _, _, text in batch] for batch in tableBatches]
+
+    print('reviews\tbatches\tdictsSeconds\ttableSeconds\tdictsMb\ttableMb\tmemoryRatio\tsameBatches')
+    print(f"{len(reviews)}\t{len(tableBatches)}\t{dictSeconds:.3f}\t{tableSeconds:.3f}\t{dictBytes / 1e6:.1f}\t{tableBytes / 1e6:.1f}\t{dictBytes / tableBytes:.1f}x\t{sameBatches}")
+    if not sameBatches:
+        print('ReviewTable batches differ from generate_batches')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#####################
+# benchmarks/sampling_benchmark.py
+# Accuracy of stratified review sampling against processing every review.
+#
+# Reviews of a few ASINs get synthetic labels whose odds depend on the rating and ASIN, standing in
+# for the extraction. The full run tags every review; each sampled run draws a sample within
+# --max-reviews (seeded per run) and tags only the sampled reviews. For each budget the script
+# reports the reviews and tokens sent, the largest error of the scaled counts and percentages
+# against the full run, and the share of percentage intervals that contain the full run's
+# percentage (about 95% expected). A last case gives --small-asins ASINs of very different sizes
+# a budget of --small-budget reviews, fewer than their (ASIN, rating) strata: the sample's weights
+# must still sum to the population and every ASIN must be sampled. It exits non-zero if the
+# coverage is under --min-coverage or the small-budget case fails.
+#
+# Run from the repository root:
+#   python -m benchmarks.sampling_benchmark --asins 3 --reviews-per-asin 10000 --max-reviews 500 2000
+import argparse
+import random
+import sys
+
+from postprocessing import postprocess_extraction_results
+from review_sampling import draw_stratified_sample
+from review_table import ReviewTable
+
+LABELS = ('easy to clean', 'loud motor', 'crushes ice', 'leaks', 'good value', 'broke quickly', 'gift')
+WORDS = 'blender motor jar lid blade ice smoothie kitchen noise power cleaning value gift daily shake'.split()
+
+
+def synthetic_reviews(asinCount, reviewsPerAsin, seed=0):
+    """reviewsPerAsin reviews of each of asinCount ASINs (an int, or a list of one count per ASIN)."""
+    rng = random.Random(seed)
+    reviews = []
+    for asinIndex in range(asinCount):
+        for index in range(reviewsPerAsin if isinstance(reviewsPerAsin, int) else reviewsPerAsin[asinIndex]):
+            rating = rng.choices((1, 2, 3, 4, 5), weights=(2 + asinIndex, 1, 1, 3, 6 - asinIndex))[0]
+            text = f"{' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 30)))} {asinIndex}-{index}"
+            reviews.append({'id': f"R{asinIndex}{index:07d}", 'asin': f"B0SAMPLE{asinIndex:02d}", 'rating': rating, 'text': text})
+    return reviews
+
+
+def review_labels(table, uid, seed=0):
+    """The labels the extraction would give uid: each with odds that depend on its rating and ASIN."""
+    row = table.rowByUid[uid]
+    rng = random.Random(f"{seed}-{table.idByUid[uid]}")
+    rating, asinCode = table.ratings[row], table.asinCodes[row]
+    return [label for index, label in enumerate(LABELS) if rng.random() < 0.05 + 0.04 * ((index + rating + asinCode) % 5)]
+
+
+def tag(table, uids):
+    labelUids = {label: [] for label in LABELS}
+    for uid in uids:
+        for label in review_labels(table, uid):
+            labelUids[label].append(uid)
+    return [{'useCase': [{'label': label, 'uid': uids} for label, uids in labelUids.items() if uids]}]
+
+
+def run(reviews, maxReviews=None, seed=0):
+    table = ReviewTable.from_reviews(reviews)
+    report = draw_stratified_sample(table, maxReviews=maxReviews, seed=seed) if maxReviews else None
+    _, frontendOutput, _ = postprocess_extraction_results(tag(table, table.extraction_uids()), table)
+    return {entry['label']: entry for entry in frontendOutput['useCase']}, report
+
+
+def small_budget_case(asinCount, maxReviews, seed=0):
+    """Sample ASINs of 20 to 400 reviews under a budget below their strata; whether the weights cover every unit and every ASIN."""
+    reviews = synthetic_reviews(asinCount, [int(20 * 20 ** (index / max(1, asinCount - 1))) for index in range(asinCount)], seed)
+    table = ReviewTable.from_reviews(reviews)
+    report = draw_stratified_sample(table, maxReviews=maxReviews, seed=seed)
+    weightedUnits = sum(table.weightByUid[uid] for uid in table.representatives)
+    asinsSampled = len({table.asinCodes[table.rowByUid[uid]] for uid in table.sample})
+    ok = abs(weightedUnits - report['population']) < 1e-6 and asinsSampled == asinCount
+    return report, weightedUnits, asinsSampled, ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stratified sampling vs every review')
+    parser.add_argument('--asins', type=int, default=3)
+    parser.add_argument('--reviews-per-asin', type=int, default=10000)
+    parser.add_argument('--max-reviews', type=int, nargs='+', default=[500, 2000])
+    parser.add_argument('--runs', type=int, default=20, help='Sampled runs (seeds) per budget')
+    parser.add_argument('--min-coverage', type=float, default=0.85)
+    parser.add_argument('--small-asins', type=int, default=5)
+    parser.add_argument('--small-budget', type=int, default=10, help='Reviews of the small-budget case, below its strata')
+    args = parser.parse_args()
+
+    reviews = synthetic_reviews(args.asins, args.reviews_per_asin)
+    full, _ = run(reviews)
+
+    print('maxReviews\tsampled\tsampledTokens\tpopulationTokens\tmaxCountError\tmaxPercentageError\tmeanIntervalWidth\tcoverage')
+    coverageOk = True
+    for maxReviews in args.max_reviews:
+        countErrors, percentageErrors, widths, covered, intervals = [], [], [], 0, 0
+        for seed in range(args.runs):
+            sampled, report = run(reviews, maxReviews, seed)
+            for label, truth in full.items():
+                estimate = sampled.get(label)
+                if estimate is None:
+                    continue
+                countErrors.append(abs(estimate['numberOfObservations'] - truth['numberOfObservations']) / truth['numberOfObservations'])
+                percentageErrors.append(abs(estimate['percentage'] - truth['percentage']))
+                low, high = estimate['percentageInterval']
+                widths.append(high - low)
+                covered += low <= truth['percentage'] <= high
+                intervals += 1
+        coverage = covered / intervals if intervals else 0.0
+        coverageOk = coverageOk and coverage >= args.min_coverage
+        print(f"{maxReviews}\t{report['sampled']}\t{report['sampledTokens']}\t{report['populationTokens']}\t{max(countErrors):.1%}\t{max(percentageErrors)}\t{sum(widths) / len(widths):.1f}\t{coverage:.2f}")
+
+    report, weightedUnits, asinsSampled, smallBudgetOk = small_budget_case(args.small_asins, args.small_budget)
+    print('\nsmallBudget\tfineStrata\tstrataBy\tstrata\tsampled\tweightedUnits\tpopulation\tasinsSampled')
+    print(f"{args.small_budget}\t{args.small_asins * 5}\t{','.join(report['strataBy']) or '-'}\t{report['strata']}\t{report['sampled']}\t{weightedUnits:.0f}\t{report['population']}\t{asinsSampled}/{args.small_asins}")
+    if not coverageOk:
+        print(f"percentage intervals contain the full-run percentage less than {args.min_coverage:.0%} of the time")
+    if not smallBudgetOk:
+        print('the small-budget sample leaves units or ASINs out of the estimate')
+    if not (coverageOk and smallBudgetOk):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
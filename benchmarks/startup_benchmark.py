@@ -0,0 +1,73 @@
+#####################
+# benchmarks/startup_benchmark.py
+# Cold-start benchmark of the API worker for each CLIENT_WARMUP mode.
+#
+# Every run is a fresh interpreter that imports the connexion app (as gunicorn does with app:app)
+# and serves two requests through the Flask test client: GET /cache_stats, which needs no client,
+# and GET /jobs/{id}, which reads Firestore (or the local backend). Reported times are measured
+# from the start of the import.
+#
+# Run from the repository root:
+#   python -m benchmarks.startup_benchmark --runs 5
+#   python -m benchmarks.startup_benchmark --backend firestore   # with real credentials
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+CHILD_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import app
+importSeconds = time.perf_counter() - start
+client = app.app.test_client()
+client.get('/cache_stats')
+firstResponseSeconds = time.perf_counter() - start
+client.get('/jobs/startup-benchmark-missing-job')
+firstStorageResponseSeconds = time.perf_counter() - start
+import main
+warmupDoneSeconds = None
+if main.CLIENT_WARMUP != 'off':
+    main.clientWarmupDone.wait(60)
+    warmupDoneSeconds = time.perf_counter() - start
+print('RESULT ' + json.dumps({
+    'importSeconds': importSeconds,
+    'firstResponseSeconds': firstResponseSeconds,
+    'firstStorageResponseSeconds': firstStorageResponseSeconds,
+    'warmupDoneSeconds': warmupDoneSeconds,
+}))
+"""
+
+
+def run_once(mode, backend):
+    env = dict(os.environ, CLIENT_WARMUP=mode, STORAGE_BACKEND=backend)
+    env.setdefault('OPENAI_API_KEY', 'startup-benchmark')
+    completed = subprocess.run([sys.executable, '-c', CHILD_SCRIPT], env=env, capture_output=True, text=True, timeout=300)
+    for line in completed.stdout.splitlines():
+        if line.startswith('RESULT '):
+            return json.loads(line[len('RESULT '):])
+    raise RuntimeError(f"Startup run failed for CLIENT_WARMUP={mode}:\n{completed.stderr[-2000:]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start time of the API worker per CLIENT_WARMUP mode')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--backend', default='memory', help="STORAGE_BACKEND of the runs ('memory', 'sqlite' or 'firestore')")
+    parser.add_argument('--modes', default='sync,background,off')
+    args = parser.parse_args()
+
+    columns = ['mode', 'importSeconds', 'firstResponseSeconds', 'firstStorageResponseSeconds', 'warmupDoneSeconds']
+    print('\t'.join(columns))
+    for mode in args.modes.split(','):
+        runs = [run_once(mode, args.backend) for _ in range(args.runs)]
+        row = [mode]
+        for column in columns[1:]:
+            values = [run[column] for run in runs if run[column] is not None]
+            row.append(str(round(statistics.median(values), 3)) if values else '-')
+        print('\t'.join(row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#####################
+# benchmarks/storage_benchmark.py
+# Offline end-to-end benchmark of run_end_to_end_investigation on the local storage backend.
+#
+# Review acquisition (RapidAPI) and the OpenAI calls are replaced by deterministic offline fakes,
+# so the run measures the pipeline and the storage round trips only. Each scenario runs with a
+# different storage layout (per-review documents vs review snapshots, per-label vs packed insights)
+# against a LocalDocumentStore with injected latency; the *_pipelined scenario runs with
+# END_TO_END_MODE=pipelined. --fetch-ms and --completion-ms add latency to the fakes, which shows
+# how much of the acquisition time pipelining hides.
+#
+# Run from the repository root:
+#   python -m benchmarks.storage_benchmark --asins 3 --reviews-per-asin 500 --latency-ms 20
+#   python -m benchmarks.storage_benchmark --asins 5 --fetch-ms 2000 --completion-ms 500
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+os.environ.setdefault('OPENAI_API_KEY', 'offline-benchmark')
+# The synthetic reviews are filled-in templates: near-duplicate collapsing would leave a handful to extract
+os.environ.setdefault('NEAR_DUPLICATE_THRESHOLD', '0')
+# The fake model answers function calls only: aggregate with it rather than with embeddings
+os.environ.setdefault('AGGREGATION_MODE', 'llm')
+
+import firebase_utils
+from benchmarks.synthetic_corpus import synthetic_review_pages
+import data_acquisition
+import reviews_processing
+import run_investigation
+from run_investigation import run_end_to_end_investigation
+
+# Subcollections the frontend lists to render an investigation stored with the perLabel layout
+INSIGHT_CATEGORIES = [
+    "useCase", "productComparison", "featureRequest", "painPoints", "usageFrequency", "usageTime",
+    "usageLocation", "customerDemographics", "functionalJob", "socialJob", "emotionalJob", "supportingJob",
+]
+
+
+def _label_key(functions):
+    properties = functions[0]['parameters']['properties']
+    firstCategory = next(iter(properties.values()))
+    return [key for key in firstCategory['items']['properties'] if key != 'uid'][0]
+
+
+def fake_function_call(content, functions):
+    """Answer a function call offline: group the uids found in the prompt into up to 10 labels per category."""
+    text = content[0]['content']
+    uids = [int(uid) for uid in re.findall(r"<(\d+)>\n,<", text)]
+    if not uids:
+        uids = [int(uid) for chunk in re.findall(r"'uid': \[([\d, ]*)\]", text) for uid in chunk.split(',') if uid.strip()]
+    labelKey = _label_key(functions)
+    arguments = {}
+    for category in functions[0]['parameters']['properties']:
+        groups = {}
+        for uid in uids:
+            groups.setdefault(uid % 10, []).append(uid)
+        arguments[category] = [{labelKey: f"{category} label {group}", 'uid': groupUids} for group, groupUids in sorted(groups.items())]
+    return {'role': 'assistant', 'content': None, 'function_call': {'name': functions[0]['name'], 'arguments': json.dumps(arguments)}}
+
+
+def install_offline_fakes(reviewsPerAsin, fetchSeconds=0, completionSeconds=0):
+    async def fake_get_product_reviews(asin):
+        # ASINs land one after another, like paged RapidAPI fetches of different sizes
+        await asyncio.sleep(fetchSeconds * (1 + int(asin[-3:])) / 2)
+        return synthetic_review_pages(asin, reviewsPerAsin)
+
+    async def fake_get_completion_list_multifunction(content_list, functions_list, function_calls_list, GPT_MODEL=None, TEMPERATURE=0, **kwargs):
+        await asyncio.sleep(completionSeconds)
+        return [fake_function_call(content, functions) for functions in functions_list for content in content_list]
+
+    async def fake_get_completion(content, *args, functions=None, **kwargs):
+        await asyncio.sleep(completionSeconds)
+        return fake_function_call(content, functions)
+
+    data_acquisition.get_product_reviews = fake_get_product_reviews
+    reviews_processing.get_completion_list_multifunction = fake_get_completion_list_multifunction
+    reviews_processing.get_completion = fake_get_completion
+
+
+def run_scenario(name, asinCount, snapshots, insightLayouts, mode='staged'):
+    db = firebase_utils.db
+    run_investigation.END_TO_END_MODE = mode
+    firebase_utils.REVIEW_SNAPSHOTS_ENABLED = snapshots
+    data_acquisition.REVIEW_SNAPSHOTS_ENABLED = snapshots
+    os.environ['INSIGHTS_STORAGE_LAYOUTS'] = ','.join(insightLayouts)
+    for cache in (firebase_utils.productDetailsCache, firebase_utils.reviewsCache, firebase_utils.reviewCountCache):
+        cache.clear()
+
+    asinList = [f"B0BENCH{name.upper()[:3]}{index:03d}" for index in range(asinCount)]
+    db.reset_stats()
+    start = time.time()
+    result = run_end_to_end_investigation({'userId': 'benchmark-user', 'asinList': asinList, 'name': name})
+    elapsed = time.time() - start
+    stats = db.stats()
+
+    # Read path of the investigation view
+    investigationId = db.collection('investigations').document('benchmark-user').collection('investigationCollections').where('name', '==', name).get()[0].id
+    db.reset_stats()
+    viewStart = time.time()
+    if insightLayouts[0] == 'perLabel':
+        for category in INSIGHT_CATEGORIES:
+            list(db.collection('reviewsInsights').document('benchmark-user').collection('investigationCollections').document(investigationId).collection(category).stream())
+    else:
+        firebase_utils.get_packed_insights_from_firestore('benchmark-user', investigationId)
+    viewElapsed = time.time() - viewStart
+
+    return {
+        'scenario': name,
+        'mode': mode,
+        'success': bool(result),
+        'seconds': round(elapsed, 3),
+        **stats,
+        'viewSeconds': round(viewElapsed, 3),
+        'viewRoundTrips': db.stats()['roundTrips'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--asins', type=int, default=3)
+    parser.add_argument('--reviews-per-asin', type=int, default=500)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--fetch-ms', type=float, default=0.0, help='Fake fetch time of the first ASIN, the k-th takes (k+1)/2 times it')
+    parser.add_argument('--completion-ms', type=float, default=0.0, help='Fake time of each completion')
+    args = parser.parse_args()
+
+    firebase_utils.db.latency = args.latency_ms / 1000
+    install_offline_fakes(args.reviews_per_asin, args.fetch_ms / 1000, args.completion_ms / 1000)
+
+    scenarios = [
+        ('perReviewDocs_perLabel', False, ['perLabel']),
+        ('snapshot_perLabel', True, ['perLabel']),
+        ('snapshot_perCategory', True, ['perCategory']),
+        ('snapshot_whole', True, ['whole']),
+        ('snapshot_whole_pipelined', True, ['whole'], 'pipelined'),
+    ]
+    results = [run_scenario(name, args.asins, *options) for name, *options in scenarios]
+
+    columns = list(results[0].keys())
+    print('\t'.join(columns))
+    for row in results:
+        print('\t'.join(str(row[column]) for column in columns))
+
+
+if __name__ == '__main__':
+    main()
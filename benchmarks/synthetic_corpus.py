@@ -0,0 +1,28 @@
+#####################
+# benchmarks/synthetic_corpus.py
+# Deterministic synthetic reviews shared by the offline benchmarks.
+import random
+
+REVIEW_TEMPLATES = [
+    "Great {item}, works as expected and the battery lasts all day",
+    "The {item} broke after two weeks, very disappointed with the quality",
+    "I use this {item} every morning in the kitchen, easy to clean",
+    "Bought the {item} as a gift for my dad, he loves it",
+    "Compared to my old {item} this one is much quieter and faster",
+    "Would be perfect if the {item} had a longer cable",
+]
+ITEMS = ["blender", "kettle", "toaster", "mixer", "grinder"]
+
+
+def synthetic_review_pages(asin, reviewsPerAsin, seed=0):
+    rng = random.Random(f"{asin}-{seed}")
+    reviews = [
+        {
+            'id': f"{asin}-R{index}",
+            'rating': rng.randint(1, 5),
+            'title': f"Review {index}",
+            'text': rng.choice(REVIEW_TEMPLATES).format(item=rng.choice(ITEMS)) + f" #{index}",
+        }
+        for index in range(reviewsPerAsin)
+    ]
+    return [reviews[index:index + 20] for index in range(0, len(reviews), 20)]
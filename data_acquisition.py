@@ -6,13 +6,19 @@
 
 import time
 import asyncio
-import nest_asyncio
 import aiohttp
-from google.cloud import firestore, secretmanager
+from google.cloud import firestore
 import firebase_admin
 from firebase_admin import credentials, firestore
 import json
 import os
+import logging
+
+from postgres_store import get_review_store
+from event_loop import run_coroutine, get_http_session
+from rate_limiter import get_rate_limiter
+from profiler import record_api_call
+from firebase_utils import FirestoreClient, REVIEW_SNAPSHOTS_ENABLED, merge_reviews_into_snapshot, invalidate_asin_cache
 
 # Amazon Scraper details
 product_url = "https://amazonlive.p.rapidapi.com/product"
@@ -23,69 +29,28 @@ headers = {
 }
 
 def initialize_firestore():
-    """Initialize Firestore client."""
-
-    # Check if running on App Engine
-    if os.environ.get('GAE_ENV', '').startswith('standard'):
-        # Running on App Engine, use default credentials
-        if not firebase_admin._apps:
-            firebase_admin.initialize_app()
-    else:
-        # Try to get the key content from environment variable
-        FIREBASE_KEY = os.getenv("FIREBASE_KEY")
-
-        # If not found, try to get from secret management
-        if not FIREBASE_KEY:
-            try:
-                FIREBASE_KEY = get_secret("FIREBASE_KEY")
-            except Exception as e:
-                logging.error(f"Error fetching FIREBASE_KEY from secret manager: {e}")
-
-        # If still not found, load from .env (for local development)
-        if not FIREBASE_KEY:
-            from dotenv import load_dotenv
-            load_dotenv()
-            FIREBASE_KEY = os.getenv("FIREBASE_KEY")
-
-        if not FIREBASE_KEY:
-            raise ValueError("FIREBASE_KEY not found in environment or secrets")
-
-        # Check if FIREBASE_KEY is a path to a file
-        if os.path.exists(FIREBASE_KEY):
-            with open(FIREBASE_KEY, 'r') as file:
-                cred_data = json.load(file)
-        else:
-            # Try to parse the key content as JSON
-            try:
-                cred_data = json.loads(FIREBASE_KEY)
-            except json.JSONDecodeError:
-                logging.error("Failed to parse FIREBASE_KEY content")
-                raise ValueError("Failed to parse FIREBASE_KEY as JSON")
-
-        if not firebase_admin._apps:
-            cred = credentials.Certificate(cred_data)
-            firebase_admin.initialize_app(cred)
-
-    db = firestore.client()
-    return db
+    """Return the shared document store client (Firestore, or the local backend selected by STORAGE_BACKEND)."""
+    return FirestoreClient.get_instance()
 
 
 async def get_product_details(asin, retries=3):
     start = time.time()
-    async with aiohttp.ClientSession() as session:
-        params = {"asin": asin, "location": "us"}
-        for _ in range(retries):
-            async with session.get(product_url, headers=headers, params=params) as response:
-                if response.status == 429:  # Rate limit hit
-                    await asyncio.sleep(2)  # Wait for 2 seconds
-                    continue
-                elif response.status != 200:
-                    print(f"Failed to fetch product details for {asin}. HTTP status: {response.status}")
-                    return None
-                print(f"Fetching product details for {asin} took {time.time() - start} seconds.")
-                return await response.json()
-        print(f"Failed to fetch product details for {asin} after {retries} retries.")
-        return None
+    session = get_http_session('rapidapi')
+    params = {"asin": asin, "location": "us"}
+    limiter = get_rate_limiter('rapidapi')
+    for _ in range(retries):
+        async with limiter.limit(), session.get(product_url, headers=headers, params=params) as response:
+            record_api_call('rapidapi')
+            if response.status == 429:  # Rate limit hit: hold back every worker for 2 seconds
+                await limiter.pause_async(2)
+                continue
+            elif response.status != 200:
+                print(f"Failed to fetch product details for {asin}. HTTP status: {response.status}")
+                return None
+            print(f"Fetching product details for {asin} took {time.time() - start} seconds.")
+            return await response.json()
+    print(f"Failed to fetch product details for {asin} after {retries} retries.")
+    return None
 
 
 async def fetch_reviews(session, page_var, asin, retries=3):
@@ -97,10 +62,12 @@ async def fetch_reviews(session, page_var, asin, retries=3):
         "sort_by_recent": "false",
         "only_verified": "true"
     }
+    limiter = get_rate_limiter('rapidapi')
     for _ in range(retries):
-        async with session.get(reviews_url, headers=headers, params=params) as response:
-            if response.status == 429:  # Rate limit hit
-                await asyncio.sleep(2)  # Wait for 2 seconds
+        async with limiter.limit(), session.get(reviews_url, headers=headers, params=params) as response:
+            record_api_call('rapidapi')
+            if response.status == 429:  # Rate limit hit: hold back every worker for 2 seconds
+                await limiter.pause_async(2)
                 continue
             elif response.status != 200:
                 print(f"Failed to fetch reviews for {asin} page {page_var}. HTTP status: {response.status}")
@@ -112,28 +79,42 @@ async def fetch_reviews(session, page_var, asin, retries=3):
 
 async def get_product_reviews(asin):
     start = time.time()
-    async with aiohttp.ClientSession() as session:
-        pages = ["1", "2", "3", "4", "5"]
-        # pages = ["1"]
-        tasks = [fetch_reviews(session, page_var, asin) for page_var in pages]
-        results = await asyncio.gather(*tasks)
-        print(f"Fetching product reviews for {asin} took {time.time() - start} seconds.")
-        return results
+    session = get_http_session('rapidapi')
+    pages = ["1", "2", "3", "4", "5"]
+    # pages = ["1"]
+    tasks = [fetch_reviews(session, page_var, asin) for page_var in pages]
+    results = await asyncio.gather(*tasks)
+    print(f"Fetching product reviews for {asin} took {time.time() - start} seconds.")
+    return results
+
 
 def update_firestore(asin, details, reviews, db):
-    if details is None or reviews is None or any(review is None for review in reviews):
+    if reviews is None or any(review is None for review in reviews):
         print(f"Skipping Firestore update for {asin} due to missing data.")
         return
     start = time.time()
+
+    reviewStore = get_review_store()
+    if reviewStore is not None:
+        if details is not None:
+            reviewStore.write_product_details(asin, details)
+        acquiredReviews = [dict(review, asin=asin) for review_page in reviews if review_page is not None for review in review_page]
+        reviewStore.write_reviews(acquiredReviews)
+        invalidate_asin_cache(asin)
+        print(f"Updating Postgres for {asin} took {time.time() - start} seconds.")
+        return
+
     doc_ref = db.collection('products').document(asin)
     
-    # Set details field in the document
-    doc_ref.set({
-        'details': details
-    }, merge=True)
+    # Set details field in the document (details fetching is currently disabled in process_asin)
+    if details is not None:
+        doc_ref.set({
+            'details': details
+        }, merge=True)
 
     # Initialize Firestore batch
     batch = db.batch()
+    acquiredReviews = []
     for review_page in reviews:
         if review_page is not None:
             for review in review_page:  # Directly iterate over review_page
@@ -141,29 +122,59 @@ def update_firestore(asin, details, reviews, db):
                 review['asin'] = asin
                 review_ref = doc_ref.collection('reviews').document(review_id)
                 batch.set(review_ref, review)
+                acquiredReviews.append(review)
 
     # Commit the batch
     batch.commit()
+    invalidate_asin_cache(asin)
+
+    # Keep the columnar snapshot in step with the reviews collection
+    if REVIEW_SNAPSHOTS_ENABLED and acquiredReviews:
+        merge_reviews_into_snapshot(asin, acquiredReviews)
 
     print(f"Updating Firestore for {asin} took {time.time() - start} seconds.")
 
-async def process_asin(asin, db):
+async def process_asin(asin, db, on_reviews=None):
     
     """details = await get_product_details(asin)
     if details is None:
         print(f"Skipping {asin} due to failed details fetch.")
         return"""
     
+    details = None
+
     reviews = await get_product_reviews(asin)
     if reviews is None or any(review is None for review in reviews):
         print(f"Skipping {asin} due to failed reviews fetch.")
         return
-    update_firestore(asin, details, reviews, db)
+    if on_reviews is None:
+        # Blocking storage writes run in a worker thread so they don't stall the shared event loop
+        await asyncio.to_thread(update_firestore, asin, details, reviews, db)
+        return
 
-async def run_data_acquisition(asinList):
+    # Pipelined runs: hand the reviews on while they are persisted (update_firestore tags the originals)
+    acquiredReviews = [dict(review, asin=asin) for review_page in reviews if review_page is not None for review in review_page]
+    persisting = asyncio.ensure_future(asyncio.to_thread(update_firestore, asin, details, reviews, db))
+    try:
+        on_reviews(acquiredReviews)
+    finally:
+        await persisting
+
+async def run_data_acquisition(asinList, on_reviews=None):
+    """
+    Fetch and persist the reviews of every ASIN.
+
+    Parameters:
+    - asinList (list): ASINs to acquire.
+    - on_reviews (callable, optional): Called on the event loop with the reviews of each ASIN
+      (tagged with 'asin') as soon as they are fetched, while they are being persisted.
+
+    Returns:
+    - bool: True if acquisition ran, False on error.
+    """
     try:
         db = initialize_firestore()
-        tasks = [process_asin(asin, db) for asin in asinList]
+        tasks = [process_asin(asin, db, on_reviews) for asin in asinList]
         await asyncio.gather(*tasks)
         return True
     except Exception as e:
@@ -171,26 +182,23 @@ async def run_data_acquisition(asinList):
         return False
 
 def execute_data_acquisition(asinList):
-    nest_asyncio.apply()
-    return asyncio.run(run_data_acquisition(asinList))
+    return run_coroutine(run_data_acquisition(asinList))
 # %%
 # ######## TESTING FUNCTIONS #########
 
 
 # Test function to get product details for the first ASIN
 def test_get_product_details_for_first_asin():
-    nest_asyncio.apply()
     asin = asinList[0]
-    details = asyncio.run(get_product_details(asin))
+    details = run_coroutine(get_product_details(asin))
     print(f"Product details for ASIN {asin}:")
     print(details)
     return details
 
 # Test function to get reviews for the first ASIN
 def test_get_product_reviews_for_first_asin():
-    nest_asyncio.apply()
     asin = asinList[0]
-    reviews = asyncio.run(get_product_reviews(asin))
+    reviews = run_coroutine(get_product_reviews(asin))
     print(f"Reviews for ASIN {asin}:")
     for review_page in reviews:
         if review_page:
@@ -201,13 +209,12 @@ def test_get_product_reviews_for_first_asin():
 
 # Test function to write product details and reviews for the first ASIN to Firebase
 def test_write_to_firestore_for_first_asin():
-    nest_asyncio.apply()
     asin = asinList[0]
     db = initialize_firestore()
     
     # Fetch product details and reviews
-    # details = asyncio.run(get_product_details(asin))
-    reviews = asyncio.run(get_product_reviews(asin))
+    # details = run_coroutine(get_product_details(asin))
+    reviews = run_coroutine(get_product_reviews(asin))
     
     # Write to Firestore
     update_firestore(asin, details, reviews, db)
@@ -0,0 +1,130 @@
+#####################
+# event_loop.py
+# One asyncio event loop per process, running in a background thread.
+#
+# Flask handlers and job workers are synchronous: they hand coroutines to the loop with
+# run_coroutine() and block on the result. Because the loop lives as long as the process, the
+# aiohttp sessions returned by get_http_session() (and anything else bound to the loop) are shared
+# across requests instead of being rebuilt by every asyncio.run().
+# The loop starts on first use, so every gunicorn worker gets its own after the fork.
+import asyncio
+import atexit
+import logging
+import os
+import threading
+
+import aiohttp
+
+
+class BackgroundEventLoop:
+    """
+    An event loop running forever in a daemon thread, with a thread-safe submit API.
+
+    Args:
+    - name (str): Name of the loop thread.
+    """
+
+    def __init__(self, name='background-event-loop'):
+        self.name = name
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self._sessions = {}
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._started.set)
+        self.loop.run_forever()
+
+    def in_loop_thread(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, coro):
+        """
+        Schedule a coroutine on the loop from any thread.
+
+        Returns:
+        - concurrent.futures.Future: Resolves to the coroutine's result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """
+        Run a coroutine on the loop and block the calling thread until it finishes.
+
+        Parameters:
+        - coro (coroutine): The coroutine to run.
+        - timeout (float, optional): Seconds to wait; the coroutine is cancelled when they run out.
+
+        Returns:
+        - The coroutine's result (its exception is re-raised in the caller).
+        """
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError("run() called from the event loop thread; await the coroutine instead")
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def get_http_session(self, name, timeout=300):
+        """
+        Return the loop's shared aiohttp session for name, creating it on first use.
+
+        Must be called from a coroutine running on this loop.
+        """
+        session = self._sessions.get(name)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout))
+            self._sessions[name] = session
+        return session
+
+    async def _close_sessions(self):
+        for session in self._sessions.values():
+            if not session.closed:
+                await session.close()
+        self._sessions.clear()
+
+    def stop(self, timeout=5):
+        if not self.loop.is_running():
+            return
+        try:
+            self.submit(self._close_sessions()).result(timeout)
+        except Exception as e:
+            logging.error(f"Error closing HTTP sessions of {self.name}: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+
+_backgroundLoop = None
+_backgroundLoopLock = threading.Lock()
+
+
+def get_event_loop():
+    """Return the process-wide BackgroundEventLoop, starting it on first use (and again after a fork)."""
+    global _backgroundLoop
+    with _backgroundLoopLock:
+        if _backgroundLoop is None or _backgroundLoop.pid != os.getpid():
+            _backgroundLoop = BackgroundEventLoop()
+        return _backgroundLoop
+
+
+def run_coroutine(coro, timeout=None):
+    """Run a coroutine on the process-wide loop from synchronous code and return its result."""
+    return get_event_loop().run(coro, timeout)
+
+
+def get_http_session(name, timeout=300):
+    """Shared aiohttp session for name on the process-wide loop (call from coroutines running on it)."""
+    return get_event_loop().get_http_session(name, timeout)
+
+
+@atexit.register
+def _stop_event_loop():
+    if _backgroundLoop is not None and _backgroundLoop.pid == os.getpid():
+        _backgroundLoop.stop()
@@ -2,13 +2,18 @@
 # Description: Utility functions for interacting with Firestore
 # firebase_utils.py
 # %%
-import pandas as pd
 import asyncio
 import os
 import json
+import copy
+import uuid
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
 from collections import defaultdict
 import logging
-from google.cloud import firestore, secretmanager, pubsub_v1
+from google.cloud import firestore
+from google.api_core.exceptions import FailedPrecondition, NotFound
 # from google.cloud.secretmanager_v1 import SecretManagerServiceClient
 import firebase_admin
 from firebase_admin import credentials, firestore
@@ -16,15 +21,26 @@ from firebase_admin import credentials, firestore
 from tqdm import tqdm
 import time
 
+from read_cache import ReadThroughCache
+from storage_backends import get_storage_backend_from_env
+from postgres_store import get_review_store
+
 # %%
 
+# Clients are created on first use (get_instance is thread safe) rather than at import, so a cold
+# start serves its first request without waiting on credentials, Secret Manager or gRPC channels.
+
 class SecretManager:
     _client = None
+    _lock = threading.Lock()
 
     @classmethod
     def get_client(cls):
         if cls._client is None:
-            cls._client = secretmanager.SecretManagerServiceClient()
+            with cls._lock:
+                if cls._client is None:
+                    from google.cloud import secretmanager
+                    cls._client = secretmanager.SecretManagerServiceClient()
         return cls._client
 
     @classmethod
@@ -38,16 +54,23 @@ class SecretManager:
 
 class FirestoreClient:
     _instance = None
+    _lock = threading.Lock()
 
     @classmethod
     def get_instance(cls):
         if cls._instance is None:
-            cls._instance = cls._initialize_firestore()
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls._initialize_firestore()
         return cls._instance
 
     @staticmethod
     def _initialize_firestore():
-        global db  # Consider replacing this with a return statement to avoid global usage
+        # Local SQLite/in-memory backend for offline runs and benchmarks (STORAGE_BACKEND=memory|sqlite)
+        localStore = get_storage_backend_from_env()
+        if localStore is not None:
+            return localStore
+
         # Check if running on App Engine
         if os.environ.get('GAE_ENV', '').startswith('standard'):
             # Running on App Engine, use default credentials
@@ -89,23 +112,27 @@ class FirestoreClient:
                 cred = credentials.Certificate(cred_data)
                 firebase_admin.initialize_app(cred)
 
-        db = firestore.client()
-        return db
+        return firestore.client()
 
 
 
 
 class GAEClient:
     _instance = None
+    _lock = threading.Lock()
 
     @classmethod
     def get_instance(cls):
         if cls._instance is None:
-            cls._instance = cls._initialize_gae()
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls._initialize_gae()
         return cls._instance
 
     @staticmethod
     def _initialize_gae():
+        if os.getenv('STORAGE_BACKEND', 'firestore').lower() != 'firestore':
+            return FirestoreClient.get_instance()
         if os.environ.get('GAE_ENV', '').startswith('standard') or \
            os.environ.get('GOOGLE_CLOUD_PROJECT', ''):
             if not firebase_admin._apps:
@@ -126,15 +153,20 @@ class GAEClient:
 
 class PubSubClient:
     _instance = None
+    _lock = threading.Lock()
 
     @classmethod
     def get_instance(cls):
         if cls._instance is None:
-            cls._instance = cls._initialize_pub_sub()
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls._initialize_pub_sub()
         return cls._instance
 
     @staticmethod
     def _initialize_pub_sub():
+        from google.cloud import pubsub_v1
+
         # Define publisher and subscriber before using them
         publisher = pubsub_v1.PublisherClient()
         subscriber = pubsub_v1.SubscriberClient()
@@ -148,13 +180,73 @@ class PubSubClient:
         return publisher, subscriber, project_id, topic_id, subscription_id, topic_path, subscription_path
 
 
-db = FirestoreClient.get_instance()
-# pubsub_client = PubSubClient.get_instance()
+class LazyClient:
+    """
+    Module-level stand-in for a client that is only created on first use.
+
+    Attribute reads and writes are forwarded to provider(), e.g. FirestoreClient.get_instance,
+    so `db.collection(...)` works as before while importing this module stays cheap.
+    """
+
+    def __init__(self, provider):
+        object.__setattr__(self, '_provider', provider)
+
+    def __getattr__(self, name):
+        return getattr(self._provider(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._provider(), name, value)
+
+
+db = LazyClient(FirestoreClient.get_instance)
+
+########### READ CACHE #############
+
+# Per-process read-through caches keyed by ASIN, bounded by READ_CACHE_MAX_BYTES of Python
+# memory per worker. Writers below and in data_acquisition call invalidate_asin_cache for the
+# ASINs they touch, but that only reaches the writing process: other workers serve their copy
+# until it expires, so reviews (which scrapes and deletions change) get the shorter
+# READ_CACHE_REVIEWS_TTL_SECONDS.
+READ_CACHE_MAX_BYTES = int(os.getenv('READ_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+READ_CACHE_TTL_SECONDS = float(os.getenv('READ_CACHE_TTL_SECONDS', 600))
+READ_CACHE_REVIEWS_TTL_SECONDS = float(os.getenv('READ_CACHE_REVIEWS_TTL_SECONDS', 60))
+
+productDetailsCache = ReadThroughCache('productDetails', READ_CACHE_MAX_BYTES // 8, READ_CACHE_TTL_SECONDS)
+reviewsCache = ReadThroughCache('reviews', READ_CACHE_MAX_BYTES, READ_CACHE_REVIEWS_TTL_SECONDS)
+reviewCountCache = ReadThroughCache('reviewCount', 1024 * 1024, READ_CACHE_REVIEWS_TTL_SECONDS)
+
+
+def _copy_reviews(reviews):
+    # Pipeline stages add keys (uid, tags) to review dicts, so hand out per-call copies
+    return [dict(review) for review in reviews]
+
+
+def invalidate_asin_cache(asin):
+    """Drop cached product details, reviews and review count for an ASIN."""
+    productDetailsCache.invalidate(asin)
+    reviewsCache.invalidate(asin)
+    reviewCountCache.invalidate(asin)
+
+
+def get_read_cache_stats():
+    """Return hit/miss/size stats of the read caches in this process."""
+    return {cache.name: cache.stats() for cache in (productDetailsCache, reviewsCache, reviewCountCache)}
 
 ########### PRODUCTS #############
 
 
-def get_product_details_from_asin(asin):
+def get_product_details_from_asin(asin, use_cache=True):
+    return productDetailsCache.get_or_load(asin, lambda: load_product_details_from_asin(asin), copy=copy.deepcopy, use_cache=use_cache)
+
+def load_product_details_from_asin(asin):
+    reviewStore = get_review_store()
+    if reviewStore is not None:
+        try:
+            return reviewStore.get_product_details(asin)
+        except Exception as e:
+            logging.error(f"Error retrieving product details for ASIN {asin} from Postgres: {e}")
+            return None
+
     try:
         # Retrieve the product details from Firestore
         product_ref = db.collection('products').document(asin)
@@ -204,6 +296,7 @@ def update_firestore_individual_products(newProductsList):
             doc_ref.set(product, merge=True)  # Use set() with merge=True to update or create a new document
         except Exception as e:
             logging.error(f"Error updating document {product['asin']}: {e}")
+        invalidate_asin_cache(product['asin'])
 
 def save_product_details_to_firestore(userId, investigationId, productData):
     """
@@ -254,7 +347,31 @@ def get_product_data_from_investigation(userId, investigationId):
 
 ########### REVIEWS #############
 
-def get_reviews_from_asin(asin):
+def get_reviews_from_asin(asin, use_cache=True):
+    return reviewsCache.get_or_load(asin, lambda: load_reviews_from_asin(asin), copy=_copy_reviews, use_cache=use_cache)
+
+def load_reviews_from_asin(asin):
+    reviewStore = get_review_store()
+    if reviewStore is not None:
+        try:
+            return reviewStore.get_reviews_for_asins([asin]).get(asin)
+        except Exception as e:
+            logging.error(f"Error retrieving reviews for ASIN {asin} from Postgres: {e}")
+            return None
+
+    if REVIEW_SNAPSHOTS_ENABLED:
+        snapshotReviews = get_reviews_from_snapshot(asin)
+        if snapshotReviews is not None:
+            return snapshotReviews
+
+    productReviews = stream_reviews_from_asin(asin)
+
+    if productReviews and REVIEW_SNAPSHOTS_ENABLED:
+        write_review_snapshot(asin, productReviews)
+
+    return productReviews
+
+def stream_reviews_from_asin(asin):
     try:
         # Retrieve the reviews from Firestore
         reviews_query = db.collection('products').document(asin).collection('reviews').stream()
@@ -279,15 +396,191 @@ def get_reviews_from_asin(asin):
         logging.warning(f'No product reviews found for ASIN {asin}')
         return None
 
-def get_investigation_and_reviews(userId, investigationId):
+########### REVIEW SNAPSHOTS #############
+
+# Columnar, zlib-compressed copy of the review fields the pipeline needs, stored next to the
+# per-review documents so an investigation reads a few blobs per ASIN instead of every review.
+# Bump REVIEW_SNAPSHOT_VERSION whenever REVIEW_SNAPSHOT_FIELDS or the encoding changes:
+# snapshots with another version are treated as stale and rebuilt from products/{asin}/reviews.
+REVIEW_SNAPSHOTS_ENABLED = os.getenv('REVIEW_SNAPSHOTS_ENABLED', '').lower() in ('1', 'true', 'yes')
+REVIEW_SNAPSHOT_VERSION = 1
+REVIEW_SNAPSHOT_FIELDS = ('id', 'rating', 'text')
+REVIEW_SNAPSHOT_CHUNK_BYTES = 900000
+
+
+def encode_review_snapshot(reviews):
+    """
+    Encode reviews as compressed columns, split into chunks that fit in a Firestore bytes field.
+
+    Parameters:
+    - reviews (list): List of review dicts.
+
+    Returns:
+    - list: List of bytes chunks.
+    """
+    columns = {field: [review.get(field) for review in reviews] for field in REVIEW_SNAPSHOT_FIELDS}
+    payload = zlib.compress(json.dumps(columns, separators=(',', ':')).encode('utf-8'), 6)
+    return [payload[index:index + REVIEW_SNAPSHOT_CHUNK_BYTES] for index in range(0, len(payload), REVIEW_SNAPSHOT_CHUNK_BYTES)] or [b'']
+
+
+def decode_review_snapshot(chunks, asin):
+    """
+    Decode snapshot chunks back into review dicts carrying the 'asin' key.
+
+    Parameters:
+    - chunks (list): List of bytes chunks, in order.
+    - asin (str): The ASIN the reviews belong to.
+
+    Returns:
+    - list: List of review dicts.
+    """
+    columns = json.loads(zlib.decompress(b''.join(chunks)).decode('utf-8'))
+    fields = [field for field in REVIEW_SNAPSHOT_FIELDS if field in columns]
+    return [dict(zip(fields, values), asin=asin) for values in zip(*(columns[field] for field in fields))]
+
+
+def write_review_snapshot(asin, reviews):
+    """
+    Write (or replace) the review snapshot for an ASIN.
+
+    The chunks are written first under a new generation id and the manifest on products/{asin}
+    last, so readers never combine chunks from two different snapshots.
+
+    Parameters:
+    - asin (str): The ASIN.
+    - reviews (list): All reviews of the ASIN.
+
+    Returns:
+    - bool: True if successful, False otherwise.
+    """
     try:
-        asinList = get_asins_from_investigation(userId, investigationId)
+        startTime = time.time()
+        product_ref = db.collection('products').document(asin)
+        snapshots_ref = product_ref.collection('reviewSnapshots')
+
+        chunks = encode_review_snapshot(reviews)
+        generation = uuid.uuid4().hex
+        writes = [(snapshots_ref.document(str(index)), {'generation': generation, 'data': chunk}) for index, chunk in enumerate(chunks)]
+        _commit_in_batches(writes)
+
+        product_ref.set({
+            'reviewSnapshot': {
+                'version': REVIEW_SNAPSHOT_VERSION,
+                'fields': list(REVIEW_SNAPSHOT_FIELDS),
+                'generation': generation,
+                'chunks': len(chunks),
+                'count': len(reviews),
+                'stale': False,
+                'updatedTimestamp': firestore.SERVER_TIMESTAMP,
+            }
+        }, merge=True)
+
+        logging.info(f"Review snapshot for ASIN {asin} written: {len(reviews)} reviews in {len(chunks)} chunks. Time taken: {time.time() - startTime} seconds")
+        return True
     except Exception as e:
-        logging.error(f"Error getting ASINs for investigation {investigationId}: {e}")
-        return []
+        logging.error(f"Error writing review snapshot for ASIN {asin}: {e}")
+        return False
+
+
+def get_reviews_from_snapshot(asin):
+    """
+    Read reviews for an ASIN from its snapshot: one product read plus one batched chunk read.
+
+    Parameters:
+    - asin (str): The ASIN.
+
+    Returns:
+    - list: List of review dicts.
+    - None: If there's no usable snapshot (missing, stale, other version, incomplete chunks).
+    """
+    try:
+        product_ref = db.collection('products').document(asin)
+        product = product_ref.get()
+        if not product.exists:
+            return None
+
+        manifest = (product.to_dict() or {}).get('reviewSnapshot')
+        if not manifest:
+            return None
+        if manifest.get('stale') or manifest.get('version') != REVIEW_SNAPSHOT_VERSION or tuple(manifest.get('fields', ())) != REVIEW_SNAPSHOT_FIELDS:
+            logging.info(f"Review snapshot for ASIN {asin} is stale, it will be rebuilt")
+            return None
+
+        snapshots_ref = product_ref.collection('reviewSnapshots')
+        chunkDocs = {doc.id: doc for doc in db.get_all([snapshots_ref.document(str(index)) for index in range(manifest['chunks'])])}
+        chunks = []
+        for index in range(manifest['chunks']):
+            chunkDoc = chunkDocs.get(str(index))
+            if chunkDoc is None or not chunkDoc.exists or chunkDoc.get('generation') != manifest['generation']:
+                logging.warning(f"Review snapshot for ASIN {asin} is incomplete, it will be rebuilt")
+                return None
+            chunks.append(chunkDoc.get('data'))
+
+        reviews = decode_review_snapshot(chunks, asin)
+        return reviews or None
+    except Exception as e:
+        logging.error(f"Error reading review snapshot for ASIN {asin}: {e}")
+        return None
+
+
+def merge_reviews_into_snapshot(asin, newReviews):
+    """
+    Merge freshly acquired reviews into the ASIN's snapshot, keyed by review id.
+
+    Parameters:
+    - asin (str): The ASIN.
+    - newReviews (list): Reviews that were just written to products/{asin}/reviews.
+
+    Returns:
+    - bool: True if successful, False otherwise.
+    """
+    existingReviews = get_reviews_from_snapshot(asin)
+    if existingReviews is None:
+        # No usable snapshot: the reviews collection (which already holds newReviews) is the source of truth
+        existingReviews = stream_reviews_from_asin(asin) or []
+
+    reviewsById = {review['id']: review for review in existingReviews}
+    for review in newReviews:
+        reviewsById[review['id']] = review
+
+    return write_review_snapshot(asin, list(reviewsById.values()))
+
+
+def mark_review_snapshot_stale(asin):
+    """Flag the ASIN's snapshot so the next read rebuilds it from the reviews collection."""
+    try:
+        product_ref = db.collection('products').document(asin)
+        product_ref.set({'reviewSnapshot': {'stale': True}}, merge=True)
+    except Exception as e:
+        logging.error(f"Error marking review snapshot stale for ASIN {asin}: {e}")
+
+
+def get_investigation_and_reviews(userId, investigationId, asinList=None):
+    if asinList is None:
+        try:
+            asinList = get_asins_from_investigation(userId, investigationId)
+        except Exception as e:
+            logging.error(f"Error getting ASINs for investigation {investigationId}: {e}")
+            return []
 
     reviewsList = []
 
+    reviewStore = get_review_store()
+    if reviewStore is not None and asinList:
+        # One indexed query for every ASIN of the investigation, bypassing the per-ASIN path
+        try:
+            reviewsByAsin = reviewStore.get_reviews_for_asins(asinList)
+        except Exception as e:
+            logging.error(f"Error retrieving reviews for investigation {investigationId} from Postgres: {e}")
+            return []
+        for asin in asinList:
+            if asin in reviewsByAsin:
+                reviewsCache.set(asin, _copy_reviews(reviewsByAsin[asin]))
+                reviewsList.append(reviewsByAsin[asin])
+            else:
+                logging.warning(f'No product reviews found for ASIN {asin}')
+        return reviewsList
+
     if asinList is not None:
         for asin in asinList:
             try:
@@ -300,15 +593,22 @@ def get_investigation_and_reviews(userId, investigationId):
 
     return reviewsList
 
-def get_clean_reviews(userId, investigationId):
-    """Retrieve and clean reviews."""
+def get_clean_reviews(userId, investigationId, statusTracker=None, asinList=None):
+    """
+    Retrieve and clean reviews.
+
+    Pass the run's statusTracker so the 'startedReviews' transition is coalesced with the one
+    run_reviews_investigation already made, and asinList when it is known to skip reading it back.
+    """
     try:
-        update_investigation_status(userId, investigationId, "startedReviews")
+        if statusTracker is None:
+            statusTracker = InvestigationStatusTracker(userId, investigationId)
+        statusTracker.transition("startedReviews")
     except Exception as e:
         logging.error(f"Error updating investigation status for {investigationId}: {e}")
 
     try:
-        reviews_download = get_investigation_and_reviews(userId, investigationId)
+        reviews_download = get_investigation_and_reviews(userId, investigationId, asinList=asinList)
         flattened_reviews = [item for sublist in reviews_download for item in sublist]
     except Exception as e:
         logging.error(f"Error flattening reviews for investigation {investigationId}: {e}")
@@ -323,6 +623,16 @@ def write_reviews_to_firestore(cleanReviewsList):
         asinString = review['asin']
         reviewsByAsin[asinString].append(review)
 
+    reviewStore = get_review_store()
+    if reviewStore is not None:
+        try:
+            reviewStore.write_reviews(cleanReviewsList)
+        except Exception as e:
+            logging.error(f"Error saving/updating reviews to Postgres: {e}")
+        for asinString in reviewsByAsin:
+            invalidate_asin_cache(asinString)
+        return
+
     startTime = time.time()
 
     # Write reviews for each ASIN in a batch
@@ -340,6 +650,9 @@ def write_reviews_to_firestore(cleanReviewsList):
 
         try:
             batch.commit()
+            invalidate_asin_cache(asinString)
+            if REVIEW_SNAPSHOTS_ENABLED:
+                mark_review_snapshot_stale(asinString)
             logging.info(f"Successfully saved/updated reviews for ASIN {asinString}")
         except Exception as e:
             logging.error(f"Error saving/updating reviews for ASIN {asinString}: {e}")
@@ -401,21 +714,531 @@ def write_insights_to_firestore(userId, investigationId, quantifiedDataId):
         return False
 
 
+########### PACKED INSIGHTS #############
+
+# Firestore rejects documents above 1 MiB; keep headroom for the manifest fields
+# and for the difference between our estimate and Firestore's own accounting.
+FIRESTORE_DOCUMENT_SIZE_LIMIT = 1048576
+PACKED_DOCUMENT_SIZE_BUDGET = 900000
+# A batch may hold at most 500 writes and 10 MiB of payload.
+FIRESTORE_BATCH_MAX_WRITES = 500
+FIRESTORE_BATCH_MAX_BYTES = 9 * 1024 * 1024
+
+PACKED_INSIGHTS_VERSION = 1
+INSIGHTS_STORAGE_LAYOUTS = ('perLabel', 'perCategory', 'whole')
+
+
+def estimate_document_size(value):
+    """
+    Estimate the Firestore storage size of a value, following the sizing rules in the
+    Firestore documentation (strings: UTF-8 bytes + 1, numbers/timestamps: 8, maps: field name + value).
+
+    Parameters:
+    - value: The value (usually a dict) to size.
+
+    Returns:
+    - int: Estimated size in bytes.
+    """
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 8
+    if isinstance(value, str):
+        return len(value.encode('utf-8')) + 1
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(str(k).encode('utf-8')) + 1 + estimate_document_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_document_size(v) for v in value)
+    # Timestamps, sentinels, references
+    return 8
+
+
+def chunk_category_items(categoryItems, maxBytes=PACKED_DOCUMENT_SIZE_BUDGET):
+    """
+    Split a {category: [items]} mapping into as few chunks as possible, each within maxBytes.
+
+    Parameters:
+    - categoryItems (dict): Category name to list of insight dicts.
+    - maxBytes (int): Size budget per chunk.
+
+    Returns:
+    - list: List of {category: [items]} dicts, in category/item order.
+    """
+    chunks = []
+    currentChunk = {}
+    currentSize = 0
+
+    for category, items in categoryItems.items():
+        categoryOverhead = len(category.encode('utf-8')) + 1
+        for item in items:
+            itemSize = estimate_document_size(item)
+            if itemSize + categoryOverhead > maxBytes:
+                raise ValueError(f"Insight in category {category} is {itemSize} bytes, larger than the {maxBytes} bytes chunk budget.")
+
+            addedSize = itemSize + (0 if category in currentChunk else categoryOverhead)
+            if currentChunk and currentSize + addedSize > maxBytes:
+                chunks.append(currentChunk)
+                currentChunk = {}
+                currentSize = 0
+                addedSize = itemSize + categoryOverhead
+
+            currentChunk.setdefault(category, []).append(item)
+            currentSize += addedSize
+
+        if not items:
+            currentChunk.setdefault(category, [])
+            currentSize += categoryOverhead
+
+    if currentChunk or not chunks:
+        chunks.append(currentChunk)
+
+    return chunks
+
+
+def _commit_in_batches(writes):
+    """Commit (doc_ref, data) pairs, splitting by Firestore's per-batch write and size limits. data=None deletes."""
+    batch = db.batch()
+    batchWrites = 0
+    batchBytes = 0
+
+    for doc_ref, data in writes:
+        dataSize = estimate_document_size(data) if data is not None else 0
+        if batchWrites and (batchWrites >= FIRESTORE_BATCH_MAX_WRITES or batchBytes + dataSize > FIRESTORE_BATCH_MAX_BYTES):
+            batch.commit()
+            batch = db.batch()
+            batchWrites = 0
+            batchBytes = 0
+
+        if data is None:
+            batch.delete(doc_ref)
+        else:
+            batch.set(doc_ref, data)
+        batchWrites += 1
+        batchBytes += dataSize
+
+    if batchWrites:
+        batch.commit()
+
+
+def _packed_insights_ref(userId, investigationId):
+    return db.collection('reviewsInsightsPacked').document(userId).collection('investigationCollections').document(investigationId)
+
+
+def write_packed_insights_to_firestore(userId, investigationId, frontendOutput, layout='perCategory'):
+    """
+    Write the frontendOutput packed into a few size-checked documents.
+
+    Layout under reviewsInsightsPacked/{userId}/investigationCollections/{investigationId}:
+    - the investigation document is the manifest. With layout='whole', a frontendOutput that fits in
+      one document is stored inline in the manifest ('insights' field), so the view is a single read.
+    - otherwise chunks are written to the 'chunks' subcollection and the manifest lists their ids:
+      'perCategory' keeps one chunk sequence per category ({category}-{n}), 'whole' shares one
+      sequence across all categories ({n}).
+
+    Parameters:
+    - userId (str): The ID of the user.
+    - investigationId (str): The ID of the investigation.
+    - frontendOutput (dict): Category name to list of insight dicts.
+    - layout (str): 'perCategory' or 'whole'.
+
+    Returns:
+    - bool: True if successful, False otherwise.
+    """
+    if layout not in ('perCategory', 'whole'):
+        raise ValueError(f"Unknown packed insights layout: {layout}")
+
+    try:
+        startTime = time.time()
+        manifest_ref = _packed_insights_ref(userId, investigationId)
+        chunks_ref = manifest_ref.collection('chunks')
+
+        # Chunks left over from a previous write of this investigation are deleted after the new manifest lands
+        previousManifest = manifest_ref.get()
+        previousChunkIds = set(previousManifest.to_dict().get('chunkIds', [])) if previousManifest.exists else set()
+
+        manifest = {
+            'version': PACKED_INSIGHTS_VERSION,
+            'layout': layout,
+            'categories': {category: len(items) for category, items in frontendOutput.items()},
+            'updatedTimestamp': firestore.SERVER_TIMESTAMP,
+        }
+        chunkWrites = []
+
+        if layout == 'whole':
+            chunks = chunk_category_items(frontendOutput)
+            if len(chunks) == 1:
+                manifest['insights'] = chunks[0]
+                manifest['chunkIds'] = []
+            else:
+                manifest['chunkIds'] = [str(index) for index in range(len(chunks))]
+                chunkWrites = [(chunks_ref.document(chunkId), {'insights': chunk}) for chunkId, chunk in zip(manifest['chunkIds'], chunks)]
+        else:
+            manifest['categoryChunks'] = {}
+            for category, items in frontendOutput.items():
+                chunks = chunk_category_items({category: items})
+                chunkIds = [f"{category}-{index}" for index in range(len(chunks))]
+                manifest['categoryChunks'][category] = chunkIds
+                chunkWrites.extend((chunks_ref.document(chunkId), {'insights': chunk}) for chunkId, chunk in zip(chunkIds, chunks))
+            manifest['chunkIds'] = [chunkId for chunkIds in manifest['categoryChunks'].values() for chunkId in chunkIds]
+
+        if estimate_document_size(manifest) > FIRESTORE_DOCUMENT_SIZE_LIMIT:
+            raise ValueError(f"Packed insights manifest for {investigationId} exceeds the Firestore document size limit.")
+
+        # Chunks first, manifest last: readers only follow chunk ids that the manifest has committed
+        staleChunkIds = previousChunkIds - set(manifest['chunkIds'])
+        _commit_in_batches(chunkWrites + [(manifest_ref, manifest)])
+        if staleChunkIds:
+            _commit_in_batches([(chunks_ref.document(chunkId), None) for chunkId in staleChunkIds])
+
+        elapsedTime = time.time() - startTime
+        logging.info(f"Packed insights ({layout}, {len(chunkWrites)} chunks) for {investigationId} written to Firestore. Time taken: {elapsedTime} seconds")
+        return True
+    except Exception as e:
+        logging.error(f"Error writing packed insights for {investigationId} to Firestore: {e}")
+        return False
+
+
+def get_packed_insights_from_firestore(userId, investigationId, categories=None):
+    """
+    Read packed insights back into the frontendOutput shape: one manifest read plus one batched
+    read of the chunks it references.
+
+    Parameters:
+    - userId (str): The ID of the user.
+    - investigationId (str): The ID of the investigation.
+    - categories (list, optional): Only load these categories (saves reads with the 'perCategory' layout).
+
+    Returns:
+    - dict: Category name to list of insight dicts.
+    - None: If the investigation has no packed insights or there's an error.
+    """
+    try:
+        manifest_ref = _packed_insights_ref(userId, investigationId)
+        manifestDoc = manifest_ref.get()
+        if not manifestDoc.exists:
+            logging.warning(f"No packed insights found for investigation {investigationId}")
+            return None
+        manifest = manifestDoc.to_dict()
+
+        wantedCategories = list(manifest.get('categories', {})) if categories is None else list(categories)
+        insights = {category: [] for category in wantedCategories if category in manifest.get('categories', {})}
+
+        if manifest.get('layout') == 'perCategory':
+            chunkIds = [chunkId for category in insights for chunkId in manifest['categoryChunks'].get(category, [])]
+        else:
+            chunkIds = manifest.get('chunkIds', [])
+            for category, items in manifest.get('insights', {}).items():
+                if category in insights:
+                    insights[category].extend(items)
+
+        if chunkIds:
+            chunks_ref = manifest_ref.collection('chunks')
+            chunkDocs = {doc.id: doc for doc in db.get_all([chunks_ref.document(chunkId) for chunkId in chunkIds])}
+            for chunkId in chunkIds:
+                chunkDoc = chunkDocs.get(chunkId)
+                if chunkDoc is None or not chunkDoc.exists:
+                    raise ValueError(f"Packed insights chunk {chunkId} referenced by the manifest is missing.")
+                for category, items in chunkDoc.to_dict().get('insights', {}).items():
+                    if category in insights:
+                        insights[category].extend(items)
+
+        return insights
+    except Exception as e:
+        logging.error(f"Error reading packed insights for {investigationId} from Firestore: {e}")
+        return None
+
+
+def write_insights(userId, investigationId, frontendOutput, layouts=None):
+    """
+    Write insights in each of the configured storage layouts.
+
+    Parameters:
+    - userId (str): The ID of the user.
+    - investigationId (str): The ID of the investigation.
+    - frontendOutput (dict): Category name to list of insight dicts.
+    - layouts (list, optional): Any of 'perLabel', 'perCategory', 'whole'. Defaults to the
+      comma-separated INSIGHTS_STORAGE_LAYOUTS environment variable, or 'perLabel'.
+
+    Returns:
+    - bool: True if every layout was written, False otherwise.
+    """
+    if layouts is None:
+        layouts = [layout.strip() for layout in os.getenv('INSIGHTS_STORAGE_LAYOUTS', 'perLabel').split(',') if layout.strip()]
+
+    success = True
+    for layout in layouts:
+        if layout == 'perLabel':
+            success = write_insights_to_firestore(userId, investigationId, frontendOutput) and success
+        elif layout in INSIGHTS_STORAGE_LAYOUTS:
+            success = write_packed_insights_to_firestore(userId, investigationId, frontendOutput, layout=layout) and success
+        else:
+            logging.error(f"Unknown insights storage layout: {layout}")
+            success = False
+    return success
+
+
+
+def write_clusters_to_firestore(investigationId, frontendOutput, asinBreakdowns):
+    """
+    Write the cluster statistics of an investigation to clusters/{investigationId}.
+
+    Parameters:
+    - investigationId (str): The ID of the investigation.
+    - frontendOutput (dict): Category name to list of insight dicts; written without customerVoice
+      as attributeClustersWithPercentage, one {category, label, ...} object per label.
+    - asinBreakdowns (list): The same statistics per ASIN ({asin, category, label, ...} objects),
+      written as attributeClustersWithPercentageByAsin.
+
+    Returns:
+    - bool: True if successful, False otherwise.
+    """
+    try:
+        clusters = {
+            'attributeClustersWithPercentage': [
+                dict({key: value for key, value in insight.items() if key != 'customerVoice'}, category=category)
+                for category, insights in frontendOutput.items()
+                for insight in insights
+            ],
+            'attributeClustersWithPercentageByAsin': asinBreakdowns,
+            'updatedTimestamp': firestore.SERVER_TIMESTAMP,
+        }
+        if estimate_document_size(clusters) > PACKED_DOCUMENT_SIZE_BUDGET:
+            raise ValueError(f"Clusters of {investigationId} exceed the {PACKED_DOCUMENT_SIZE_BUDGET} bytes document budget.")
+        db.collection('clusters').document(investigationId).set(clusters)
+        logging.info(f"Clusters for {investigationId} written to Firestore ({len(asinBreakdowns)} label-ASIN pairs).")
+        return True
+    except Exception as e:
+        logging.error(f"Error writing clusters for {investigationId} to Firestore: {e}")
+        return False
+
+
+########### INVESTIGATION CHECKPOINTS #############
+
+# Output of each reviews-processing stage, saved under investigationCheckpoints/{investigationId}
+# so a rerun (recovered job, retried request) resumes from the last completed unit of work instead
+# of paying for every LLM call again. Units: 'cleanedReviews' (ReviewTable columns), 'batches' (uids only),
+# 'extraction' per function and batch, 'aggregatedCategories' and 'aggregation' per category.
+# Values are zlib-compressed JSON, split into parts that fit in a document. Every document carries
+# expireAt; a Firestore TTL policy on that field (collection groups investigationCheckpoints and
+# units) deletes them after CHECKPOINT_RETENTION_HOURS, and expired ones are ignored until then.
+# Bump CHECKPOINT_VERSION whenever a unit's format or the meaning of its key changes.
+CHECKPOINTS_ENABLED = os.getenv('CHECKPOINTS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+CHECKPOINT_RETENTION_HOURS = float(os.getenv('CHECKPOINT_RETENTION_HOURS', 72))
+CHECKPOINT_VERSION = 3
+CHECKPOINT_PART_BYTES = 900000
+
+
+def encode_checkpoint(value):
+    """
+    Encode a checkpoint value as compressed JSON parts.
+
+    Parameters:
+    - value: JSON-serializable value.
+
+    Returns:
+    - list: List of bytes parts.
+    """
+    payload = zlib.compress(json.dumps(value, separators=(',', ':'), default=str).encode('utf-8'), 6)
+    return [payload[index:index + CHECKPOINT_PART_BYTES] for index in range(0, len(payload), CHECKPOINT_PART_BYTES)] or [b'']
+
+
+def decode_checkpoint(parts):
+    """Decode the parts written by encode_checkpoint (in order) back into the value."""
+    return json.loads(zlib.decompress(b''.join(parts)).decode('utf-8'))
+
+
+class InvestigationCheckpoint:
+    """
+    Checkpointed stage output of one investigation.
+
+    Units are read once, on first access, and kept in memory; save() writes through. Checkpoints
+    written with another version or config, or marked completed (the insights were written, so a
+    new run starts from fresh reviews), are ignored: the next save starts a new generation.
+
+    Args:
+    - investigationId (str): The ID of the investigation.
+    - config (dict, optional): Settings the saved units depend on (model, batch size, ...).
+    - retention_hours (float): How long the checkpoints are kept.
+    """
+
+    def __init__(self, investigationId, config=None, retention_hours=CHECKPOINT_RETENTION_HOURS):
+        self.investigationId = investigationId
+        self.config = config or {}
+        self.retention_hours = retention_hours
+        self.generation = None
+        self._units = None
+        self._lock = threading.Lock()
+
+    def _manifest_ref(self):
+        return db.collection('investigationCheckpoints').document(self.investigationId)
+
+    def _expire_at(self):
+        return datetime.now(timezone.utc) + timedelta(hours=self.retention_hours)
+
+    @staticmethod
+    def _unit_id(stage, key):
+        return stage if key is None else f"{stage}:{key}"
+
+    @staticmethod
+    def _is_expired(data):
+        expireAt = data.get('expireAt')
+        return expireAt is not None and expireAt <= datetime.now(timezone.utc)
+
+    def _load(self):
+        with self._lock:
+            if self._units is not None:
+                return self._units
+            self._units = {}
+            try:
+                manifest = self._manifest_ref().get()
+                data = manifest.to_dict() if manifest.exists else None
+                if not data or data.get('completed') or self._is_expired(data) or data.get('version') != CHECKPOINT_VERSION or data.get('config') != self.config:
+                    return self._units
+                self.generation = data['generation']
+
+                parts = defaultdict(dict)
+                heads = {}
+                for doc in self._manifest_ref().collection('units').where('generation', '==', self.generation).stream():
+                    unit = doc.to_dict()
+                    if self._is_expired(unit):
+                        continue
+                    unitId = doc.id.split('#')[0]
+                    parts[unitId][unit['part']] = unit
+                    if unit['part'] == 0:
+                        heads[unitId] = unit
+
+                for unitId, head in heads.items():
+                    unitParts = [parts[unitId].get(index) for index in range(head['parts'])]
+                    if any(part is None or part['unitGeneration'] != head['unitGeneration'] for part in unitParts):
+                        logging.warning(f"Checkpoint {unitId} of investigation {self.investigationId} is incomplete, it will be redone")
+                        continue
+                    self._units[unitId] = decode_checkpoint([part['data'] for part in unitParts])
+                logging.info(f"Loaded {len(self._units)} checkpoints of investigation {self.investigationId}")
+            except Exception as e:
+                logging.error(f"Error loading checkpoints of investigation {self.investigationId}: {e}")
+                self._units = {}
+            return self._units
+
+    def has(self, stage, key=None):
+        return self._unit_id(stage, key) in self._load()
+
+    def get(self, stage, key=None, default=None):
+        return self._load().get(self._unit_id(stage, key), default)
+
+    def get_stage(self, stage):
+        """Return {key: value} of the keyed units saved for stage."""
+        prefix = f"{stage}:"
+        return {unitId[len(prefix):]: value for unitId, value in self._load().items() if unitId.startswith(prefix)}
+
+    def save(self, stage, value, key=None):
+        """Save one unit. Returns True if successful, False otherwise."""
+        return self.save_many(stage, {key: value})
+
+    def save_many(self, stage, values):
+        """
+        Save several units of a stage in batched writes.
+
+        Parameters:
+        - stage (str): The stage name.
+        - values (dict): Unit key (None for the stage's single unit) to value.
+
+        Returns:
+        - bool: True if successful, False otherwise.
+        """
+        self._load()
+        try:
+            expireAt = self._expire_at()
+            with self._lock:
+                if self.generation is None:
+                    self.generation = uuid.uuid4().hex
+                    self._manifest_ref().set({
+                        'version': CHECKPOINT_VERSION,
+                        'config': self.config,
+                        'generation': self.generation,
+                        'expireAt': expireAt,
+                        'createdTimestamp': firestore.SERVER_TIMESTAMP,
+                    })
+
+            units_ref = self._manifest_ref().collection('units')
+            writes = []
+            for key, value in values.items():
+                unitId = self._unit_id(stage, key)
+                parts = encode_checkpoint(value)
+                unitGeneration = uuid.uuid4().hex
+                # Part 0 names the part count, so it is written last
+                for index in list(range(1, len(parts))) + [0]:
+                    writes.append((units_ref.document(unitId if index == 0 else f"{unitId}#{index}"), {
+                        'stage': stage,
+                        'generation': self.generation,
+                        'unitGeneration': unitGeneration,
+                        'part': index,
+                        'parts': len(parts),
+                        'data': parts[index],
+                        'expireAt': expireAt,
+                    }))
+            _commit_in_batches(writes)
+
+            with self._lock:
+                for key, value in values.items():
+                    self._units[self._unit_id(stage, key)] = value
+            return True
+        except Exception as e:
+            logging.error(f"Error saving {stage} checkpoints of investigation {self.investigationId}: {e}")
+            return False
+
+    def mark_completed(self):
+        """Retire the checkpoints once the run's output is written; they expire with the manifest."""
+        if self.generation is None:
+            return
+        try:
+            self._manifest_ref().update({'completed': True})
+        except Exception as e:
+            logging.error(f"Error completing checkpoints of investigation {self.investigationId}: {e}")
+
+
+def get_investigation_checkpoint(investigationId, config=None):
+    """Return the InvestigationCheckpoint of an investigation, or None when checkpoints are disabled."""
+    if not CHECKPOINTS_ENABLED or not investigationId:
+        return None
+    return InvestigationCheckpoint(investigationId, config=config)
+
+
 # %%
 
-def count_reviews_for_asins(asin_list):
+def count_reviews_for_asins(asin_list, use_cache=True):
     """
     Count the number of reviews for each ASIN in the given list.
 
     Parameters:
     - asin_list (list): List of ASINs to count reviews for.
+    - use_cache (bool): Set to False to bypass the read cache.
 
     Returns:
     - dict: Dictionary with ASINs as keys and the number of reviews as values.
     """
     review_count_dict = {}  # Initialize a dictionary to store the count of reviews for each ASIN
 
+    reviewStore = get_review_store()
+    if reviewStore is not None:
+        try:
+            return reviewStore.count_reviews_for_asins(asin_list)
+        except Exception as e:
+            logging.error(f"Error counting reviews in Postgres: {e}")
+            return {asin: 0 for asin in asin_list}
+
     for asin in asin_list:
+        if use_cache:
+            cachedCount = reviewCountCache.get(asin)
+            if cachedCount is None:
+                # Reuse cached reviews without counting a reviews-cache lookup in the stats
+                cachedReviews = reviewsCache.peek(asin)
+                cachedCount = len(cachedReviews) if cachedReviews is not None else None
+            if cachedCount is not None:
+                review_count_dict[asin] = cachedCount
+                continue
+
         try:
             # Query the Firestore to get the reviews collection for the given ASIN
             reviews_ref = db.collection('products').document(asin).collection('reviews')
@@ -426,6 +1249,7 @@ def count_reviews_for_asins(asin_list):
 
             # Store the count in the dictionary
             review_count_dict[asin] = review_count
+            reviewCountCache.set(asin, review_count)
 
         except Exception as e:
             logging.error(f"Error counting reviews for ASIN {asin}: {e}")
@@ -522,16 +1346,99 @@ def update_investigation_status(userId, investigationId,  newStatus):
     if not newStatus:
         raise ValueError("New status is required to update the investigation.")
 
-    investigation_ref = db.collection('investigations').document(userId).collection('investigationCollections').document(investigationId)
-    investigation = investigation_ref.get()
-    if investigation.exists:
-        investigation_ref.update({
-            'status': newStatus,
-            f'{newStatus}Timestamp': firestore.SERVER_TIMESTAMP,
-        })
+    return InvestigationStatusTracker(userId, investigationId).transition(newStatus)
+
+
+########### INVESTIGATION STATUS #############
+
+# Legal status transitions. 'finished', 'failed' and 'cancelled' investigations can be re-run from the reviews stage.
+INVESTIGATION_STATUS_TRANSITIONS = {
+    'started': {'startedReviews', 'finished', 'failed', 'cancelled'},
+    'startedReviews': {'finishedReviews', 'failed', 'cancelled'},
+    'finishedReviews': {'startedReviews', 'finished', 'failed', 'cancelled'},
+    'finished': {'startedReviews'},
+    'failed': {'startedReviews', 'failed'},
+    'cancelled': {'startedReviews'},
+}
+
+
+class InvestigationStatusTracker:
+    """
+    Applies investigation status transitions with one precondition-guarded write each.
+
+    The tracker remembers the status and update time of its own last write, so it can reject
+    illegal transitions and skip repeated ones without reading the document. The write is guarded
+    by the document's last update time (or by its existence for the first write of a tracker
+    that starts without one); if another writer got in between, the document is read once, the
+    transition is re-validated against the stored status and retried.
+
+    Args:
+    - userId (str): The ID of the user.
+    - investigationId (str): The ID of the investigation.
+    - status (str, optional): The status the investigation is known to be in, e.g. 'started'
+      right after start_investigation. None means unknown: the first transition is not validated.
+    - updateTime (optional): Update time of the document matching 'status'.
+    """
+
+    def __init__(self, userId, investigationId, status=None, updateTime=None):
+        self.userId = userId
+        self.investigationId = investigationId
+        self.status = status
+        self.updateTime = updateTime
+        self.investigation_ref = db.collection('investigations').document(userId).collection('investigationCollections').document(investigationId)
+
+    def is_allowed(self, newStatus):
+        return self.status is None or newStatus in INVESTIGATION_STATUS_TRANSITIONS.get(self.status, set())
+
+    def transition(self, newStatus, extraFields=None):
+        """
+        Move the investigation to newStatus.
+
+        Parameters:
+        - newStatus (str): Target status.
+        - extraFields (dict, optional): Other fields to write in the same update.
+
+        Returns:
+        - bool: True if the status was written or already was newStatus.
+
+        Raises:
+        - ValueError: If the transition is illegal or the investigation does not exist.
+        """
+        if newStatus == self.status and not extraFields:
+            return True
+        if newStatus != self.status and not self.is_allowed(newStatus):
+            raise ValueError(f"Illegal status transition for investigation {self.investigationId}: {self.status} -> {newStatus}")
+
+        fields = dict(extraFields or {})
+        if newStatus != self.status:
+            fields['status'] = newStatus
+            fields[f'{newStatus}Timestamp'] = firestore.SERVER_TIMESTAMP
+        self._write(fields, newStatus)
         return True
-    else:
-        raise ValueError(f"Investigation with ID {investigationId} does not exist.")
+
+    def update(self, fields):
+        """Write non-status fields to the investigation document, keeping the tracker's precondition current."""
+        self._write(dict(fields), self.status)
+
+    def _write(self, fields, newStatus):
+        option = db.write_option(last_update_time=self.updateTime) if self.updateTime is not None else None
+        try:
+            writeResult = self.investigation_ref.update(fields, option=option)
+        except NotFound:
+            raise ValueError(f"Investigation with ID {self.investigationId} does not exist.")
+        except FailedPrecondition:
+            # Someone else wrote the document since our last write: re-sync once and re-validate
+            investigation = self.investigation_ref.get()
+            if not investigation.exists:
+                raise ValueError(f"Investigation with ID {self.investigationId} does not exist.")
+            self.status = investigation.to_dict().get('status')
+            self.updateTime = investigation.update_time
+            if newStatus != self.status and not self.is_allowed(newStatus):
+                raise ValueError(f"Illegal status transition for investigation {self.investigationId}: {self.status} -> {newStatus}")
+            writeResult = self.investigation_ref.update(fields, option=db.write_option(last_update_time=self.updateTime))
+
+        self.status = newStatus
+        self.updateTime = writeResult.update_time
 
 # %%
 # ===========================
@@ -0,0 +1,85 @@
+#####################
+# function_schemas.py
+# Registry of the review prompts' function schemas and pre-serialised chat request payloads.
+#
+# export_functions_for_reviews() builds the schemas once per process; the registry names them and
+# hashes them into a schema version, which keys anything that stores model output produced with
+# them (the reviews checkpoints), so a schema change never reuses stale responses.
+# A RequestTemplate holds the JSON of everything in a chat completion request except the messages
+# (model, temperature, functions, function_call); render() only serialises the messages and
+# splices them in. get_request_template() keeps one template per registry schema and settings.
+import hashlib
+import json
+import threading
+from functools import lru_cache
+
+from rate_limiter import estimate_request_tokens
+from reviews_data_processing_utils import export_functions_for_reviews
+
+SCHEMA_NAMES = (
+    'market', 'extractJobs', 'marketResponseHeal', 'useCase', 'productComparison', 'featureRequest',
+    'painPoints', 'usageFrequency', 'usageTime', 'usageLocation', 'customerDemographics',
+    'functionalJob', 'socialJob', 'emotionalJob', 'supportingJob',
+)
+
+
+@lru_cache(maxsize=None)
+def get_function_schemas():
+    """Name (SCHEMA_NAMES) to the functions list of that prompt. Shared: treat as read-only."""
+    return dict(zip(SCHEMA_NAMES, export_functions_for_reviews()))
+
+
+@lru_cache(maxsize=None)
+def get_schema_version():
+    """Short hash of every function schema; changes whenever any schema does."""
+    canonical = json.dumps(get_function_schemas(), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+
+
+class RequestTemplate:
+    """
+    The static part of a chat completion request, serialised once.
+
+    Args:
+    - model (str): The model.
+    - temperature (float): The sampling temperature.
+    - functions (list, optional): Function schemas.
+    - function_call (dict, optional): The forced function call.
+    """
+
+    def __init__(self, model, temperature, functions=None, function_call=None):
+        static = {"model": model, "temperature": temperature}
+        if functions is not None:
+            static["functions"] = functions
+        if function_call is not None:
+            static["function_call"] = function_call
+        # '{"model": ..., "function_call": {...}' followed by ', "messages": [...]}' on each render
+        self._prefix = json.dumps(static)[:-1] + ', "messages": '
+        self._functionsCharacters = len(json.dumps(functions, default=str)) if functions is not None else None
+
+    def render(self, messages):
+        """The request body (UTF-8 JSON bytes) for messages."""
+        return (self._prefix + json.dumps(messages) + '}').encode('utf-8')
+
+    def estimate_tokens(self, messages):
+        """estimate_request_tokens() of the request, without serialising the functions again."""
+        return estimate_request_tokens(messages, functions_characters=self._functionsCharacters)
+
+
+_templates = {}
+_templatesLock = threading.Lock()
+
+
+def get_request_template(model, temperature, functions=None, function_call=None):
+    """
+    The RequestTemplate of these settings. Templates of registry schemas (and of requests without
+    functions) are built once and kept; other functions lists get a new template on every call.
+    """
+    if functions is not None and not any(functions is schema for schema in get_function_schemas().values()):
+        return RequestTemplate(model, temperature, functions, function_call)
+    key = (model, temperature, id(functions), json.dumps(function_call, sort_keys=True))
+    template = _templates.get(key)
+    if template is None:
+        with _templatesLock:
+            template = _templates.setdefault(key, RequestTemplate(model, temperature, functions, function_call))
+    return template
@@ -0,0 +1,252 @@
+#####################
+# job_queue.py
+# Background execution of end-to-end investigations.
+#
+# The API enqueues a job and returns immediately; a bounded thread pool runs the jobs. Job records
+# live in the 'investigationJobs' collection with a lease that the owning process renews while the
+# job is queued or running. When a process dies, its leases expire and recover_jobs() (run at
+# startup and again on every heartbeat of every process) claims the jobs with a
+# precondition-guarded write and runs them again.
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core.exceptions import FailedPrecondition
+from firebase_admin import firestore
+
+from firebase_utils import FirestoreClient, InvestigationStatusTracker
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_MAX_QUEUE_DEPTH = int(os.getenv('JOB_MAX_QUEUE_DEPTH', 20))
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', 120))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+
+ACTIVE_JOB_STATUSES = ('queued', 'running')
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class InvestigationJobQueue:
+    """
+    Bounded worker pool for investigation jobs.
+
+    Args:
+    - runner (callable): Called as runner(job, should_cancel) in a worker thread. should_cancel()
+      returns True once the job was cancelled; the runner checks it between stages and raises
+      JobCancelled (or returns) to stop early. A falsy return value marks the job as failed.
+    - max_workers (int): Number of jobs running at the same time in this process.
+    - max_queue_depth (int): Number of jobs allowed to wait for a worker.
+    - lease_seconds (float): How long a job stays claimed without a heartbeat.
+    """
+
+    def __init__(self, runner, max_workers=JOB_WORKERS, max_queue_depth=JOB_MAX_QUEUE_DEPTH, lease_seconds=JOB_LEASE_SECONDS):
+        self.runner = runner
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='investigation-job')
+        self._lock = threading.Lock()
+        self._jobs = {}  # jobId -> {'future', 'cancelEvent', 'running', 'payload'}
+        self._stopEvent = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew_leases, name='investigation-job-heartbeat', daemon=True)
+        self._heartbeat.start()
+
+    @property
+    def db(self):
+        return FirestoreClient.get_instance()
+
+    def _job_ref(self, jobId):
+        return self.db.collection('investigationJobs').document(jobId)
+
+    def queue_depth(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job['running'])
+
+    def is_full(self):
+        return self.queue_depth() >= self.max_queue_depth
+
+    def submit(self, jobId, payload):
+        """
+        Persist and enqueue a job.
+
+        Parameters:
+        - jobId (str): Job id (the investigation id).
+        - payload (dict): Everything the runner needs (userId, investigationId, asinList, ...).
+
+        Returns:
+        - dict: The job record.
+
+        Raises:
+        - QueueFullError: If max_queue_depth jobs are already waiting.
+        """
+        if self.is_full():
+            raise QueueFullError(f"{self.max_queue_depth} investigation jobs are already queued")
+
+        job = {
+            'id': jobId,
+            'payload': payload,
+            'status': 'queued',
+            'owner': self.owner,
+            'leaseExpiresAt': time.time() + self.lease_seconds,
+            'attempts': 0,
+            'cancelRequested': False,
+            'error': None,
+            'queuedTimestamp': firestore.SERVER_TIMESTAMP,
+        }
+        self._job_ref(jobId).set(job)
+        self._enqueue(jobId, payload)
+        return {key: value for key, value in job.items() if key != 'queuedTimestamp'}
+
+    def _enqueue(self, jobId, payload):
+        cancelEvent = threading.Event()
+        with self._lock:
+            self._jobs[jobId] = {'cancelEvent': cancelEvent, 'running': False, 'future': None, 'payload': payload}
+            self._jobs[jobId]['future'] = self._executor.submit(self._execute, jobId, payload, cancelEvent)
+
+    def _execute(self, jobId, payload, cancelEvent):
+        job_ref = self._job_ref(jobId)
+        with self._lock:
+            self._jobs[jobId]['running'] = True
+
+        try:
+            if cancelEvent.is_set():
+                self._mark_investigation_cancelled(payload)
+                raise JobCancelled()
+            job_ref.update({
+                'status': 'running',
+                'owner': self.owner,
+                'leaseExpiresAt': time.time() + self.lease_seconds,
+                'attempts': firestore.Increment(1),
+                'startedTimestamp': firestore.SERVER_TIMESTAMP,
+            })
+            result = self.runner(dict(payload, jobId=jobId), cancelEvent.is_set)
+            # The runner raises JobCancelled when it stops early; a cancel request that came in after
+            # its last stage does not change the outcome of a run that finished
+            status, error = ('succeeded', None) if result else ('failed', 'Investigation run returned no result')
+        except JobCancelled:
+            status, error = 'cancelled', None
+        except Exception as e:
+            logging.error(f"Investigation job {jobId} failed: {e}", exc_info=True)
+            status, error = 'failed', str(e)
+        finally:
+            with self._lock:
+                self._jobs.pop(jobId, None)
+
+        try:
+            job_ref.update({'status': status, 'error': error, 'finishedTimestamp': firestore.SERVER_TIMESTAMP})
+        except Exception as e:
+            logging.error(f"Error recording the outcome of investigation job {jobId}: {e}")
+        logging.info(f"Investigation job {jobId} {status}")
+
+    def _mark_investigation_cancelled(self, payload):
+        """Move the investigation of a job that never ran (or will not run again) to 'cancelled'."""
+        try:
+            InvestigationStatusTracker(payload['userId'], payload['investigationId']).transition('cancelled')
+        except Exception as e:
+            logging.error(f"Error marking investigation {payload.get('investigationId')} as cancelled: {e}")
+
+    def cancel(self, jobId):
+        """
+        Cancel a job. Queued jobs never start; running jobs stop at the next stage boundary.
+
+        Returns:
+        - bool: True if the job was active and is now cancelled or cancelling.
+        """
+        with self._lock:
+            localJob = self._jobs.get(jobId)
+        if localJob is not None:
+            localJob['cancelEvent'].set()
+            if localJob['future'] is not None and localJob['future'].cancel():
+                with self._lock:
+                    self._jobs.pop(jobId, None)
+                self._job_ref(jobId).update({'status': 'cancelled', 'cancelRequested': True, 'finishedTimestamp': firestore.SERVER_TIMESTAMP})
+                self._mark_investigation_cancelled(localJob['payload'])
+                return True
+
+        job = self._job_ref(jobId).get()
+        if not job.exists or job.get('status') not in ACTIVE_JOB_STATUSES:
+            return False
+        # Running here or in another process: the owner's heartbeat picks the flag up
+        self._job_ref(jobId).update({'cancelRequested': True})
+        return True
+
+    def get_job(self, jobId):
+        job = self._job_ref(jobId).get()
+        if not job.exists:
+            return None
+        data = job.to_dict()
+        data.pop('payload', None)
+        return data
+
+    def _renew_leases(self):
+        interval = max(1.0, self.lease_seconds / 3)
+        while not self._stopEvent.wait(interval):
+            with self._lock:
+                activeJobs = dict(self._jobs)
+            for jobId, localJob in activeJobs.items():
+                try:
+                    job_ref = self._job_ref(jobId)
+                    job_ref.update({'leaseExpiresAt': time.time() + self.lease_seconds})
+                    if job_ref.get().get('cancelRequested'):
+                        localJob['cancelEvent'].set()
+                except Exception as e:
+                    logging.error(f"Error renewing the lease of investigation job {jobId}: {e}")
+            # Jobs of a process that died while their lease was still valid (or that a full queue
+            # left behind) are claimed by a later scan, not only the one at startup
+            try:
+                recovered = self.recover_jobs()
+                if recovered:
+                    logging.info(f"Recovered {len(recovered)} investigation jobs: {recovered}")
+            except Exception as e:
+                logging.error(f"Error recovering investigation jobs: {e}")
+
+    def recover_jobs(self):
+        """
+        Claim queued/running jobs whose lease expired (their process died) and run them again. Run
+        at startup and on every heartbeat; a scan that finds the queue full leaves the rest to the next.
+
+        Returns:
+        - list: Ids of the recovered jobs.
+        """
+        recovered = []
+        now = time.time()
+        for status in ACTIVE_JOB_STATUSES:
+            for job in self.db.collection('investigationJobs').where('status', '==', status).stream():
+                data = job.to_dict()
+                with self._lock:
+                    tracked = job.id in self._jobs
+                if data.get('leaseExpiresAt', 0) > now or tracked:
+                    continue
+                if data.get('attempts', 0) >= JOB_MAX_ATTEMPTS or data.get('cancelRequested'):
+                    self._job_ref(job.id).update({'status': 'failed' if not data.get('cancelRequested') else 'cancelled', 'finishedTimestamp': firestore.SERVER_TIMESTAMP})
+                    if data.get('cancelRequested'):
+                        self._mark_investigation_cancelled(data['payload'])
+                    continue
+                if self.is_full():
+                    return recovered
+                try:
+                    # Only one process wins the claim; the others see the document changed
+                    self._job_ref(job.id).update(
+                        {'status': 'queued', 'owner': self.owner, 'leaseExpiresAt': time.time() + self.lease_seconds},
+                        option=self.db.write_option(last_update_time=job.update_time),
+                    )
+                except FailedPrecondition:
+                    continue
+                logging.info(f"Recovered investigation job {job.id} from {data.get('owner')}")
+                self._enqueue(job.id, data['payload'])
+                recovered.append(job.id)
+        return recovered
+
+    def shutdown(self, wait=False):
+        self._stopEvent.set()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,284 @@
+#####################
+# label_consolidation.py
+# Local consolidation of a category's extraction labels (the embedding engine of the aggregation).
+#
+# Every extraction batch labels its own reviews, so a category collects many labels meaning the
+# same thing. Instead of sending them all through the model to be merged, the labels are embedded
+# (openai_utils.get_embeddings(), batched and cached), and grouped by agglomerative clustering
+# (average linkage) on their cosine distances: labels closer than CONSOLIDATION_SIMILARITY end up
+# together, and the groups are merged further down to CONSOLIDATION_MAX_LABELS. Each group gets
+# the union of its labels' uid lists. The model is only asked to name the groups, in one call per
+# category that sees a few member labels of each group, not their uids. A group the model does
+# not name keeps the header of its most central label.
+#
+# The offline path needs no network: labels become TF-IDF vectors of their character n-grams,
+# labels whose sparse cosine similarity reaches LOCAL_CONSOLIDATION_SIMILARITY are linked, and the
+# connected components (merged down to CONSOLIDATION_MAX_LABELS) are the groups, each named by its
+# most central label. It serves quick or offline runs, and labels that cannot be embedded.
+import asyncio
+import logging
+import os
+
+from aggregation_tree import function_call_response, parse_labels
+
+CONSOLIDATION_SIMILARITY = float(os.getenv('CONSOLIDATION_SIMILARITY', 0.6))
+CONSOLIDATION_MAX_LABELS = 10
+# Labels clustered at most (the distance matrix is labels squared); larger categories fall back to the model
+CONSOLIDATION_MAX_ITEMS = int(os.getenv('CONSOLIDATION_MAX_ITEMS', 5000))
+# Member labels of a group shown to the model when it is named
+NAMING_SAMPLE_LABELS = 6
+# Character n-gram cosine similarity at which the local (offline) path links two labels
+LOCAL_CONSOLIDATION_SIMILARITY = float(os.getenv('LOCAL_CONSOLIDATION_SIMILARITY', 0.65))
+LOCAL_SIMILARITY_BLOCK_ROWS = 1024
+
+
+def label_text(label):
+    """The text of a label: its fields other than 'uid', joined."""
+    return ' '.join(str(value) for field, value in label.items() if field != 'uid' and value not in (None, '')).strip()
+
+
+def merge_identical_labels(observations):
+    """
+    Labels with the same text (ignoring case and spacing) merged into one, with the union of their
+    uid lists; labels without uids or text are dropped.
+
+    Returns:
+    - list: The merged labels, in order of first appearance.
+    - list: Their texts.
+    """
+    labels = {}
+    for observation in observations:
+        if not isinstance(observation, dict) or not isinstance(observation.get('uid'), list) or not observation['uid']:
+            continue
+        text = label_text(observation)
+        if not text:
+            continue
+        key = ' '.join(text.lower().split())
+        if key not in labels:
+            labels[key] = (dict(observation, uid=[]), text, set())
+        label, _, seen = labels[key]
+        for uid in observation['uid']:
+            if uid not in seen:
+                seen.add(uid)
+                label['uid'].append(uid)
+    return [label for label, _, _ in labels.values()], [text for _, text, _ in labels.values()]
+
+
+def normalize_rows(vectors):
+    """Rows scaled to unit length (a sparse matrix from a TF-IDF vectoriser already is)."""
+    import numpy as np
+    if hasattr(vectors, 'tocsr'):
+        return vectors.tocsr()
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def renumber(assignments):
+    """Cluster numbers from 0 in order of first row, so that results do not depend on sklearn's or scipy's numbering."""
+    import numpy as np
+    _, first, inverse = np.unique(assignments, return_index=True, return_inverse=True)
+    return np.argsort(np.argsort(first))[inverse]
+
+
+def cluster_embeddings(embeddings, similarity=None, maxClusters=None):
+    """
+    Agglomerative clustering (average linkage) of embeddings on their cosine distances.
+
+    Parameters:
+    - embeddings (numpy.ndarray): One row per label.
+    - similarity (float, optional): Cosine similarity above which labels are grouped (CONSOLIDATION_SIMILARITY).
+    - maxClusters (int, optional): Most clusters returned (CONSOLIDATION_MAX_LABELS).
+
+    Returns:
+    - numpy.ndarray: The cluster of each row, numbered from 0 in order of first row.
+    """
+    import numpy as np
+    from sklearn.cluster import AgglomerativeClustering
+    similarity = CONSOLIDATION_SIMILARITY if similarity is None else similarity
+    maxClusters = maxClusters or CONSOLIDATION_MAX_LABELS
+    count = len(embeddings)
+    if count < 2:
+        return np.zeros(count, dtype=np.int64)
+    vectors = normalize_rows(embeddings)
+    distances = np.clip(1.0 - vectors @ vectors.T, 0.0, 2.0)
+    np.fill_diagonal(distances, 0.0)
+    assignments = AgglomerativeClustering(n_clusters=None, metric='precomputed', linkage='average', distance_threshold=1.0 - similarity).fit_predict(distances)
+    if assignments.max() + 1 > maxClusters:
+        assignments = AgglomerativeClustering(n_clusters=maxClusters, metric='precomputed', linkage='average').fit_predict(distances)
+    return renumber(assignments)
+
+
+def local_label_vectors(texts):
+    """TF-IDF vectors of the character n-grams (3 to 5, within words) of texts: a sparse matrix with unit rows."""
+    import numpy as np
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    return TfidfVectorizer(analyzer='char_wb', ngram_range=(3, 5), sublinear_tf=True, dtype=np.float32).fit_transform(texts)
+
+
+def cluster_locally(vectors, similarity=None, maxClusters=None):
+    """
+    Connected components of the graph linking rows of a sparse matrix with unit rows whose cosine
+    similarity is at least similarity (LOCAL_CONSOLIDATION_SIMILARITY). The similarities are computed
+    LOCAL_SIMILARITY_BLOCK_ROWS rows at a time, keeping only the links. Over maxClusters
+    (CONSOLIDATION_MAX_LABELS) components, the components are merged by agglomerative clustering
+    (average linkage) on the cosine distances of their mean vectors.
+
+    Returns:
+    - numpy.ndarray: The cluster of each row, numbered from 0 in order of first row.
+    """
+    import numpy as np
+    from scipy.sparse import csr_matrix, vstack
+    from scipy.sparse.csgraph import connected_components
+    from sklearn.cluster import AgglomerativeClustering
+    similarity = LOCAL_CONSOLIDATION_SIMILARITY if similarity is None else similarity
+    maxClusters = maxClusters or CONSOLIDATION_MAX_LABELS
+    count = vectors.shape[0]
+    if count < 2:
+        return np.zeros(count, dtype=np.int64)
+    links = []
+    for start in range(0, count, LOCAL_SIMILARITY_BLOCK_ROWS):
+        block = (vectors[start:start + LOCAL_SIMILARITY_BLOCK_ROWS] @ vectors.T).tocsr()
+        block.data[block.data < similarity] = 0
+        block.eliminate_zeros()
+        links.append(block)
+    components, assignments = connected_components(vstack(links).tocsr(), directed=False)
+    if components > maxClusters:
+        membership = csr_matrix((np.ones(count, dtype=np.float32), (assignments, np.arange(count))), shape=(components, count))
+        centroids = membership @ vectors
+        similarities = (centroids @ centroids.T).toarray()
+        norms = np.sqrt(np.maximum(np.diag(similarities), 1e-12))
+        distances = np.clip(1.0 - similarities / np.outer(norms, norms), 0.0, 2.0)
+        np.fill_diagonal(distances, 0.0)
+        assignments = AgglomerativeClustering(n_clusters=maxClusters, metric='precomputed', linkage='average').fit_predict(distances)[assignments]
+    return renumber(assignments)
+
+
+def merge_clusters(labels, assignments, vectors):
+    """
+    The groups of clustered labels, largest first.
+
+    Parameters:
+    - labels (list): The labels.
+    - assignments (numpy.ndarray): The cluster of each label.
+    - vectors: The labels' vectors, dense or sparse, with unit rows (normalize_rows()).
+
+    Returns:
+    - list: Dicts with 'uid' (the union of the labels' uid lists), 'members' (the labels, most
+      uids first) and 'central' (the label closest to the group's mean vector).
+    """
+    import numpy as np
+    groups = []
+    for cluster in range(int(assignments.max()) + 1 if len(assignments) else 0):
+        rows = np.flatnonzero(assignments == cluster)
+        uids = []
+        seen = set()
+        for row in rows:
+            for uid in labels[row]['uid']:
+                if uid not in seen:
+                    seen.add(uid)
+                    uids.append(uid)
+        centrality = vectors[rows] @ np.asarray(vectors[rows].mean(axis=0)).ravel()
+        central = rows[int(np.argmax(centrality))]
+        groups.append({'uid': uids, 'members': sorted((labels[row] for row in rows), key=lambda label: -len(label['uid'])), 'central': labels[central]})
+    groups.sort(key=lambda group: -len(group['uid']))
+    return groups
+
+
+def naming_content(key, groups):
+    """The prompt asking for one header per group; each group is shown as a few of its labels with the group id as its uid."""
+    items = [{'labels': [label_text(label) for label in group['members'][:NAMING_SAMPLE_LABELS]], 'uid': [index]} for index, group in enumerate(groups)]
+    return [
+        {"role": "user", "content": f"You are the most awesome product researcher. Please process the results for key: {key}. Each observation below is a group of similar labels; its uid is the id of the group, not of a review. Do not merge or split the groups: write one header for each group that summarises its labels, and return it with the id of the group.  \n Groups are here: {items}"}
+    ]
+
+
+def named_labels(key, groups, response):
+    """The final labels: each group with the header the model gave it, or its central label's fields, and its uids."""
+    names = {}
+    for label in (parse_labels(response, key) or []) if response is not None else []:
+        if not isinstance(label, dict):
+            continue
+        fields = {field: value for field, value in label.items() if field != 'uid'}
+        for reference in label.get('uid') or []:
+            if fields and isinstance(reference, (int, float)) and reference == int(reference) and 0 <= reference < len(groups):
+                names.setdefault(int(reference), fields)
+    labels = []
+    for index, group in enumerate(groups):
+        fields = names.get(index) or {field: value for field, value in group['central'].items() if field != 'uid'}
+        labels.append(dict(fields, uid=group['uid']))
+    return labels
+
+
+async def consolidate_labels(key, observations, embed, complete, functionName):
+    """
+    Consolidate a category's extraction labels locally and have the model name the groups. Labels
+    that cannot be embedded (e.g. while the embedding API is throttled) are grouped by the offline
+    path of cluster_locally() instead.
+
+    Parameters:
+    - key (str): The category.
+    - observations (list): Label dicts with a 'uid' list of review uids.
+    - embed (callable): Coroutine function taking a list of texts and returning their embeddings
+      (a matrix, one row per text), or None on failure.
+    - complete (callable): Coroutine function taking the messages of one call and returning its
+      response (None on failure).
+    - functionName (str): Function name of the returned response.
+
+    Returns:
+    - dict: A function call response with the category's final labels.
+    - None: If the labels are over CONSOLIDATION_MAX_ITEMS or could not be grouped (the caller
+      then aggregates them with the model).
+    """
+    try:
+        labels, texts = merge_identical_labels(observations)
+        if not labels:
+            return function_call_response(functionName, key, [])
+        if len(labels) > CONSOLIDATION_MAX_ITEMS:
+            logging.info(f"{key} has {len(labels)} distinct labels, over CONSOLIDATION_MAX_ITEMS.")
+            return None
+        embeddings = await embed(texts)
+        # The clustering is CPU-bound: run it off the shared event loop
+        if embeddings is not None and len(embeddings) == len(labels):
+            vectors = normalize_rows(embeddings)
+            assignments = await asyncio.to_thread(cluster_embeddings, vectors)
+        else:
+            logging.warning(f"Error embedding the labels of {key}, grouping them offline.")
+            vectors = await asyncio.to_thread(local_label_vectors, texts)
+            assignments = await asyncio.to_thread(cluster_locally, vectors)
+        groups = await asyncio.to_thread(merge_clusters, labels, assignments, vectors)
+        response = await complete(naming_content(key, groups))
+        return function_call_response(functionName, key, named_labels(key, groups, response))
+    except Exception as e:
+        logging.error(f"Error consolidating the labels of {key}: {e}")
+        return None
+
+
+def consolidate_labels_offline(key, observations, functionName, similarity=None):
+    """
+    Consolidate a category's extraction labels on the CPU alone: character n-gram TF-IDF vectors,
+    grouped by cluster_locally(), each group named by its most central label. No network calls.
+
+    Parameters:
+    - key (str): The category.
+    - observations (list): Label dicts with a 'uid' list of review uids (a category of
+      aggregate_all_categories() output).
+    - functionName (str): Function name of the returned response.
+    - similarity (float, optional): LOCAL_CONSOLIDATION_SIMILARITY.
+
+    Returns:
+    - dict: A function call response with the category's final labels.
+    - None: If the labels are over CONSOLIDATION_MAX_ITEMS or could not be grouped.
+    """
+    try:
+        labels, texts = merge_identical_labels(observations)
+        if not labels:
+            return function_call_response(functionName, key, [])
+        if len(labels) > CONSOLIDATION_MAX_ITEMS:
+            logging.info(f"{key} has {len(labels)} distinct labels, over CONSOLIDATION_MAX_ITEMS.")
+            return None
+        vectors = local_label_vectors(texts)
+        groups = merge_clusters(labels, cluster_locally(vectors, similarity), vectors)
+        return function_call_response(functionName, key, named_labels(key, groups, None))
+    except Exception as e:
+        logging.error(f"Error consolidating the labels of {key} offline: {e}")
+        return None
@@ -0,0 +1,223 @@
+#####################
+# llm_scheduler.py
+# Fair sharing of LLM capacity between investigations.
+#
+# Every OpenAI completion waits for a slot from the process-wide FairShareScheduler. Requests are
+# queued per tenant (an investigation) and slots are handed out by deficit round-robin: on its turn a
+# tenant's deficit grows by QUANTUM x the weight of its priority class, and it is served while the
+# deficit covers the estimated token cost of its next request. A 5k-review investigation therefore
+# cannot starve a small one that starts after it, and paid tiers get a larger share.
+# The scheduler lives on the background event loop (event_loop.py); the tenant of the requests a
+# coroutine makes is set with run_as_tenant().
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+PRIORITY_WEIGHTS = {
+    'paid': 4.0,
+    'standard': 1.0,
+    'background': 0.25,
+}
+DEFAULT_PRIORITY = 'standard'
+
+LLM_SCHEDULER_CONCURRENCY = int(os.getenv('LLM_SCHEDULER_CONCURRENCY', os.getenv('OPENAI_MAX_CONCURRENCY', 12)))
+LLM_SCHEDULER_QUANTUM = float(os.getenv('LLM_SCHEDULER_QUANTUM', 4000))  # Estimated tokens per round at weight 1
+WAIT_SAMPLES_PER_TENANT = 1000
+MAX_TENANTS_IN_STATS = 500
+
+currentTenant = contextvars.ContextVar('llmTenant', default=None)
+
+
+def normalize_priority(priority):
+    """Return priority if it is a known class, else the default class."""
+    return priority if priority in PRIORITY_WEIGHTS else DEFAULT_PRIORITY
+
+
+async def run_as_tenant(coro, tenantId, userId=None, priority=DEFAULT_PRIORITY):
+    """
+    Await coro with every LLM request it makes (including those of tasks it gathers) queued under tenantId.
+    Pass the coroutine before it starts: tasks created earlier, e.g. by asyncio.gather(), keep their own tenant.
+
+    Parameters:
+    - coro (coroutine): The work to run.
+    - tenantId (str): Queue the requests belong to, usually the investigation id.
+    - userId (str, optional): Reported in the stats.
+    - priority (str): One of PRIORITY_WEIGHTS.
+    """
+    token = currentTenant.set({'tenantId': tenantId, 'userId': userId, 'priority': normalize_priority(priority)})
+    try:
+        return await coro
+    finally:
+        currentTenant.reset(token)
+
+
+class _Waiter:
+    __slots__ = ('future', 'cost', 'enqueuedAt')
+
+    def __init__(self, future, cost):
+        self.future = future
+        self.cost = cost
+        self.enqueuedAt = time.monotonic()
+
+
+class FairShareScheduler:
+    """
+    Deficit round-robin over per-tenant queues in front of a fixed number of slots.
+
+    Args:
+    - capacity (int): Requests of this process in flight at once.
+    - quantum (float): Cost (estimated tokens) a weight-1 tenant may spend per round.
+    """
+
+    def __init__(self, capacity=LLM_SCHEDULER_CONCURRENCY, quantum=LLM_SCHEDULER_QUANTUM):
+        self.capacity = capacity
+        self.quantum = quantum
+        self.inFlight = 0
+        self._queues = {}  # tenantId -> deque of _Waiter
+        self._tenants = {}  # tenantId -> {'userId', 'priority'}
+        self._deficits = {}
+        self._active = deque()  # Round-robin order of tenants with queued requests
+        self._turnStarted = False
+        self._statsLock = threading.Lock()
+        self._stats = {}
+
+    @asynccontextmanager
+    async def slot(self, cost=1):
+        """Wait for a slot in the current tenant's turn and hold it until exit."""
+        tenant = currentTenant.get() or {'tenantId': 'default', 'userId': None, 'priority': DEFAULT_PRIORITY}
+        waiter = self._enqueue(tenant, max(1.0, float(cost)))
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release()  # Granted just before the cancellation arrived
+            else:
+                self._remove(tenant['tenantId'], waiter)
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _enqueue(self, tenant, cost):
+        tenantId = tenant['tenantId']
+        self._tenants[tenantId] = tenant
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), cost)
+        if tenantId not in self._queues:
+            self._queues[tenantId] = deque()
+            self._deficits[tenantId] = 0.0
+            self._active.append(tenantId)
+        self._queues[tenantId].append(waiter)
+        self._dispatch()
+        return waiter
+
+    def _remove(self, tenantId, waiter):
+        queue = self._queues.get(tenantId)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return
+        if not queue:
+            self._drop_tenant(tenantId)
+        self._dispatch()
+
+    def _drop_tenant(self, tenantId):
+        if self._active and self._active[0] == tenantId:
+            self._turnStarted = False
+        self._active.remove(tenantId)
+        del self._queues[tenantId]
+        del self._deficits[tenantId]
+        del self._tenants[tenantId]
+
+    def _release(self):
+        self.inFlight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.inFlight < self.capacity and self._active:
+            tenantId = self._active[0]
+            queue = self._queues[tenantId]
+            if not self._turnStarted:
+                weight = PRIORITY_WEIGHTS[self._tenants[tenantId]['priority']]
+                self._deficits[tenantId] += self.quantum * weight
+                self._turnStarted = True
+
+            waiter = queue[0]
+            if self._deficits[tenantId] < waiter.cost:
+                # Turn over: the unspent deficit carries to the tenant's next turn
+                self._active.rotate(-1)
+                self._turnStarted = False
+                continue
+
+            queue.popleft()
+            self._deficits[tenantId] -= waiter.cost
+            tenant = self._tenants[tenantId]
+            if not queue:
+                self._drop_tenant(tenantId)
+            if waiter.future.cancelled():
+                continue
+            self.inFlight += 1
+            waiter.future.set_result(None)
+            self._record_wait(tenantId, tenant, time.monotonic() - waiter.enqueuedAt)
+
+    def _record_wait(self, tenantId, tenant, waitSeconds):
+        with self._statsLock:
+            if tenantId not in self._stats and len(self._stats) >= MAX_TENANTS_IN_STATS:
+                del self._stats[next(iter(self._stats))]
+            stats = self._stats.setdefault(tenantId, {
+                'userId': tenant['userId'],
+                'priority': tenant['priority'],
+                'granted': 0,
+                'totalWaitSeconds': 0.0,
+                'maxWaitSeconds': 0.0,
+                'samples': deque(maxlen=WAIT_SAMPLES_PER_TENANT),
+            })
+            stats['granted'] += 1
+            stats['totalWaitSeconds'] += waitSeconds
+            stats['maxWaitSeconds'] = max(stats['maxWaitSeconds'], waitSeconds)
+            stats['samples'].append(waitSeconds)
+
+    def stats(self):
+        """
+        Per-tenant wait times of this process.
+
+        Returns:
+        - dict: capacity, inFlight, queued and, per tenant, userId, priority, granted, queued and
+          mean/p95/max wait in seconds.
+        """
+        queued = {tenantId: len(queue) for tenantId, queue in list(self._queues.items())}
+        tenants = {}
+        with self._statsLock:
+            for tenantId, stats in self._stats.items():
+                samples = sorted(stats['samples'])
+                tenants[tenantId] = {
+                    'userId': stats['userId'],
+                    'priority': stats['priority'],
+                    'granted': stats['granted'],
+                    'queued': queued.get(tenantId, 0),
+                    'meanWaitSeconds': round(stats['totalWaitSeconds'] / stats['granted'], 4),
+                    'p95WaitSeconds': round(samples[int(0.95 * (len(samples) - 1))], 4) if samples else 0.0,
+                    'maxWaitSeconds': round(stats['maxWaitSeconds'], 4),
+                }
+        return {'capacity': self.capacity, 'inFlight': self.inFlight, 'queued': sum(queued.values()), 'tenants': tenants}
+
+
+_scheduler = None
+_schedulerLock = threading.Lock()
+
+
+def get_llm_scheduler():
+    """Return the process-wide FairShareScheduler."""
+    global _scheduler
+    with _schedulerLock:
+        if _scheduler is None:
+            _scheduler = FairShareScheduler()
+            logging.info(f"LLM scheduler started with {_scheduler.capacity} slots")
+        return _scheduler
@@ -3,12 +3,14 @@
 # %%
 from flask import jsonify, request
 import logging
+import os
+import threading
 import time
 logging.basicConfig(level=logging.INFO)
 
 
 try:
-    from firebase_utils import FirestoreClient, PubSubClient, GAEClient, start_investigation
+    from firebase_utils import FirestoreClient, start_investigation, get_read_cache_stats, get_investigation, InvestigationStatusTracker
 except ImportError as e:
     logging.error(f"import error is {e}")
 
@@ -18,29 +20,66 @@ except ImportError as e:
     logging.error(f"import  error is {e}")
 
 try:
-    from run_investigation import run_end_to_end_investigation, ensure_event_loop
+    from run_investigation import run_end_to_end_investigation, enqueue_end_to_end_investigation, get_investigation_job_queue
 except ImportError as e:
     logging.error(f"import error is {e}")
 
 try:
     from reviews_processing import run_reviews_investigation
+    from review_sampling import normalize_sampling
 except ImportError as e:
     logging.error(f"import error is {e}")
 
 try:
-    db = FirestoreClient.get_instance()
-except Exception as e:
-    logging.error(f"Error initializing Firestore: {e}")
+    from llm_scheduler import get_llm_scheduler
+    from users import get_user_priority
+    from profiler import run_profiled
+except ImportError as e:
+    logging.error(f"import error is {e}")
 
 try:
-    publisher, subscriber, project_id, topic_id, subscription_id, topic_path, subscription_path = PubSubClient.get_instance()
-except Exception as e:
-    logging.error(f"Error initializing Pub/Sub: {e}")
+    from openai_utils import get_openai_headers
+    from reviews_data_processing_utils import get_tokenizer
+except ImportError as e:
+    logging.error(f"import error is {e}")
 
-try:
-    GAEClient.get_instance()
-except Exception as e:
-    logging.error(f"Error initializing GAE: {e}")
+from job_queue import QueueFullError
+
+
+# %%
+########### CLIENT WARM-UP #############
+
+# Clients are created lazily on first use. CLIENT_WARMUP decides whether they are also created ahead
+# of the first request: 'background' (default) warms them in a thread after boot, 'sync' at import
+# (the old behaviour, the worker only serves once they are ready), 'off' leaves it to the first request.
+CLIENT_WARMUP = os.getenv('CLIENT_WARMUP', 'background').lower()
+clientWarmupDone = threading.Event()
+
+
+def warm_up_clients():
+    """
+    Create the Firestore client, look up the OpenAI key, start the job queue (which recovers jobs
+    orphaned by a previous process) and load the tokenizer. Failures are logged; first use retries them.
+    """
+    startTime = time.time()
+    for name, provider in (
+        ('Firestore', lambda: FirestoreClient.get_instance()),
+        ('OpenAI key', lambda: get_openai_headers()),
+        ('investigation job queue', lambda: get_investigation_job_queue()),
+        ('tokenizer', lambda: get_tokenizer()),
+    ):
+        try:
+            provider()
+        except Exception as e:
+            logging.error(f"Error warming up {name}: {e}")
+    clientWarmupDone.set()
+    logging.info(f"Client warm-up took {time.time() - startTime} seconds")
+
+
+if CLIENT_WARMUP == 'sync':
+    warm_up_clients()
+elif CLIENT_WARMUP == 'background':
+    threading.Thread(target=warm_up_clients, name='client-warmup', daemon=True).start()
 
 
 # %%
@@ -181,7 +220,8 @@ def api_run_reviews_investigation():
 
     try:
         logging.info(f"Starting reviews investigation for ID: {investigationId}")
-        run_reviews_investigation(userId, investigationId)
+        statusTracker = InvestigationStatusTracker(userId, investigationId)
+        run_profiled(investigationId, statusTracker, run_reviews_investigation, userId, investigationId, statusTracker=statusTracker, priority=get_user_priority(userId), sampling=normalize_sampling(data.get('sampling')))
         logging.info(f"Completed reviews investigation for ID: {investigationId}")
         return jsonify({"message": "Reviews investigation completed successfully"}), 200
     except Exception as e:
@@ -190,14 +230,11 @@ def api_run_reviews_investigation():
 
 
 
-from run_investigation import run_end_to_end_investigation, ensure_event_loop  # Ensure this is correctly imported
-
 def api_run_end_to_end_investigation():
     """
-    Initiates an end-to-end investigation based on the provided user ID and list of ASINs.
+    Starts an end-to-end investigation based on the provided user ID and list of ASINs and runs it
+    as a background job. Returns 202 with the investigation and job IDs right away.
     """
-    start_time = time.time()  # Start the timer
-
     try:
         data = request.json
         userId = data.get('userId')
@@ -207,22 +244,89 @@ def api_run_end_to_end_investigation():
         if not userId or not asinList or not name:
             return jsonify({"error": "userId and asinList and name are required"}), 400
 
-        ensure_event_loop()  # Ensure an event loop is available for async operations
+        result = enqueue_end_to_end_investigation(data)
+        logging.info(f"Queued end-to-end investigation {result['id']}")
+        return jsonify({
+            "message": "End-to-end investigation queued",
+            "investigationId": result['id'],
+            "jobId": result['jobId'],
+            "status": result['jobStatus'],
+        }), 202
+
+    except QueueFullError as e:
+        logging.warning(f"Rejected end-to-end investigation: {e}")
+        return jsonify({"error": str(e)}), 429
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error in api_run_end_to_end_investigation: {e}")
+        return jsonify({"error": str(e)}), 500
 
-        result = run_end_to_end_investigation(data)  # If this function is async, ensure it's awaited properly or run via asyncio.run() if it's the main async entry point
 
-        if result:
-            end_time = time.time()  # Stop the timer
-            elapsed_time = end_time - start_time
-            logging.info(f"Total time taken for end-to-end investigation: {elapsed_time:.2f} seconds")
+def api_get_job(jobId):
+    """
+    Returns the status of an investigation job.
+    """
+    try:
+        job = get_investigation_job_queue().get_job(jobId)
+        if job is None:
+            return jsonify({"error": f"Job {jobId} not found"}), 404
+        return jsonify(job), 200
+    except Exception as e:
+        logging.error(f"Error in api_get_job: {e}")
+        return jsonify({"error": str(e)}), 500
 
-            return jsonify({"message": "End-to-end investigation completed successfully"}), 200
-        else:
-            return jsonify({"error": "End-to-end investigation failed"}), 500
 
+def api_cancel_job(jobId):
+    """
+    Cancels a queued or running investigation job. Running jobs stop at the next stage boundary.
+    """
+    try:
+        if not get_investigation_job_queue().cancel(jobId):
+            return jsonify({"error": f"Job {jobId} is not queued or running"}), 409
+        return jsonify({"message": f"Cancellation of job {jobId} requested"}), 202
     except Exception as e:
-        logging.error(f"Error in api_run_end_to_end_investigation: {e}")
+        logging.error(f"Error in api_cancel_job: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+def api_get_cache_stats():
+    """
+    Returns hit/miss and size stats of the product and review read caches of the worker serving the request.
+    """
+    try:
+        return jsonify(get_read_cache_stats()), 200
+    except Exception as e:
+        logging.error(f"Error in api_get_cache_stats: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+def api_get_llm_scheduler_stats():
+    """
+    Returns per-investigation wait times of the LLM fair-share scheduler of the worker serving the request.
+    """
+    try:
+        return jsonify(get_llm_scheduler().stats()), 200
+    except Exception as e:
+        logging.error(f"Error in api_get_llm_scheduler_stats: {e}")
         return jsonify({"error": str(e)}), 500
 
 
-# %%
\ No newline at end of file
+def api_get_investigation_timing(userId, investigationId):
+    """
+    Returns the per-stage timing report of the last run of an investigation.
+    """
+    try:
+        investigation = get_investigation(userId, investigationId)
+        if investigation is None:
+            return jsonify({"error": f"Investigation {investigationId} not found"}), 404
+        timingReport = investigation.get('timingReport')
+        if not timingReport:
+            return jsonify({"error": f"Investigation {investigationId} has no timing report yet"}), 404
+        return jsonify(timingReport), 200
+    except Exception as e:
+        logging.error(f"Error in api_get_investigation_timing: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# %%
@@ -0,0 +1,123 @@
+#####################
+# near_duplicates.py
+# Near-duplicate review detection with MinHash signatures and LSH banding.
+#
+# Reviews are shingled into character 4-grams of their normalised text. MINHASH_PERMUTATIONS
+# universal hashes mod the Mersenne prime 2^31 - 1 turn each shingle set into a signature, computed
+# in NumPy in chunks of shingles. Signatures are cut into bands; reviews sharing a band are
+# candidates, and a candidate joins a cluster when its signature agrees with the cluster
+# representative's on at least `threshold` of the positions (the estimated Jaccard similarity).
+# Clusters are stars around their first review, so similarity never drifts along a chain.
+# The pipeline clusters at NEAR_DUPLICATE_THRESHOLD; 0 turns the stage off.
+import os
+import re
+import zlib
+
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', 0.8))
+MINHASH_PERMUTATIONS = 64
+MINHASH_SEED = 20240101
+SHINGLE_SIZE = 4
+SIGNATURE_CHUNK_SHINGLES = 65536
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+
+
+def shingle_hashes(text):
+    """Hashes (31 bits) of the distinct character shingles of the lowercased, alphanumeric-only text."""
+    normalised = _NON_ALPHANUMERIC.sub(' ', str(text).lower()).strip()
+    if not normalised:
+        return set()
+    if len(normalised) <= SHINGLE_SIZE:
+        return {zlib.crc32(normalised.encode('utf-8')) & _MERSENNE_PRIME}
+    return {zlib.crc32(normalised[index:index + SHINGLE_SIZE].encode('utf-8')) & _MERSENNE_PRIME for index in range(len(normalised) - SHINGLE_SIZE + 1)}
+
+
+def lsh_bands(threshold, permutations=MINHASH_PERMUTATIONS):
+    """(bands, rows per band) of the banding whose S-curve midpoint, (1 / bands) ** (1 / rows), is closest to threshold."""
+    shapes = [(permutations // rows, rows) for rows in range(1, permutations + 1) if permutations % rows == 0]
+    return min(shapes, key=lambda shape: abs((1 / shape[0]) ** (1 / shape[1]) - threshold))
+
+
+class NearDuplicateIndex:
+    """
+    Incremental clustering of texts into near-duplicate groups.
+
+    Args:
+    - threshold (float): Minimum estimated Jaccard similarity of a text to its cluster representative.
+    - permutations (int): MinHash signature length.
+    - seed (int): Seed of the hash functions; the same seed gives the same clusters.
+
+    Raises:
+    - ValueError: If threshold is not in (0, 1].
+    """
+
+    def __init__(self, threshold, permutations=MINHASH_PERMUTATIONS, seed=MINHASH_SEED):
+        import numpy as np
+
+        if not 0 < threshold <= 1:
+            raise ValueError(f"Near-duplicate threshold {threshold} is not in (0, 1].")
+        self.threshold = threshold
+        self.permutations = permutations
+        self.bands, self.rows = lsh_bands(threshold, permutations)
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _MERSENNE_PRIME, size=(permutations, 1), dtype=np.uint64)
+        self._b = rng.integers(0, _MERSENNE_PRIME, size=(permutations, 1), dtype=np.uint64)
+        self._buckets = [{} for _ in range(self.bands)]  # band -> band bytes -> representative
+        self._signatures = {}  # representative -> signature
+        self.count = 0
+
+    def signatures(self, texts):
+        """MinHash signatures (len(texts) x permutations, uint64); texts without shingles get None."""
+        import numpy as np
+
+        shingleSets = [shingle_hashes(text) for text in texts]
+        signatures = np.full((len(texts), self.permutations), _MERSENNE_PRIME, dtype=np.uint64)
+        nonEmpty = [index for index, shingles in enumerate(shingleSets) if shingles]
+        start = 0
+        while start < len(nonEmpty):
+            # Texts whose shingles fit in one chunk (at least one text per chunk)
+            stop = start
+            shingleCount = 0
+            while stop < len(nonEmpty) and (stop == start or shingleCount + len(shingleSets[nonEmpty[stop]]) <= SIGNATURE_CHUNK_SHINGLES):
+                shingleCount += len(shingleSets[nonEmpty[stop]])
+                stop += 1
+            chunk = nonEmpty[start:stop]
+            lengths = np.fromiter((len(shingleSets[index]) for index in chunk), dtype=np.int64, count=len(chunk))
+            shingles = np.fromiter((shingle for index in chunk for shingle in shingleSets[index]), dtype=np.uint64, count=int(lengths.sum()))
+            hashed = (self._a * shingles + self._b) % _MERSENNE_PRIME
+            segmentStarts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            signatures[chunk] = np.minimum.reduceat(hashed, segmentStarts, axis=1).T
+            start = stop
+        return [signatures[index] if shingleSets[index] else None for index in range(len(texts))]
+
+    def add(self, texts):
+        """
+        Cluster texts, numbered on from the texts added before.
+
+        Returns:
+        - list: For each text, the number of its cluster representative (its own number when it
+          starts a cluster).
+        """
+        representatives = []
+        for signature in self.signatures(texts):
+            number = self.count
+            self.count += 1
+            if signature is None:
+                representatives.append(number)
+                continue
+            bandKeys = [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+            representative = None
+            for band, bandKey in enumerate(bandKeys):
+                candidate = self._buckets[band].get(bandKey)
+                if candidate is not None and (signature == self._signatures[candidate]).mean() >= self.threshold:
+                    representative = candidate
+                    break
+            if representative is None:
+                representative = number
+                self._signatures[number] = signature
+                for band, bandKey in enumerate(bandKeys):
+                    self._buckets[band].setdefault(bandKey, number)
+            representatives.append(representative)
+        return representatives
+
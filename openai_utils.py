@@ -4,46 +4,34 @@ import aiohttp
 import json
 import asyncio
 import os
-import numpy as np
+import threading
 import random
-import pandas as pd
+from collections import OrderedDict
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 import requests
-import tiktoken
-import nest_asyncio
-nest_asyncio.apply()
 import logging
 logging.basicConfig(level=logging.INFO)
 import traceback
 from aiohttp import ContentTypeError, ClientResponseError
+from event_loop import get_http_session
+from rate_limiter import get_rate_limiter
+from llm_scheduler import get_llm_scheduler
+from profiler import record_api_call
+from reviews_data_processing_utils import get_tokenizer
+from function_schemas import get_request_template
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import pandas as pd
 
 embedding_model = "text-embedding-3-small"
 embedding_encoding = "cl100k_base"
 max_tokens = 10000
-encoding = tiktoken.get_encoding(embedding_encoding)
 
 response_queue = asyncio.Queue() 
 
 GPT_MODEL = "gpt-3.5-turbo-0125"
 
 
-from firebase_utils import FirestoreClient, PubSubClient, GAEClient
-
-try:
-    db = FirestoreClient.get_instance()
-except Exception as e:
-    logging.error(f"Error initializing Firestore: {e}")
-
-try:
-    publisher, subscriber, project_id, topic_id, subscription_id, topic_path, subscription_path = PubSubClient.get_instance()
-except Exception as e:
-    logging.error(f"Error initializing Pub/Sub: {e}")
-
-try:
-    GAEClient.get_instance()
-except Exception as e:
-    logging.error(f"Error initializing GAE: {e}")
-
 def get_openai_key():
     """Retrieve OpenAI API key."""
 
@@ -53,8 +41,8 @@ def get_openai_key():
     # If not found, try to get from secret management
     if not OPENAI_API_KEY:
         try:
-            from firebase_utils import get_secret
-            OPENAI_API_KEY = get_secret("OPENAI_API_KEY")
+            from firebase_utils import SecretManager
+            OPENAI_API_KEY = SecretManager.get_secret("OPENAI_API_KEY")
         except:
             pass
 
@@ -69,15 +57,25 @@ def get_openai_key():
 
     return OPENAI_API_KEY
 
-OPENAI_API_KEY = get_openai_key()
+_headers = None
+_headersLock = threading.Lock()
 
 
-HEADERS = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {OPENAI_API_KEY}"
-}
+def get_openai_headers():
+    """Request headers for the OpenAI API; the key is looked up once, on first use."""
+    global _headers
+    if _headers is None:
+        with _headersLock:
+            if _headers is None:
+                _headers = {
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {get_openai_key()}"
+                }
+    return _headers
 
 max_parallel_calls = 100
+# Seconds every worker holds back after a 429 without a Retry-After header
+OPENAI_THROTTLE_PAUSE_SECONDS = 5
 timeout = 60
 
 class ProgressLog:
@@ -94,7 +92,7 @@ class ProgressLog:
 async def process_message(message):
     data = message.data.decode('utf-8')
     content = json.loads(data)
-    session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300))
+    session = get_http_session('openai')
     semaphore = asyncio.Semaphore(6)
     progress_log = ProgressLog(1)  # Assuming one task per message
     await get_completion(content, session, semaphore, progress_log)
@@ -105,22 +103,19 @@ async def callback(message):
 
 @retry(wait=wait_random_exponential(min=1, max=180), stop=stop_after_attempt(10))
 def chat_completion_request(messages, functions=None, function_call=None, temperature=0, model=GPT_MODEL):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": "Bearer " + OPENAI_API_KEY,
-    }
-    json_data = {"model": model, "messages": messages, "temperature": temperature}
-    if functions is not None:
-        json_data.update({"functions": functions})
-    if function_call is not None:
-        json_data.update({"function_call": function_call})
+    headers = get_openai_headers()
+    template = get_request_template(model, temperature, functions, function_call)
     try:
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=json_data,
-        )
+        with get_rate_limiter('openai').limit_blocking(template.estimate_tokens(messages)):
+            response = requests.post(
+                "https://api.openai.com/v1/chat/completions",
+                headers=headers,
+                data=template.render(messages),
+            )
+        if response.status_code == 429:
+            get_rate_limiter('openai').pause(float(response.headers.get('Retry-After', OPENAI_THROTTLE_PAUSE_SECONDS)))
         try:
+            record_api_call('openai', tokens=response.json()['usage']['total_tokens'])
             print(response.json()['usage'])
         except:
             pass
@@ -140,25 +135,19 @@ def chat_completion_request(messages, functions=None, function_call=None, temper
        before_sleep=lambda retry_state: print(f"Sleeping for {retry_state.next_action} seconds"),
        retry_error_callback=lambda retry_state: print(f"Attempt {retry_state.attempt_number} failed. Error: {retry_state.outcome.result()}"))
 async def get_completion(content, session, semaphore, progress_log, functions=None, function_call=None, GPT_MODEL=GPT_MODEL, TEMPERATURE=0):
-    async with semaphore:
-        await asyncio.sleep(3)  # Introduce a 5.45-second delay between requests to avoid hitting the RPM & TPM limits.
-
-        # 1. Prepare request payload
-        json_data = {
-            "model": GPT_MODEL,
-            "messages": content,
-            "temperature": TEMPERATURE
-        }
-
-        # 2. Optionally update payload with additional fields
-        if functions is not None:
-            json_data.update({"functions": functions})
-        if function_call is not None:
-            json_data.update({"function_call": function_call})
+    # The semaphore caps this call's fan-out; the scheduler shares this process's slots fairly between
+    # investigations (llm_scheduler.py); the rate limiter holds the RPM/TPM budget of all worker processes
+    # The model, temperature and functions are serialised once per process (function_schemas.py)
+    template = get_request_template(GPT_MODEL, TEMPERATURE, functions, function_call)
+    estimatedTokens = template.estimate_tokens(content)
+    async with semaphore, get_llm_scheduler().slot(estimatedTokens), get_rate_limiter('openai').limit(estimatedTokens):
+
+        # 1-2. Prepare request payload: splice the messages into the static part
+        body = template.render(content)
 
         try:
             # 3. Make API request
-            async with session.post("https://api.openai.com/v1/chat/completions", headers=HEADERS, json=json_data) as resp:
+            async with session.post("https://api.openai.com/v1/chat/completions", headers=get_openai_headers(), data=body) as resp:
                 resp.raise_for_status()
                 
                 try:
@@ -173,7 +162,8 @@ async def get_completion(content, session, semaphore, progress_log, functions=No
                     logging.error(f"OpenAI API Error: {error_message}")
                     raise ValueError(error_message)
 
-                # 5. Print usage data if available
+                # 5. Record and print usage data if available
+                record_api_call('openai', tokens=response_json.get('usage', {}).get('total_tokens', 0))
                 try:
                     print(response_json['usage'])
                 except KeyError:
@@ -192,6 +182,9 @@ async def get_completion(content, session, semaphore, progress_log, functions=No
                 raise  # These are not retriable errors, so re-raise them immediately
             elif e.status in [429, 502, 503, 504]:
                 logging.warning("Temporary API issue or rate limit hit. Retrying...")
+                if e.status == 429:
+                    retryAfter = e.headers.get('Retry-After') if e.headers else None
+                    await get_rate_limiter('openai').pause_async(float(retryAfter or OPENAI_THROTTLE_PAUSE_SECONDS))
                 raise  # This exception will trigger a retry if within the retry count
             else:
                 raise  # For other errors, re-raise them immediately
@@ -207,8 +200,8 @@ async def get_completion_list(content_list, functions=None, function_call=None,
     semaphore = asyncio.Semaphore(6)  # Allow only 3 requests at a time to ensure you don't exceed the RPM
     progress_log = ProgressLog(len(content_list))
 
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300)) as session:
-        return await asyncio.gather(*[get_completion(content, session, semaphore, progress_log, functions, function_call, GPT_MODEL, TEMPERATURE) for content in content_list])
+    session = get_http_session('openai')
+    return await asyncio.gather(*[get_completion(content, session, semaphore, progress_log, functions, function_call, GPT_MODEL, TEMPERATURE) for content in content_list])
 
 
 
@@ -217,42 +210,102 @@ async def get_completion_list_multifunction(content_list, functions_list, functi
     semaphore = asyncio.Semaphore(6)
     progress_log = ProgressLog(len(content_list) * len(functions_list))  # Adjust for multiple functions
 
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300)) as session:
-        tasks = []
-        for i in range(len(functions_list)):
-            for content in content_list:
-                tasks.append(get_completion(content, session, semaphore, progress_log, functions_list[i], function_calls_list[i], GPT_MODEL, TEMPERATURE))
-        return await asyncio.gather(*tasks)
+    session = get_http_session('openai')
+    tasks = []
+    for i in range(len(functions_list)):
+        for content in content_list:
+            tasks.append(get_completion(content, session, semaphore, progress_log, functions_list[i], function_calls_list[i], GPT_MODEL, TEMPERATURE))
+    return await asyncio.gather(*tasks)
 
 
 
-async def get_embedding(text: str, model="text-embedding-3-small") -> list[float]:
-    async with aiohttp.ClientSession() as session:
-        for attempt in range(6):  # Retry up to 6 times
-            try:
+# Texts per embeddings request, and (model, text) embeddings kept in process by get_embeddings()
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 256))
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 50000))
+_embeddingCache = OrderedDict()
+_embeddingCacheLock = threading.Lock()
+
+
+async def _embedding_request(texts, model, session):
+    """Embeddings of a batch of texts in input order, or None after 6 failed attempts."""
+    estimatedTokens = sum(len(text) for text in texts) // 4 + len(texts)
+    for attempt in range(6):  # Retry up to 6 times
+        try:
+            async with get_rate_limiter('openai').limit(estimatedTokens):
                 async with session.post(
                     'https://api.openai.com/v1/embeddings',
-                    json={"input": [text], "model": model},
-                    headers=HEADERS
+                    json={"input": texts, "model": model},
+                    headers=get_openai_headers()
                 ) as response:
+                    if response.status == 429:
+                        await get_rate_limiter('openai').pause_async(float(response.headers.get('Retry-After') or OPENAI_THROTTLE_PAUSE_SECONDS))
+                    response.raise_for_status()
                     response = await response.json()
-                    return np.array(response["data"][0]["embedding"])  # Convert embedding to numpy array directly
-            except Exception as e:
-                wait_time = random.uniform(1, min(20, 2 ** attempt))  # Exponential backoff
-                print(f"Request failed with {e}, retrying in {wait_time} seconds.")
-                await asyncio.sleep(wait_time)
-        print("Failed to get embedding after 6 attempts, returning None.")
-        return None
+            record_api_call('openai', tokens=response.get('usage', {}).get('total_tokens', 0))
+            return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+        except Exception as e:
+            wait_time = random.uniform(1, min(20, 2 ** attempt))  # Exponential backoff
+            print(f"Request failed with {e}, retrying in {wait_time} seconds.")
+            await asyncio.sleep(wait_time)
+    print("Failed to get embeddings after 6 attempts, returning None.")
+    return None
+
+
+async def get_embeddings(texts, model=embedding_model):
+    """
+    Embeddings of many texts, EMBEDDING_BATCH_SIZE per request.
+
+    Repeated texts are embedded once, and embeddings already cached in this process (up to
+    EMBEDDING_CACHE_SIZE, least recently used first out) are not requested again.
+
+    Parameters:
+    - texts (list): Non-empty strings.
+    - model (str): The embedding model.
+
+    Returns:
+    - numpy.ndarray: float32 matrix with one row per text, in order.
+    - None: If a request failed.
+    """
+    import numpy as np
+    vectors = {}
+    with _embeddingCacheLock:
+        for text in dict.fromkeys(texts):
+            if (model, text) in _embeddingCache:
+                _embeddingCache.move_to_end((model, text))
+                vectors[text] = _embeddingCache[(model, text)]
+    missing = [text for text in dict.fromkeys(texts) if text not in vectors]
+    if missing:
+        session = get_http_session('openai')
+        batches = [missing[start:start + EMBEDDING_BATCH_SIZE] for start in range(0, len(missing), EMBEDDING_BATCH_SIZE)]
+        results = await asyncio.gather(*[_embedding_request(batch, model, session) for batch in batches])
+        if any(result is None for result in results):
+            return None
+        with _embeddingCacheLock:
+            for batch, embeddings in zip(batches, results):
+                for text, embedding in zip(batch, embeddings):
+                    vectors[text] = np.asarray(embedding, dtype=np.float32)
+                    _embeddingCache[(model, text)] = vectors[text]
+            while len(_embeddingCache) > EMBEDDING_CACHE_SIZE:
+                _embeddingCache.popitem(last=False)
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.vstack([vectors[text] for text in texts])
+
+
+async def get_embedding(text: str, model="text-embedding-3-small") -> list[float]:
+    embeddings = await get_embeddings([text], model=model)
+    return embeddings[0] if embeddings is not None else None
 
 
 
 max_tokens = 8048  # Define max tokens or get it from somewhere
 
-async def process_dataframe_async_embedding(df: pd.DataFrame, embedding_model="text-embedding-3-small") -> pd.DataFrame:
+async def process_dataframe_async_embedding(df: "pd.DataFrame", embedding_model="text-embedding-3-small") -> "pd.DataFrame":
     loop = asyncio.get_event_loop()
     tasks = []
 
     # Filter rows by token count
+    encoding = get_tokenizer(embedding_encoding)
     df["n_tokens"] = df['Value'].apply(lambda x: len(encoding.encode(x)))
     df = df[df.n_tokens <= max_tokens]
 
@@ -0,0 +1,190 @@
+#####################
+# postprocessing.py
+# Turns the parsed aggregation responses into tagged reviews and the frontend output in one pass.
+#
+# Each response maps a category to labels with the uids of their reviews. Only the first category
+# of a response counts and a later response for the same category replaces an earlier one, as the
+# step-by-step version in process_reviews_with_gpt did. Review fields are looked up in lists
+# indexed by uid, and duplicate labels are dropped by a hashable key instead of json.dumps.
+# The statistics of every label, overall and per ASIN, come from one grouped NumPy pass over the
+# labels' uids laid out flat with offsets (quantify_label_arrays). A uid that represents a cluster of
+# near-duplicate reviews is expanded to every member first, so each member counts with its own rating.
+# When the table holds a sample, each observation is weighted by its sampling weight.
+from reviews_data_processing_utils import format_label_statistics, quantify_label_arrays
+
+LABEL_KEYS = frozenset(('headerOfCategory (7 words)', 'objectiveStatement', 'headerOfCategory'))
+CUSTOMER_VOICE_SAMPLES = 5
+
+_MISSING = object()
+
+
+def _freeze(value):
+    """Hashable key equal for two values exactly when their json.dumps(sort_keys=True) strings are."""
+    valueType = type(value)
+    if valueType is str or valueType is int:
+        return value
+    if valueType is list:
+        return tuple([_freeze(element) for element in value])
+    if valueType is dict:
+        return (dict, tuple(sorted((key, _freeze(element)) for key, element in value.items())))
+    # 1, 1.0 and True compare equal but serialize differently
+    return (valueType, value)
+
+
+def _select_categories(processedResults):
+    """Category -> labels: the first category of each response, later responses replacing earlier ones."""
+    categories = {}
+    for result in processedResults:
+        if isinstance(result, dict) and result:
+            category = next(iter(result))
+            categories[category] = result[category]
+    return categories
+
+
+def postprocess_extraction_results(processedResults, reviews, uid_to_id_mapping=None):
+    """
+    Filter, deduplicate, label, tag and quantify the aggregation results in a single pass.
+
+    Parameters:
+    - processedResults (list): Parsed aggregation responses, dicts of category -> list of label
+      dicts with a 'uid' list and the label under one of LABEL_KEYS or 'label'.
+    - reviews (ReviewTable): The reviews; their tags are set on the table, per representative uid.
+    - uid_to_id_mapping (Mapping, optional): uid to review id; uids outside it are dropped.
+      Defaults to the table's own.
+
+    Returns:
+    - tuple: The tagged table, the frontend output (category -> labels sorted by
+      numberOfObservations) and the per-ASIN breakdowns (a list of {asin, category, label,
+      numberOfObservations, percentage, rating, negativeRatingsCount, positiveRatingsCount}, the
+      percentage being of the category's observations for that ASIN, where a review shared by
+      several ASINs counts in each). For a sample, counts are scaled-up estimates and both outputs
+      also have sampledObservations and percentageInterval. Both outputs are empty when a label
+      has no name.
+
+    Raises:
+    - KeyError: If a label has no 'uid' list, or the first one has no name.
+    """
+    import numpy as np
+
+    if uid_to_id_mapping is None:
+        uid_to_id_mapping = reviews.uid_to_id_mapping
+    # Review fields by uid (a uid shared by several rows takes its first row's fields)
+    texts = reviews.texts
+    rowByUid = reviews.rowByUid
+    representativeByUid = reviews.representativeByUid
+
+    tagsByUid = {}
+    categories = []
+    labelNames, labelCategories, labelUids, offsets, flatUids = [], [], [], [0], []
+    missingLabel = False
+    label = _MISSING
+
+    for category, labels in _select_categories(processedResults).items():
+        categoryIndex = len(categories)
+        categories.append(category)
+        seen = set()
+
+        for item in labels:
+            uids = [uid for uid in item['uid'] if uid in uid_to_id_mapping]
+            if not uids:
+                continue
+            renamed = {}
+            for key, value in item.items():
+                renamed['label' if key in LABEL_KEYS else key] = uids if key == 'uid' else value
+            dedupeKey = _freeze(dict(item, uid=uids))
+            if dedupeKey in seen:
+                continue
+            seen.add(dedupeKey)
+
+            # A label without a name is tagged with the previous one and empties the outputs
+            if 'label' in renamed:
+                label = renamed['label']
+            else:
+                missingLabel = True
+                if label is _MISSING:
+                    raise KeyError('label')
+
+            for uid in uids:
+                representative = representativeByUid[uid]
+                uidTags = tagsByUid.get(representative)
+                if uidTags is None:
+                    uidTags = tagsByUid[representative] = {}
+                if category in uidTags:
+                    uidTags[category].append(label)
+                else:
+                    uidTags[category] = [label]
+
+            labelNames.append(label)
+            labelCategories.append(categoryIndex)
+            labelUids.append(uids)
+            flatUids.extend(uids)
+            offsets.append(len(flatUids))
+
+    reviews.tags = tagsByUid
+    if missingLabel:
+        return reviews, {}, []
+
+    # Gathered straight from the table's arrays. A review counts once overall and once for every
+    # ASIN (variant) it was acquired for, and each near-duplicate review of a cluster counts
+    observationUids = np.asarray(flatUids, dtype=np.int64)
+    if len(reviews.representatives) < reviews.uidCount:
+        memberOffsets, members = reviews.cluster_members()
+        observationRepresentatives = np.frombuffer(representativeByUid, dtype=np.int64)[observationUids]
+        memberCounts = np.diff(memberOffsets)[observationRepresentatives]
+        memberBounds = np.zeros(len(observationUids) + 1, dtype=np.int64)
+        np.cumsum(memberCounts, out=memberBounds[1:])
+        observationUids = members[np.repeat(memberOffsets[observationRepresentatives] - memberBounds[:-1], memberCounts) + np.arange(memberBounds[-1])]
+        offsets = memberBounds[np.asarray(offsets, dtype=np.int64)]
+    uidAsinOffsets, uidAsinCodes = reviews.uid_asins()
+    asinCounts = np.diff(uidAsinOffsets)[observationUids]
+    asinOffsets = np.zeros(len(observationUids) + 1, dtype=np.int64)
+    np.cumsum(asinCounts, out=asinOffsets[1:])
+    asinEntries = np.repeat(uidAsinOffsets[observationUids] - asinOffsets[:-1], asinCounts) + np.arange(asinOffsets[-1])
+    stats = quantify_label_arrays(
+        labelCategories,
+        offsets,
+        np.frombuffer(reviews.ratings, dtype=np.int8)[np.frombuffer(rowByUid, dtype=np.int64)[observationUids]],
+        uidAsinCodes[asinEntries],
+        len(categories),
+        len(reviews.asins),
+        asinOffsets=asinOffsets,
+        weights=np.frombuffer(reviews.weightByUid, dtype=np.float64)[observationUids] if reviews.weightByUid is not None else None,
+    )
+
+    entriesByCategory = [[] for _ in categories]
+    for index, statistics in enumerate(format_label_statistics(stats)):
+        entry = {
+            'label': labelNames[index],
+            'numberOfObservations': statistics.pop('numberOfObservations'),
+            'percentage': statistics.pop('percentage'),
+            'rating': statistics.pop('rating'),
+            'customerVoice': [texts[rowByUid[uid]] for uid in labelUids[index][:CUSTOMER_VOICE_SAMPLES]],
+        }
+        entry.update(statistics)
+        entriesByCategory[labelCategories[index]].append(entry)
+    frontendOutput = {
+        category: sorted(entries, key=lambda entry: entry['numberOfObservations'], reverse=True)
+        for category, entries in zip(categories, entriesByCategory)
+    }
+
+    # Pairs ordered by ASIN, category and decreasing observations, ties in label order
+    asins = reviews.asins
+    pairStats = stats['byAsin']
+    asinRanks = np.empty(len(asins), dtype=np.int64)
+    asinRanks[sorted(range(len(asins)), key=lambda code: str(asins[code]))] = np.arange(len(asins))
+    categoryRanks = np.empty(len(categories), dtype=np.int64)
+    categoryRanks[sorted(range(len(categories)), key=lambda code: categories[code])] = np.arange(len(categories))
+    order = np.lexsort((-pairStats['count'], categoryRanks[np.asarray(labelCategories, dtype=np.int64)[pairStats['label']]], asinRanks[pairStats['asin']]))
+    pairStats = {key: values[order] for key, values in pairStats.items()}
+
+    asinBreakdowns = [
+        {
+            'asin': asins[asinCode],
+            'category': categories[labelCategories[index]],
+            'label': labelNames[index],
+            **statistics,
+        }
+        for index, asinCode, statistics in zip(pairStats['label'].tolist(), pairStats['asin'].tolist(), format_label_statistics(pairStats))
+    ]
+
+    return reviews, frontendOutput, asinBreakdowns
@@ -0,0 +1,204 @@
+#####################
+# profiler.py
+# Per-stage timing of investigation runs.
+#
+# A run activates an InvestigationProfiler; it lives in a ContextVar, so it follows the run onto the
+# background event loop (run_coroutine) and into asyncio.to_thread workers. Stages run one after
+# another: begin_stage() closes the open stage and opens the next one, profile_stage() wraps a block.
+# Each stage records wall time, CPU time, the peak RSS of the process, item counts, and the tokens
+# and API calls that OpenAI and RapidAPI requests report through record_api_call() while it is open.
+# CPU time and peak RSS are per process, so runs sharing a worker inflate each other's figures.
+# report() is the compact form written to the investigation document as 'timingReport'.
+import contextvars
+import logging
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+STAGES = ('acquisition', 'load', 'clean', 'batch', 'extract', 'aggregate', 'postProcess', 'write')
+TIMING_REPORT_VERSION = 1
+
+currentProfiler = contextvars.ContextVar('investigationProfiler', default=None)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class InvestigationProfiler:
+    """
+    Stage timings, counts and API usage of one investigation run.
+
+    Args:
+    - investigationId (str): The ID of the investigation.
+    """
+
+    def __init__(self, investigationId):
+        self.investigationId = investigationId
+        self.startedAt = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stages = {}  # name -> totals, in first-opened order
+        self._open = None  # (name, wallStart, cpuStart)
+
+    @contextmanager
+    def activate(self):
+        """Make this the profiler of the current context (and of the work it starts) until exit."""
+        token = currentProfiler.set(self)
+        try:
+            yield self
+        finally:
+            self.end_stage()
+            currentProfiler.reset(token)
+
+    def _totals(self, name):
+        if name not in self._stages:
+            self._stages[name] = {'wallSeconds': 0.0, 'cpuSeconds': 0.0, 'peakRssMb': 0.0, 'items': 0, 'tokens': 0, 'apiCalls': {}}
+        return self._stages[name]
+
+    def begin_stage(self, name, items=None):
+        """Close the open stage, if any, and open name; a stage opened again adds to its totals."""
+        with self._lock:
+            self._close_open()
+            totals = self._totals(name)
+            if items:
+                totals['items'] += items
+            self._open = (name, time.perf_counter(), time.process_time())
+
+    def end_stage(self):
+        with self._lock:
+            self._close_open()
+
+    def _close_open(self):
+        if self._open is None:
+            return
+        name, wallStart, cpuStart = self._open
+        totals = self._totals(name)
+        totals['wallSeconds'] += time.perf_counter() - wallStart
+        totals['cpuSeconds'] += time.process_time() - cpuStart
+        totals['peakRssMb'] = max(totals['peakRssMb'], peak_rss_mb())
+        self._open = None
+
+    def add_items(self, count):
+        """Count items (reviews, batches, categories, ...) processed by the open stage."""
+        with self._lock:
+            if self._open is not None:
+                self._totals(self._open[0])['items'] += count
+
+    def record_api_call(self, api, tokens=0):
+        """Count a request to api, and the tokens it used, against the open stage."""
+        with self._lock:
+            totals = self._totals(self._open[0] if self._open is not None else 'other')
+            totals['apiCalls'][api] = totals['apiCalls'].get(api, 0) + 1
+            totals['tokens'] += tokens or 0
+
+    def report(self):
+        """
+        Compact timing report of the run so far.
+
+        Returns:
+        - dict: version, totalSeconds, peakRssMb, slowestStage and stages, a list (in the order the
+          stages were first opened) of {stage, wallSeconds, cpuSeconds, peakRssMb, items, tokens, apiCalls}.
+        """
+        with self._lock:
+            stages = []
+            for name, totals in self._stages.items():
+                wallSeconds = totals['wallSeconds']
+                cpuSeconds = totals['cpuSeconds']
+                if self._open is not None and self._open[0] == name:
+                    wallSeconds += time.perf_counter() - self._open[1]
+                    cpuSeconds += time.process_time() - self._open[2]
+                stages.append({
+                    'stage': name,
+                    'wallSeconds': round(wallSeconds, 3),
+                    'cpuSeconds': round(cpuSeconds, 3),
+                    'peakRssMb': totals['peakRssMb'],
+                    'items': totals['items'],
+                    'tokens': totals['tokens'],
+                    'apiCalls': dict(totals['apiCalls']),
+                })
+        slowest = max(stages, key=lambda stage: stage['wallSeconds'])['stage'] if stages else None
+        return {
+            'version': TIMING_REPORT_VERSION,
+            'totalSeconds': round(time.perf_counter() - self.startedAt, 3),
+            'peakRssMb': peak_rss_mb(),
+            'slowestStage': slowest,
+            'stages': stages,
+        }
+
+    def summary(self):
+        """One log line: wall seconds per stage."""
+        report = self.report()
+        stages = ', '.join(f"{stage['stage']} {stage['wallSeconds']}s" for stage in report['stages'])
+        return f"Investigation {self.investigationId} took {report['totalSeconds']}s ({stages}); slowest: {report['slowestStage']}"
+
+
+# Module-level helpers act on the profiler of the current context and do nothing without one, so
+# instrumented code also runs outside a profiled investigation (API endpoints, benchmarks).
+
+def get_current_profiler():
+    return currentProfiler.get()
+
+
+def begin_stage(name, items=None):
+    profiler = currentProfiler.get()
+    if profiler is not None:
+        profiler.begin_stage(name, items)
+
+
+def end_stage():
+    profiler = currentProfiler.get()
+    if profiler is not None:
+        profiler.end_stage()
+
+
+@contextmanager
+def profile_stage(name, items=None):
+    """Record the block as stage name of the current profiler."""
+    begin_stage(name, items)
+    try:
+        yield
+    finally:
+        end_stage()
+
+
+def add_stage_items(count):
+    profiler = currentProfiler.get()
+    if profiler is not None:
+        profiler.add_items(count)
+
+
+def record_api_call(api, tokens=0):
+    profiler = currentProfiler.get()
+    if profiler is not None:
+        profiler.record_api_call(api, tokens)
+
+
+def run_profiled(investigationId, statusTracker, func, /, *args, **kwargs):
+    """
+    Call func under a new profiler and save its report when it returns or raises. Runs func as is
+    when the current context already has a profiler (the stages belong to an enclosing run).
+    """
+    if currentProfiler.get() is not None:
+        return func(*args, **kwargs)
+    profiler = InvestigationProfiler(investigationId)
+    try:
+        with profiler.activate():
+            return func(*args, **kwargs)
+    finally:
+        save_timing_report(profiler, statusTracker)
+
+
+def save_timing_report(profiler, statusTracker):
+    """Write the profiler's report onto the investigation document. Returns True if successful."""
+    try:
+        statusTracker.update({'timingReport': profiler.report()})
+        logging.info(profiler.summary())
+        return True
+    except Exception as e:
+        logging.error(f"Error saving the timing report of investigation {profiler.investigationId}: {e}")
+        return False
@@ -0,0 +1,362 @@
+#####################
+# rate_limiter.py
+# Rate limits shared by every worker process that calls OpenAI and RapidAPI.
+#
+# Each named budget (e.g. 'openai') has a requests-per-minute and a tokens-per-minute token bucket,
+# a cap on requests in flight and a shared pause that a 429 response sets for everybody. The state
+# lives in a backend that all processes draw from:
+# - 'file' (default): a JSON state file guarded by fcntl.flock, shared by the gunicorn workers of a host.
+# - 'redis': a Redis-compatible server (RATE_LIMIT_REDIS_URL), shared by all instances. Needs `pip install redis`.
+# - 'local': in-process only (the old per-worker behaviour), for scripts and tests.
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+
+# How often a caller blocked only by the in-flight cap checks again
+CONCURRENCY_POLL_SECONDS = 0.05
+
+RATE_LIMIT_DEFAULTS = {
+    'openai': {
+        'rpm': float(os.getenv('OPENAI_RPM', 500)),
+        'tpm': float(os.getenv('OPENAI_TPM', 200000)),
+        'max_concurrency': int(os.getenv('OPENAI_MAX_CONCURRENCY', 12)),
+    },
+    'rapidapi': {
+        'rpm': float(os.getenv('RAPIDAPI_RPM', 120)),
+        'tpm': 0,
+        'max_concurrency': int(os.getenv('RAPIDAPI_MAX_CONCURRENCY', 10)),
+    },
+}
+
+
+def _acquire_in_state(state, now, name, cost, rpm, tpm, maxConcurrency, leaseSeconds):
+    """
+    Token-bucket acquisition on a plain dict; shared by the file and local backends.
+
+    Returns:
+    - tuple: (seconds to wait before trying again, slot id). The slot id is None unless acquired.
+    """
+    budget = state.setdefault(name, {'requests': rpm, 'tokens': tpm, 'updatedAt': now, 'pausedUntil': 0, 'slots': {}})
+    elapsed = max(0.0, now - budget['updatedAt'])
+    if rpm:
+        budget['requests'] = min(rpm, budget['requests'] + elapsed * rpm / 60)
+    if tpm:
+        budget['tokens'] = min(tpm, budget['tokens'] + elapsed * tpm / 60)
+        cost = min(cost, tpm)  # A request larger than the whole bucket would never pass otherwise
+    budget['updatedAt'] = now
+    budget['slots'] = {slotId: expiresAt for slotId, expiresAt in budget['slots'].items() if expiresAt > now}
+
+    wait = max(0.0, budget['pausedUntil'] - now)
+    if rpm and budget['requests'] < 1:
+        wait = max(wait, (1 - budget['requests']) * 60 / rpm)
+    if tpm and budget['tokens'] < cost:
+        wait = max(wait, (cost - budget['tokens']) * 60 / tpm)
+    if maxConcurrency and len(budget['slots']) >= maxConcurrency:
+        wait = max(wait, CONCURRENCY_POLL_SECONDS)
+    if wait > 0:
+        return wait, None
+
+    if rpm:
+        budget['requests'] -= 1
+    if tpm:
+        budget['tokens'] -= cost
+    slotId = uuid.uuid4().hex
+    budget['slots'][slotId] = now + leaseSeconds
+    return 0.0, slotId
+
+
+def _release_in_state(state, name, slotId):
+    if name in state:
+        state[name]['slots'].pop(slotId, None)
+
+
+def _pause_in_state(state, now, name, seconds):
+    if name in state:
+        state[name]['pausedUntil'] = max(state[name]['pausedUntil'], now + seconds)
+
+
+class LocalRateLimitBackend:
+    """Budgets held in this process only."""
+
+    blocking = False  # In-memory updates under a lock held for microseconds
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}
+
+    def acquire(self, name, cost, rpm, tpm, maxConcurrency, leaseSeconds):
+        with self._lock:
+            return _acquire_in_state(self._state, time.time(), name, cost, rpm, tpm, maxConcurrency, leaseSeconds)
+
+    def release(self, name, slotId):
+        with self._lock:
+            _release_in_state(self._state, name, slotId)
+
+    def pause(self, name, seconds):
+        with self._lock:
+            _pause_in_state(self._state, time.time(), name, seconds)
+
+
+class FileRateLimitBackend:
+    """
+    Budgets kept in a JSON file that every process on the host locks with flock for each operation.
+
+    Args:
+    - path (str): State file; created on first use.
+    """
+
+    blocking = True  # flock and file I/O (and a lock shared with limit_blocking() threads), so the event loop runs them in a thread
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked_state(self):
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            with os.fdopen(fd, 'r+') as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                try:
+                    raw = file.read()
+                    try:
+                        state = json.loads(raw) if raw else {}
+                    except json.JSONDecodeError:
+                        logging.error(f"Resetting unreadable rate limit state in {self.path}")
+                        state = {}
+                    yield state
+                    file.seek(0)
+                    file.truncate()
+                    file.write(json.dumps(state))
+                    file.flush()
+                finally:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+
+    def acquire(self, name, cost, rpm, tpm, maxConcurrency, leaseSeconds):
+        with self._locked_state() as state:
+            return _acquire_in_state(state, time.time(), name, cost, rpm, tpm, maxConcurrency, leaseSeconds)
+
+    def release(self, name, slotId):
+        with self._locked_state() as state:
+            _release_in_state(state, name, slotId)
+
+    def pause(self, name, seconds):
+        with self._locked_state() as state:
+            _pause_in_state(state, time.time(), name, seconds)
+
+
+REDIS_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local rpm = tonumber(ARGV[3])
+local tpm = tonumber(ARGV[4])
+local maxConcurrency = tonumber(ARGV[5])
+local lease = tonumber(ARGV[6])
+local slotId = ARGV[7]
+local poll = tonumber(ARGV[8])
+
+local bucket = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'updatedAt', 'pausedUntil')
+local requests = tonumber(bucket[1]) or rpm
+local tokens = tonumber(bucket[2]) or tpm
+local updatedAt = tonumber(bucket[3]) or now
+local pausedUntil = tonumber(bucket[4]) or 0
+local elapsed = math.max(0, now - updatedAt)
+if rpm > 0 then requests = math.min(rpm, requests + elapsed * rpm / 60) end
+if tpm > 0 then
+  tokens = math.min(tpm, tokens + elapsed * tpm / 60)
+  cost = math.min(cost, tpm)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+
+local wait = math.max(0, pausedUntil - now)
+if rpm > 0 and requests < 1 then wait = math.max(wait, (1 - requests) * 60 / rpm) end
+if tpm > 0 and tokens < cost then wait = math.max(wait, (cost - tokens) * 60 / tpm) end
+if maxConcurrency > 0 and redis.call('ZCARD', KEYS[2]) >= maxConcurrency then wait = math.max(wait, poll) end
+if wait == 0 then
+  if rpm > 0 then requests = requests - 1 end
+  if tpm > 0 then tokens = tokens - cost end
+  redis.call('ZADD', KEYS[2], now + lease, slotId)
+end
+redis.call('HSET', KEYS[1], 'requests', requests, 'tokens', tokens, 'updatedAt', now)
+redis.call('EXPIRE', KEYS[1], 3600)
+redis.call('EXPIRE', KEYS[2], 3600)
+return tostring(wait)
+"""
+
+REDIS_PAUSE_SCRIPT = """
+local pausedUntil = tonumber(redis.call('HGET', KEYS[1], 'pausedUntil')) or 0
+redis.call('HSET', KEYS[1], 'pausedUntil', math.max(pausedUntil, tonumber(ARGV[1])))
+redis.call('EXPIRE', KEYS[1], 3600)
+return 1
+"""
+
+
+class RedisRateLimitBackend:
+    """
+    Budgets kept in a Redis-compatible server, updated atomically by Lua scripts, so every instance shares them.
+
+    Args:
+    - url (str): Redis URL, e.g. redis://localhost:6379/0.
+    - prefix (str): Key prefix.
+    """
+
+    blocking = True  # Calls go over the network, so the event loop runs them in a thread
+
+    def __init__(self, url, prefix='rateLimit'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._acquire = self.client.register_script(REDIS_ACQUIRE_SCRIPT)
+        self._pause = self.client.register_script(REDIS_PAUSE_SCRIPT)
+
+    def _keys(self, name):
+        return [f"{self.prefix}:{name}:bucket", f"{self.prefix}:{name}:slots"]
+
+    def acquire(self, name, cost, rpm, tpm, maxConcurrency, leaseSeconds):
+        slotId = uuid.uuid4().hex
+        wait = float(self._acquire(keys=self._keys(name), args=[time.time(), cost, rpm or 0, tpm or 0, maxConcurrency or 0, leaseSeconds, slotId, CONCURRENCY_POLL_SECONDS]))
+        return (wait, None) if wait > 0 else (0.0, slotId)
+
+    def release(self, name, slotId):
+        self.client.zrem(self._keys(name)[1], slotId)
+
+    def pause(self, name, seconds):
+        self._pause(keys=self._keys(name)[:1], args=[time.time() + seconds])
+
+
+def get_rate_limit_backend_from_env():
+    """
+    Build the backend selected by RATE_LIMIT_BACKEND ('file' (default), 'redis' or 'local').
+
+    Environment:
+    - RATE_LIMIT_STATE_PATH: State file of the 'file' backend.
+    - RATE_LIMIT_REDIS_URL: Server of the 'redis' backend.
+    """
+    backend = os.getenv('RATE_LIMIT_BACKEND', 'file').lower()
+    if backend == 'file':
+        return FileRateLimitBackend(os.getenv('RATE_LIMIT_STATE_PATH', os.path.join(tempfile.gettempdir(), 'productexplorer-rate-limits.json')))
+    if backend == 'redis':
+        return RedisRateLimitBackend(os.getenv('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0'))
+    if backend == 'local':
+        return LocalRateLimitBackend()
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {backend}")
+
+
+class RateLimiter:
+    """
+    A named budget drawn from a shared backend.
+
+    Args:
+    - name (str): Budget name; processes using the same name and backend share the budget.
+    - rpm (float): Requests per minute (0 for no limit).
+    - tpm (float): Tokens per minute (0 for no limit).
+    - max_concurrency (int): Requests in flight across all processes (0 for no limit).
+    - backend: LocalRateLimitBackend, FileRateLimitBackend or RedisRateLimitBackend.
+    - lease_seconds (float): A slot not released within this time (e.g. its process died) is freed.
+    """
+
+    def __init__(self, name, rpm, tpm, max_concurrency, backend, lease_seconds=300):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.backend = backend
+        self.lease_seconds = lease_seconds
+
+    def _try_acquire(self, cost):
+        try:
+            return self.backend.acquire(self.name, cost, self.rpm, self.tpm, self.max_concurrency, self.lease_seconds)
+        except Exception as e:
+            # An unavailable backend must not stop the pipeline; the provider's 429s still apply
+            logging.error(f"Rate limit backend error for {self.name}, not limiting this request: {e}")
+            return 0.0, None
+
+    def _release(self, slotId):
+        if slotId is None:
+            return
+        try:
+            self.backend.release(self.name, slotId)
+        except Exception as e:
+            logging.error(f"Error releasing {self.name} rate limit slot: {e}")
+
+    @asynccontextmanager
+    async def limit(self, cost=0):
+        """Wait for a request (and cost tokens) within the budget, holding an in-flight slot until exit."""
+        while True:
+            if self.backend.blocking:
+                wait, slotId = await asyncio.to_thread(self._try_acquire, cost)
+            else:
+                wait, slotId = self._try_acquire(cost)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        try:
+            yield
+        finally:
+            if self.backend.blocking:
+                await asyncio.to_thread(self._release, slotId)
+            else:
+                self._release(slotId)
+
+    @contextmanager
+    def limit_blocking(self, cost=0):
+        """Synchronous limit() for code outside the event loop."""
+        while True:
+            wait, slotId = self._try_acquire(cost)
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        try:
+            yield
+        finally:
+            self._release(slotId)
+
+    def pause(self, seconds):
+        """Hold back every process using this budget for seconds, e.g. after a 429."""
+        try:
+            self.backend.pause(self.name, seconds)
+        except Exception as e:
+            logging.error(f"Error pausing {self.name} rate limit: {e}")
+
+    async def pause_async(self, seconds):
+        """pause() for coroutines: a blocking backend is called from a worker thread, as in limit()."""
+        if self.backend.blocking:
+            await asyncio.to_thread(self.pause, seconds)
+        else:
+            self.pause(seconds)
+
+
+_backend = None
+_limiters = {}
+_limitersLock = threading.Lock()
+
+
+def get_rate_limiter(name):
+    """Return the process-wide RateLimiter for a budget in RATE_LIMIT_DEFAULTS, on the backend from the environment."""
+    global _backend
+    with _limitersLock:
+        if name not in _limiters:
+            if _backend is None:
+                _backend = get_rate_limit_backend_from_env()
+            _limiters[name] = RateLimiter(name, backend=_backend, **RATE_LIMIT_DEFAULTS[name])
+        return _limiters[name]
+
+
+def estimate_request_tokens(messages, functions=None, max_completion_tokens=1000, functions_characters=None):
+    """
+    Rough token cost of a chat request (about 4 characters per token) for the TPM budget. Pass
+    functions_characters, the length of the serialised functions, instead of functions when known.
+    """
+    characters = len(json.dumps(messages, default=str))
+    if functions_characters is not None:
+        characters += functions_characters
+    elif functions is not None:
+        characters += len(json.dumps(functions, default=str))
+    return characters // 4 + max_completion_tokens
@@ -0,0 +1,160 @@
+#####################
+# read_cache.py
+# In-process read-through cache used by firebase_utils for product details and reviews.
+# Every gunicorn worker holds its own cache; entries expire after a TTL and the least
+# recently used entries are evicted once the cache grows past its byte budget, counted in
+# Python memory. Invalidation only reaches the cache of the process that wrote, so other
+# workers keep serving their copy until its TTL runs out.
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def python_memory_size(value):
+    """
+    Approximate the memory held by a value: sys.getsizeof of it and of every object it
+    contains, each object counted once (interned keys shared between dicts are counted once).
+
+    Parameters:
+    - value: The value to size.
+
+    Returns:
+    - int: Size in bytes.
+    """
+    seen = set()
+    size = 0
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return size
+
+
+class ReadThroughCache:
+    """
+    Memory-bounded cache with TTL expiry and LRU eviction.
+
+    Args:
+    - name (str): Name used in stats and logs.
+    - max_bytes (int): Upper bound for the summed size of all cached values.
+    - ttl_seconds (float): Entries older than this are treated as misses.
+    - sizeof (callable, optional): Returns the approximate size in bytes of a value
+      (default python_memory_size).
+    """
+
+    def __init__(self, name, max_bytes, ttl_seconds, sizeof=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sizeof = sizeof or python_memory_size
+        self._entries = OrderedDict()  # key -> (expiresAt, size, value)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss or an expired entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expiresAt, size, value = entry
+            if expiresAt < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key):
+        """Return the cached value for key like get(), without counting a hit or miss or refreshing its LRU position."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return entry[2]
+
+    def set(self, key, value):
+        """Store value under key, evicting least recently used entries to stay within max_bytes."""
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            logging.info(f"{self.name} cache: value for {key} ({size} bytes) is larger than the cache, not cached")
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while self._entries and self.current_bytes + size > self.max_bytes:
+                oldestKey = next(iter(self._entries))
+                self._remove(oldestKey)
+                self.evictions += 1
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, size, value)
+            self.current_bytes += size
+
+    def get_or_load(self, key, loader, copy=None, use_cache=True):
+        """
+        Read-through lookup.
+
+        Args:
+        - key: Cache key.
+        - loader (callable): Called with no arguments on a miss. None results are not cached.
+        - copy (callable, optional): Applied to values going in and out, so callers can mutate what they get.
+        - use_cache (bool): False bypasses the cache for this call (the loaded value still refreshes it).
+
+        Returns:
+        - The cached or loaded value.
+        """
+        if use_cache:
+            value = self.get(key)
+            if value is not None:
+                return copy(value) if copy else value
+
+        value = loader()
+        if value is not None:
+            self.set(key, copy(value) if copy else value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'maxBytes': self.max_bytes,
+                'ttlSeconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRatio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
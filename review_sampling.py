@@ -0,0 +1,119 @@
+#####################
+# review_sampling.py
+# Stratified sampling of an investigation's reviews under a review or token budget.
+#
+# The sampling units are the reviews extraction would send (the ReviewTable representatives).
+# Strata are the (ASIN, rating) of each unit's first row. When the budget is smaller than the
+# number of strata, they are coarsened (ASIN only, then rating only, then a single stratum) until
+# it is not, so every unit belongs to a sampled stratum and the weights sum to the population.
+# Every stratum gets one unit, and the rest of the budget is split in proportion to the strata
+# sizes (largest remainders). Units are
+# drawn at random within each stratum, seeded from the investigation id, so a rerun draws the same
+# sample. Each sampled unit, and every near-duplicate it represents, stands for N_h / n_h units of
+# its stratum; quantification scales counts by that weight and adds confidence intervals.
+# A token budget is turned into a number of units at the mean tokens of a unit.
+import hashlib
+import random
+from array import array
+
+# Fields the strata are keyed by, finest first
+STRATA_LEVELS = (('asin', 'rating'), ('asin',), ('rating',), ())
+
+def normalize_sampling(sampling):
+    """
+    The sampling budget of a request: {'maxReviews': int or None, 'maxTokens': int or None}, or
+    None when it sets no positive integer budget (the run then processes every review). Booleans
+    are not budgets.
+    """
+    if not isinstance(sampling, dict):
+        return None
+    budget = {key: sampling.get(key) if type(sampling.get(key)) is int and sampling.get(key) > 0 else None for key in ('maxReviews', 'maxTokens')}
+    return budget if any(budget.values()) else None
+
+
+def sampling_seed(investigationId):
+    """Seed of an investigation's sample, stable across runs and processes."""
+    return int.from_bytes(hashlib.blake2b(str(investigationId).encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def _largest_remainder(total, sizes):
+    """Split total into integers proportional to sizes (rounding by largest remainder, ties to the first)."""
+    sizeSum = sum(sizes)
+    if not sizeSum:
+        return [0] * len(sizes)
+    quotas = [total * size / sizeSum for size in sizes]
+    shares = [int(quota) for quota in quotas]
+    for index in sorted(range(len(sizes)), key=lambda index: shares[index] - quotas[index])[:total - sum(shares)]:
+        shares[index] += 1
+    return shares
+
+
+def allocate_sample(strataSizes, sampleSize):
+    """
+    Units to draw from each stratum.
+
+    sampleSize must be at least the number of strata: every stratum gets one unit and the rest is
+    split in proportion to the strata sizes less one, which never exceeds a stratum.
+    """
+    if sampleSize < len(strataSizes):
+        raise ValueError(f"A sample of {sampleSize} cannot cover {len(strataSizes)} strata")
+    return [1 + share for share in _largest_remainder(sampleSize - len(strataSizes), [size - 1 for size in strataSizes])]
+
+
+def draw_stratified_sample(table, maxReviews=None, maxTokens=None, seed=0):
+    """
+    Restrict the extraction of a ReviewTable to a stratified sample within the budget.
+
+    Parameters:
+    - table (ReviewTable): The reviews; its sample and weights are set.
+    - maxReviews (int, optional): Most units to send.
+    - maxTokens (int, optional): Most review text tokens to send (on average).
+    - seed (int): Seed of the draw.
+
+    Returns:
+    - dict: The sampling report: 'population' and 'sampled' units, 'strata' and the fields they
+      are keyed by ('strataBy', coarser than ['asin', 'rating'] when the budget was smaller than the
+      number of (ASIN, rating) strata), the budget, and the review tokens of the population and of
+      the sample.
+    - None: If the budget covers every unit (nothing is sampled).
+    """
+    units = table.representatives
+    population = len(units)
+    populationTokens = sum(table.review_tokens(uid) for uid in units)
+    sampleSize = population
+    if maxReviews:
+        sampleSize = min(sampleSize, maxReviews)
+    if maxTokens and populationTokens > maxTokens:
+        sampleSize = min(sampleSize, max(1, maxTokens * population // populationTokens))
+    if sampleSize >= population:
+        return None
+
+    for strataBy in STRATA_LEVELS:
+        strata = {}
+        for uid in units:
+            row = table.rowByUid[uid]
+            fields = {'asin': table.asinCodes[row], 'rating': table.ratings[row]}
+            strata.setdefault(tuple(fields[field] for field in strataBy), []).append(uid)
+        if len(strata) <= sampleSize:
+            break
+    keys = sorted(strata)
+    allocation = allocate_sample([len(strata[key]) for key in keys], sampleSize)
+
+    rng = random.Random(seed)
+    weightByRepresentative = {}
+    for key, size in zip(keys, allocation):
+        weight = len(strata[key]) / size
+        for uid in rng.sample(strata[key], size):
+            weightByRepresentative[uid] = weight
+    table.set_sample(sorted(weightByRepresentative), array('d', [weightByRepresentative.get(representative, 0.0) for representative in table.representativeByUid]))
+
+    return {
+        'population': population,
+        'sampled': len(table.sample),
+        'strata': len(keys),
+        'strataBy': list(strataBy),
+        'maxReviews': maxReviews,
+        'maxTokens': maxTokens,
+        'populationTokens': populationTokens,
+        'sampledTokens': sum(table.review_tokens(uid) for uid in table.sample),
+    }
@@ -0,0 +1,291 @@
+#####################
+# review_table.py
+# Columnar store of an investigation's reviews, from loading through batching and tagging.
+#
+# Rows keep the load order. Each row is an (ASIN, review) pair with an id, an interned ASIN code
+# (into asins), an int rating (stdlib arrays) and a text. Variants of a parent product share a
+# review pool, so the same review arrives once per variant. Rows are deduplicated on a hash of the
+# review id and normalised text: every distinct review gets a dense uid, numbered in first-seen
+# order, and its first row represents it. Only uids are batched, so each review is sent to the LLM
+# once. With a near-duplicate threshold, distinct reviews are further clustered (near_duplicates.py)
+# and only each cluster's representative uid is batched; the other members are not sent.
+# Tags are kept per representative and fan back out to every member and every row. Statistics count
+# every member once, with its own rating, and once per ASIN in the per-ASIN breakdowns.
+# uid -> id, uid -> row and uid -> representative are list/array lookups. Batches are BatchViews of
+# representative uids, or of a sample of them (review_sampling.py), whose weights then scale the
+# statistics. Review dicts come back out only at the storage boundary: to_dicts() for
+# Firestore, to_columns() for checkpoints.
+import hashlib
+from array import array
+from collections.abc import Mapping
+
+from near_duplicates import NearDuplicateIndex
+from reviews_data_processing_utils import num_tokens_from_string, transform_rating_to_star_format
+
+
+class UidToIdMapping(Mapping):
+    """Read-only uid -> review id view of a ReviewTable, usable wherever a uid_to_id_mapping dict was."""
+
+    __slots__ = ('_ids',)
+
+    def __init__(self, table):
+        self._ids = table.idByUid
+
+    def __getitem__(self, uid):
+        if isinstance(uid, int) and 0 <= uid < len(self._ids):
+            return self._ids[uid]
+        raise KeyError(uid)
+
+    def __contains__(self, uid):
+        return isinstance(uid, int) and 0 <= uid < len(self._ids)
+
+    def __iter__(self):
+        return iter(range(len(self._ids)))
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class BatchView:
+    """Some uids (an int array) of a ReviewTable; iterates (uid, rating in star format, text) without copying the rows."""
+
+    __slots__ = ('table', '_uids')
+
+    def __init__(self, table, uids):
+        self.table = table
+        self._uids = uids
+
+    def __len__(self):
+        return len(self._uids)
+
+    def __iter__(self):
+        table = self.table
+        for uid in self._uids:
+            row = table.rowByUid[uid]
+            yield uid, transform_rating_to_star_format(table.ratings[row]), table.texts[row]
+
+    def uids(self):
+        return self._uids.tolist()
+
+
+class ReviewTable:
+    """
+    Reviews as columns: ids and texts lists, an interned ASIN column and int ratings and uids in arrays.
+
+    Build one with ReviewTable.from_reviews(reviews), or extend() an empty one as reviews arrive.
+
+    Args:
+    - nearDuplicateThreshold (float, optional): Similarity (0 to 1) from which distinct reviews are
+      collapsed into one representative; 0 or None keeps every distinct review.
+    """
+
+    def __init__(self, nearDuplicateThreshold=None):
+        self.idByUid = []              # uid -> review id
+        self.rowByUid = array('q')     # uid -> first row of the review
+        self.representativeByUid = array('q')  # uid -> uid of its near-duplicate cluster's representative
+        self.representatives = array('q')      # Representative uids, in uid order: the uids sent
+        self.tokensByUid = array('q')  # uid -> tokens of its text, -1 until counted
+        self.rowUids = array('q')      # row -> uid
+        self.asins = []                # ASIN code -> ASIN
+        self.asinCodes = array('q')    # row -> ASIN code
+        self.ratings = array('b')      # row -> rating
+        self.texts = []                # row -> text
+        self.tags = None               # Representative uid -> {category: [labels]}, once tagged
+        self.sample = None             # Representative uids sent when sampling, in uid order
+        self.weightByUid = None        # uid -> sampling weight of its representative (0 if not sampled)
+        self._uidByKey = {}
+        self._asinCodeByAsin = {}
+        self._nearDuplicates = NearDuplicateIndex(nearDuplicateThreshold) if nearDuplicateThreshold else None
+        self.uid_to_id_mapping = UidToIdMapping(self)
+
+    @classmethod
+    def from_reviews(cls, reviews, nearDuplicateThreshold=None):
+        table = cls(nearDuplicateThreshold)
+        table.extend(reviews)
+        return table
+
+    def __len__(self):
+        return len(self.texts)
+
+    @property
+    def uidCount(self):
+        return len(self.idByUid)
+
+    @staticmethod
+    def review_key(reviewId, text):
+        """Dedupe key of a review: a digest of its id and its text, lowercased with whitespace collapsed."""
+        normalised = ' '.join(str(text).lower().split())
+        return hashlib.blake2b(f"{reviewId}\0{normalised}".encode('utf-8'), digest_size=16).digest()
+
+    def extend(self, reviews):
+        """
+        Append review dicts ('id', 'rating', 'text' and optionally 'asin'); other fields are dropped.
+
+        Returns:
+        - tuple: The (start, stop) rows of the appended reviews.
+
+        Raises:
+        - ValueError: If a rating is not an integer from 0 to 127.
+        """
+        start = len(self.texts)
+        firstNewUid = len(self.idByUid)
+        for review in reviews:
+            reviewId = review['id']
+            key = self.review_key(reviewId, review['text'])
+            uid = self._uidByKey.get(key)
+            if uid is None:
+                uid = self._uidByKey[key] = len(self.idByUid)
+                self.idByUid.append(reviewId)
+                self.rowByUid.append(len(self.texts))
+                self.tokensByUid.append(-1)
+            asin = review.get('asin')
+            asinCode = self._asinCodeByAsin.get(asin)
+            if asinCode is None:
+                asinCode = self._asinCodeByAsin[asin] = len(self.asins)
+                self.asins.append(asin)
+            self.rowUids.append(uid)
+            self.asinCodes.append(asinCode)
+            try:
+                self.ratings.append(int(review['rating']))
+            except OverflowError:
+                raise ValueError(f"Rating {review['rating']} of review {reviewId} is out of range.")
+            self.texts.append(review['text'])
+
+        newUids = range(firstNewUid, len(self.idByUid))
+        if self._nearDuplicates is None:
+            representatives = newUids
+        else:
+            representatives = self._nearDuplicates.add([self.texts[self.rowByUid[uid]] for uid in newUids])
+        for uid, representative in zip(newUids, representatives):
+            self.representativeByUid.append(representative)
+            if representative == uid:
+                self.representatives.append(uid)
+        return start, len(self.texts)
+
+    def review_tokens(self, uid):
+        """Tokens of the text of uid, counted once."""
+        tokens = self.tokensByUid[uid]
+        if tokens < 0:
+            tokens = self.tokensByUid[uid] = num_tokens_from_string(self.texts[self.rowByUid[uid]], encoding_name="cl100k_base")
+        return tokens
+
+    def set_sample(self, uids, weightByUid):
+        """Send only the representative uids (sorted) and weight every uid's observations by weightByUid (an array('d'))."""
+        self.sample = array('q', uids)
+        self.weightByUid = weightByUid
+
+    def extraction_uids(self):
+        """The uids extraction sends: the sample when there is one, else every representative."""
+        return self.sample if self.sample is not None else self.representatives
+
+    def batches(self, max_tokens, start=0):
+        """
+        Split the extraction uids from position start onwards into consecutive BatchViews of at most
+        max_tokens tokens, as generate_batches() does with reviews (a review longer than max_tokens
+        gets a batch of its own).
+        """
+        uids = self.extraction_uids()
+        batches = []
+        batchStart = start
+        currentTokens = 0
+        for position in range(start, len(uids)):
+            reviewTokens = self.review_tokens(uids[position])
+            if position > batchStart and currentTokens + reviewTokens + 1 > max_tokens:
+                batches.append(BatchView(self, uids[batchStart:position]))
+                batchStart = position
+                currentTokens = reviewTokens
+            else:
+                currentTokens += reviewTokens + 1
+        if batchStart < len(uids):
+            batches.append(BatchView(self, uids[batchStart:]))
+        return batches
+
+    def batches_from_uids(self, batchUids):
+        """Rebuild BatchViews from the uid lists of their batches."""
+        return [BatchView(self, array('q', uids)) for uids in batchUids]
+
+    def uid_asins(self):
+        """
+        The distinct ASINs of every uid's rows, as numpy arrays: uid i's ASIN codes are
+        codes[offsets[i]:offsets[i + 1]].
+
+        Returns:
+        - tuple: (offsets, codes).
+        """
+        import numpy as np
+
+        asinCount = max(len(self.asins), 1)
+        pairs = np.unique(np.frombuffer(self.rowUids, dtype=np.int64) * asinCount + np.frombuffer(self.asinCodes, dtype=np.int64))
+        uids, codes = np.divmod(pairs, asinCount)
+        offsets = np.zeros(len(self.idByUid) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(uids, minlength=len(self.idByUid)), out=offsets[1:])
+        return offsets, codes
+
+    def cluster_members(self):
+        """
+        The member uids of every near-duplicate cluster, as numpy arrays: the members of the cluster
+        represented by uid i are members[offsets[i]:offsets[i + 1]], in uid order (none when i is
+        not a representative).
+
+        Returns:
+        - tuple: (offsets, members).
+        """
+        import numpy as np
+
+        representativeByUid = np.frombuffer(self.representativeByUid, dtype=np.int64)
+        offsets = np.zeros(len(self.idByUid) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(representativeByUid, minlength=len(self.idByUid)), out=offsets[1:])
+        return offsets, np.argsort(representativeByUid, kind='stable')
+
+    def dedupe_report(self):
+        """
+        What deduplication saved: rows, distinct reviews (uids), near-duplicate reviews collapsed into
+        a representative, the share of rows not sent and the review text tokens not sent, in all and
+        by the near-duplicate stage alone.
+        """
+        rows = len(self.texts)
+        uniqueReviews = len(self.idByUid)
+        representatives = len(self.representatives)
+        acquiredTokens = sum(self.review_tokens(uid) for uid in self.rowUids)
+        sentTokens = sum(self.review_tokens(uid) for uid in self.representatives)
+        return {
+            'rows': rows,
+            'uniqueReviews': uniqueReviews,
+            'duplicateRows': rows - uniqueReviews,
+            'nearDuplicateReviews': uniqueReviews - representatives,
+            'representatives': representatives,
+            'savingsRatio': round((rows - representatives) / rows, 4) if rows else 0.0,
+            'tokensSent': sentTokens,
+            'tokensSaved': acquiredTokens - sentTokens,
+            'nearDuplicateTokensSaved': sum(self.review_tokens(uid) for uid in range(uniqueReviews) if self.representativeByUid[uid] != uid),
+        }
+
+    def to_dicts(self):
+        """The reviews as dicts with 'id', 'asin', 'rating', 'text', 'uid' and, once tagged, 'tags'."""
+        reviews = []
+        for row in range(len(self.texts)):
+            uid = self.rowUids[row]
+            review = {'id': self.idByUid[uid], 'asin': self.asins[self.asinCodes[row]], 'rating': self.ratings[row], 'text': self.texts[row], 'uid': uid}
+            if self.tags is not None:
+                review['tags'] = self.tags.get(self.representativeByUid[uid], {})
+            reviews.append(review)
+        return reviews
+
+    def to_columns(self):
+        """JSON-serializable columns, one entry per row, for checkpoints."""
+        return {
+            'ids': [self.idByUid[uid] for uid in self.rowUids],
+            'asins': self.asins,
+            'asinCodes': self.asinCodes.tolist(),
+            'ratings': self.ratings.tolist(),
+            'texts': self.texts,
+        }
+
+    @classmethod
+    def from_columns(cls, columns, nearDuplicateThreshold=None):
+        asins = columns['asins']
+        return cls.from_reviews(
+            ({'id': reviewId, 'asin': asins[asinCode], 'rating': rating, 'text': text}
+             for reviewId, asinCode, rating, text in zip(columns['ids'], columns['asinCodes'], columns['ratings'], columns['texts'])),
+            nearDuplicateThreshold,
+        )
@@ -2,17 +2,25 @@
 # data_processing_utils.py
 
 import re
-from tiktoken import get_encoding
 import logging
 logging.basicConfig(level=logging.INFO)
-import numpy as np
-import pandas as pd
-import tiktoken
+from functools import lru_cache
+
+# tiktoken is imported, and its BPE file loaded, the first time a stage counts tokens rather than
+# at import. Images set TIKTOKEN_CACHE_DIR to a directory the BPE was downloaded to at build time.
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(encoding_name="cl100k_base"):
+    """Returns the tiktoken encoding, loading it on first use."""
+    import tiktoken
+    return tiktoken.get_encoding(encoding_name)
+
 
 def num_tokens_from_string(string: str, encoding_name="cl100k_base") -> int:
     """Returns the number of tokens in a text string."""
     try:
-        encoding = get_encoding(encoding_name)
+        encoding = get_tokenizer(encoding_name)
         return len(encoding.encode(string))
     except Exception as e:
         logging.error(f"Error counting tokens: {e}")
@@ -103,15 +111,8 @@ def add_uid_to_reviews(reviewsList):
         - dict: Dictionary mapping from 'uid' to 'id'.
     """
 
-    # Extract 'id' from each dictionary
-    ids = [review['id'] for review in reviewsList]
-
-    # Create DataFrame
-    id_uid_df = pd.DataFrame(ids, columns=['id'])
-    id_uid_df['uid'] = id_uid_df.index
-
-    # Create a mapping of 'id' to 'uid'
-    id_to_uid_mapping = id_uid_df.set_index('id')['uid'].to_dict()
+    # Create a mapping of 'id' to 'uid' (position in the list; a repeated id keeps its last position)
+    id_to_uid_mapping = {review['id']: index for index, review in enumerate(reviewsList)}
 
     # Initialize dictionary for 'uid' to 'id' mapping
     uid_to_id_mapping = {}
@@ -188,47 +189,256 @@ def aggregate_all_categories(data):
 
 
 
-def quantify_category_data(inputData):
-    processedData = {}
-    
-    for categoryKey, labels in inputData.items():
-        categoryTotalObservations = sum([len(labelData['uid']) for labelData in labels])
-        processedLabels = []
-        
-        for labelData in labels:
-            labelObservations = len(labelData['uid'])
-            
-            # Calculate label percentage
-            labelPercentage = (labelObservations / categoryTotalObservations) * 100 if categoryTotalObservations != 0 else 0
-            formattedLabelPercentage = int("{:.0f}".format(labelPercentage))
-            
-            # Count ratings 1-3 and 4-5
-            ratings_1_2_3_count = sum(1 for rating in labelData['rating'] if rating >= 1 and rating <= 3)
-            ratings_4_5_count = sum(1 for rating in labelData['rating'] if rating >= 4 and rating <= 5)
-            
-            # Calculate average rating
-            if len(labelData['rating']) != 0:
-                averageRating = sum(labelData['rating']) / len(labelData['rating'])
-                formattedAverageRating = float("{:.1f}".format(averageRating))
-                
-                processedLabelData = {
-                    'label': labelData['label'],
-                    'uid': labelData['uid'],
-                    'asin': list(set(labelData['asin'])),
-                    'numberOfObservations': labelObservations,
-                    'percentage': formattedLabelPercentage,
-                    'rating': formattedAverageRating,
-                    'negativeRatingsCount': ratings_1_2_3_count,
-                    'positiveRatingsCount': ratings_4_5_count
-                }
-                
-                processedLabels.append(processedLabelData)
-            else:
+CONFIDENCE_Z = 1.96  # 95% intervals
+
+
+def wilson_intervals(proportions, sampleSizes, z=CONFIDENCE_Z):
+    """
+    Wilson score intervals of proportions estimated from sampleSizes observations (arrays).
+
+    Returns:
+    - tuple: (low, high) arrays, in percent; (0, 100) where the sample size is 0.
+    """
+    import numpy as np
+
+    proportions = np.asarray(proportions, dtype=np.float64)
+    sampleSizes = np.asarray(sampleSizes, dtype=np.float64)
+    safeSizes = np.where(sampleSizes > 0, sampleSizes, 1)
+    denominator = 1 + z * z / safeSizes
+    centre = (proportions + z * z / (2 * safeSizes)) / denominator
+    margin = z * np.sqrt(np.maximum(proportions * (1 - proportions) / safeSizes + z * z / (4 * safeSizes * safeSizes), 0)) / denominator
+    low = np.where(sampleSizes > 0, np.clip(centre - margin, 0, 1), 0.0)
+    high = np.where(sampleSizes > 0, np.clip(centre + margin, 0, 1), 1.0)
+    return low * 100, high * 100
+
+
+def quantify_label_arrays(labelCategories, offsets, ratings, asinCodes, categoryCount, asinCount, asinOffsets=None, weights=None, byAsin=True):
+    """
+    Statistics of every label, overall and per ASIN, in one grouped pass over flat arrays.
+
+    Label i's observations (one per tagged review) are ratings[offsets[i]:offsets[i + 1]] and, by
+    default, asinCodes[offsets[i]:offsets[i + 1]]. With asinOffsets, observation j belongs to
+    several ASINs, asinCodes[asinOffsets[j]:asinOffsets[j + 1]], and counts once in each of them.
+    With weights (a sample), observation j stands for weights[j] reviews: counts are scaled up,
+    ratings are weighted means and percentages get confidence intervals.
+
+    Parameters:
+    - labelCategories (sequence of int): Category index of each label.
+    - offsets (sequence of int): Label boundaries, one more than there are labels.
+    - ratings (sequence of int): Rating of each observation.
+    - asinCodes (sequence of int): ASIN index of each observation (of each observation-ASIN pair with asinOffsets).
+    - categoryCount (int): Number of categories.
+    - asinCount (int): Number of ASINs.
+    - asinOffsets (sequence of int, optional): Boundaries of each observation's ASIN codes.
+    - weights (sequence of float, optional): Sampling weight of each observation.
+    - byAsin (bool): Whether to compute the per-ASIN statistics; without them asinCodes may be None.
+
+    Returns:
+    - dict: Per label (numpy arrays): 'count', 'percentage' of its category's observations, 'rating'
+      (mean), 'negative' (ratings 1-3) and 'positive' (ratings 4-5) counts; and 'byAsin', the same
+      statistics per (label, ASIN) pair that has observations, with its 'label' and 'asin' indexes.
+      Percentages by ASIN are of the category's observations for that ASIN. With weights, counts
+      are float estimates, and each level also has 'sampled' (observations in the sample) and
+      'percentageLow' / 'percentageHigh', a Wilson interval at the Kish effective sample size of
+      the category (of the category for that ASIN).
+    """
+    import numpy as np
+
+    labelCategories = np.asarray(labelCategories, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    ratings = np.asarray(ratings, dtype=np.int64)
+    labelCount = len(labelCategories)
+
+    counts = np.diff(offsets)
+    observationLabels = np.repeat(np.arange(labelCount), counts)
+    negative = (ratings >= 1) & (ratings <= 3)
+    positive = (ratings >= 4) & (ratings <= 5)
+
+    if weights is None:
+        def grouped(keys, size, observations=slice(None)):
+            return (
+                np.bincount(keys, minlength=size),
+                np.bincount(keys, weights=ratings[observations], minlength=size),
+                np.bincount(keys, weights=negative[observations], minlength=size).astype(np.int64),
+                np.bincount(keys, weights=positive[observations], minlength=size).astype(np.int64),
+            )
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+
+        def grouped(keys, size, observations=slice(None)):
+            observationWeights = weights[observations]
+            return (
+                np.bincount(keys, weights=observationWeights, minlength=size),
+                np.bincount(keys, weights=observationWeights * ratings[observations], minlength=size),
+                np.bincount(keys, weights=observationWeights * negative[observations], minlength=size),
+                np.bincount(keys, weights=observationWeights * positive[observations], minlength=size),
+            )
+
+    def percentages(values, totals):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(totals != 0, (values / np.where(totals != 0, totals, 1)) * 100, 0.0)
+
+    labelCounts, labelRatingSums, labelNegative, labelPositive = grouped(observationLabels, labelCount)
+    categoryTotals = np.bincount(labelCategories, weights=labelCounts, minlength=categoryCount)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats = {
+            'count': labelCounts,
+            'percentage': percentages(labelCounts, categoryTotals[labelCategories]),
+            'rating': labelRatingSums / np.where(labelCounts != 0, labelCounts, 1),
+            'negative': labelNegative,
+            'positive': labelPositive,
+        }
+
+    def intervals(percentage, totals, squaredTotals):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            effectiveSizes = np.where(squaredTotals > 0, totals * totals / np.where(squaredTotals > 0, squaredTotals, 1), 0.0)
+        return wilson_intervals(percentage / 100, effectiveSizes)
+
+    if weights is not None:
+        # Effective sample size of each category (and category-ASIN below): (sum w)^2 / sum w^2
+        squaredWeights = weights * weights
+        labelSquaredWeights = np.bincount(observationLabels, weights=squaredWeights, minlength=labelCount)
+        categorySquaredWeights = np.bincount(labelCategories, weights=labelSquaredWeights, minlength=categoryCount)
+        stats['sampled'] = np.bincount(observationLabels, minlength=labelCount)
+        stats['percentageLow'], stats['percentageHigh'] = intervals(stats['percentage'], categoryTotals[labelCategories], categorySquaredWeights[labelCategories])
+    if not byAsin:
+        return stats
+
+    # The same pass keyed by (label, ASIN)
+    asinCodes = np.asarray(asinCodes, dtype=np.int64)
+    if asinOffsets is None:
+        asinObservations = slice(None)
+    else:
+        asinObservations = np.repeat(np.arange(len(ratings)), np.diff(np.asarray(asinOffsets, dtype=np.int64)))
+    pairKeys = observationLabels[asinObservations] * asinCount + asinCodes
+    # Grouped over the (label, ASIN) pairs that occur, not a dense labels x ASINs table
+    pairs, pairIndex = np.unique(pairKeys, return_inverse=True)
+    pairCounts, pairRatingSums, pairNegative, pairPositive = grouped(pairIndex, len(pairs), asinObservations)
+    present = np.flatnonzero(pairCounts)
+    pairLabels, pairAsins = np.divmod(pairs[present], asinCount) if asinCount else (pairs[present], pairs[present])
+    categoryAsinKeys = labelCategories[pairLabels] * asinCount + pairAsins
+    categoryAsinTotals = np.bincount(categoryAsinKeys, weights=pairCounts[present], minlength=categoryCount * asinCount)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pairStats = {
+            'label': pairLabels,
+            'asin': pairAsins,
+            'count': pairCounts[present],
+            'percentage': percentages(pairCounts[present], categoryAsinTotals[categoryAsinKeys]),
+            'rating': pairRatingSums[present] / pairCounts[present],
+            'negative': pairNegative[present],
+            'positive': pairPositive[present],
+        }
+    stats['byAsin'] = pairStats
+    if weights is None:
+        return stats
+
+    pairSquaredWeights = np.bincount(pairIndex, weights=squaredWeights[asinObservations], minlength=len(pairs))[present]
+    categoryAsinSquaredWeights = np.bincount(categoryAsinKeys, weights=pairSquaredWeights, minlength=categoryCount * asinCount)
+    pairStats['sampled'] = np.bincount(pairIndex, minlength=len(pairs))[present]
+    pairStats['percentageLow'], pairStats['percentageHigh'] = intervals(pairStats['percentage'], categoryAsinTotals[categoryAsinKeys], categoryAsinSquaredWeights[categoryAsinKeys])
+    return stats
+
+
+def format_counts(counts):
+    """Estimated (float) counts rounded half to even, as a list of ints."""
+    import numpy as np
+
+    return np.rint(counts).astype(np.int64).tolist()
+
+
+def format_percentages(percentages):
+    """Percentages rounded as int("{:.0f}".format(p)) rounds them (half to even), as a list of ints."""
+    import numpy as np
+
+    return np.rint(percentages).astype(np.int64).tolist()
+
+
+def format_ratings(ratings):
+    """Ratings rounded as float("{:.1f}".format(r)) rounds them; each distinct value is formatted once."""
+    import numpy as np
+
+    distinct, inverse = np.unique(ratings, return_inverse=True)
+    formatted = [float("{:.1f}".format(rating)) for rating in distinct.tolist()]
+    return [formatted[index] for index in inverse.tolist()]
+
+
+def format_label_statistics(levelStats):
+    """
+    Frontend fields of one level of quantify_label_arrays() statistics (the labels, or 'byAsin'),
+    one dict per entry: 'numberOfObservations', 'percentage', 'rating', 'negativeRatingsCount' and
+    'positiveRatingsCount'; for a sample, counts are rounded estimates and 'sampledObservations' and
+    'percentageInterval' ([low, high]) are added.
+    """
+    sampled = 'sampled' in levelStats
+    formatCount = format_counts if sampled else (lambda counts: counts.tolist())
+    keys = ['numberOfObservations', 'percentage', 'rating', 'negativeRatingsCount', 'positiveRatingsCount']
+    columns = [
+        formatCount(levelStats['count']), format_percentages(levelStats['percentage']), format_ratings(levelStats['rating']),
+        formatCount(levelStats['negative']), formatCount(levelStats['positive']),
+    ]
+    if sampled:
+        keys += ['sampledObservations', 'percentageInterval']
+        columns += [levelStats['sampled'].tolist(), [list(interval) for interval in zip(format_percentages(levelStats['percentageLow']), format_percentages(levelStats['percentageHigh']))]]
+    return [dict(zip(keys, values)) for values in zip(*columns)]
+
+
+def quantify_category_data(inputData, byAsin=True):
+    """
+    Count observations, percentages, mean ratings and negative/positive counts of every label.
+
+    Parameters:
+    - inputData (dict): Category to list of label dicts with 'label', 'uid', 'rating' and 'asin'
+      lists (one entry per observation) and, for a sample, a 'weight' list (reviews each
+      observation stands for, 1 when missing).
+    - byAsin (bool): Whether to add the per-ASIN breakdowns; callers that do not need them skip
+      that pass.
+
+    Returns:
+    - dict: Category to list of label dicts with 'label', 'uid', 'asin' (distinct, sorted),
+      'numberOfObservations', 'percentage', 'rating', 'negativeRatingsCount', 'positiveRatingsCount'
+      and, with byAsin, 'byAsin' (the same statistics per ASIN). Labels without observations are
+      left out. With weights, counts are scaled up and every entry also has 'sampledObservations'
+      and 'percentageInterval' (see format_label_statistics).
+    """
+    import numpy as np
+
+    categories = list(inputData)
+    labelRefs, labelCategories, labelSizes, ratings, asins, weights = [], [], [0], [], [], []
+    weighted = any('weight' in labelData for labels in inputData.values() for labelData in labels)
+    for categoryIndex, categoryKey in enumerate(categories):
+        for labelData in inputData[categoryKey]:
+            if len(labelData['rating']) == 0:
                 # Skip if no ratings
                 continue
-        
-        processedData[categoryKey] = processedLabels
-    
+            labelRefs.append((categoryKey, labelData))
+            labelCategories.append(categoryIndex)
+            labelSizes.append(len(labelData['rating']))
+            ratings.extend(labelData['rating'])
+            if byAsin:
+                asins.extend(labelData['asin'])
+            if weighted:
+                weights.extend(labelData.get('weight') or [1.0] * len(labelData['rating']))
+
+    asinIndex = {asin: code for code, asin in enumerate(dict.fromkeys(asins))}
+    asinCodes = np.fromiter(map(asinIndex.__getitem__, asins), dtype=np.int64, count=len(asins)) if byAsin else None
+    stats = quantify_label_arrays(labelCategories, np.cumsum(labelSizes), ratings, asinCodes, len(categories), len(asinIndex), weights=weights if weighted else None, byAsin=byAsin)
+
+    breakdowns = None
+    if byAsin:
+        asinNames = list(asinIndex)
+        breakdowns = [[] for _ in labelRefs]
+        pairStats = stats['byAsin']
+        for label, asin, statistics in zip(pairStats['label'].tolist(), pairStats['asin'].tolist(), format_label_statistics(pairStats)):
+            breakdowns[label].append({'asin': asinNames[asin], **statistics})
+
+    processedData = {categoryKey: [] for categoryKey in categories}
+    for index, statistics in enumerate(format_label_statistics(stats)):
+        categoryKey, labelData = labelRefs[index]
+        entry = {'label': labelData['label'], 'uid': labelData['uid'], 'asin': sorted(set(labelData['asin'])), **statistics}
+        if byAsin:
+            entry['byAsin'] = breakdowns[index]
+        processedData[categoryKey].append(entry)
     return processedData
 
 
@@ -236,7 +446,12 @@ def quantify_category_data(inputData):
 
 
 
+@lru_cache(maxsize=None)
 def export_functions_for_reviews():
+    """
+    Function schemas of the extraction, healing and aggregation prompts, built once per process
+    (function_schemas.py). The returned schemas are shared: treat them as read-only.
+    """
     marketFunctions = [
                 {
                     "parameters": {
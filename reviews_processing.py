@@ -5,91 +5,188 @@ import asyncio
 from tqdm import tqdm
 import time
 import logging
-import pandas as pd
 logging.basicConfig(level=logging.INFO)
 import json
 
-import aiohttp
 import os
-import tiktoken
-import nest_asyncio
-nest_asyncio.apply()
 
 
-from reviews_data_processing_utils import generate_batches, add_uid_to_reviews, aggregate_all_categories,  quantify_category_data, export_functions_for_reviews
-from firebase_utils import get_clean_reviews , write_insights_to_firestore,  FirestoreClient, PubSubClient, GAEClient, update_investigation_status
-from openai_utils import chat_completion_request, get_completion_list_multifunction, ProgressLog, get_completion
+from reviews_data_processing_utils import aggregate_all_categories, num_tokens_from_string
+from firebase_utils import get_clean_reviews , write_insights, write_clusters_to_firestore, InvestigationStatusTracker, get_investigation_checkpoint
+from openai_utils import chat_completion_request, get_completion_list_multifunction, ProgressLog, get_completion, get_embeddings
+from event_loop import run_coroutine, get_http_session
+from llm_scheduler import run_as_tenant, DEFAULT_PRIORITY
+from profiler import begin_stage, end_stage, add_stage_items
+from postprocessing import postprocess_extraction_results
+from review_table import BatchView, ReviewTable
+from function_schemas import get_function_schemas, get_schema_version
+from near_duplicates import NEAR_DUPLICATE_THRESHOLD
+from review_sampling import draw_stratified_sample, sampling_seed
+from aggregation_tree import AGGREGATION_CHUNK_MAX_TOKENS, aggregation_content, tree_reduce
+from label_consolidation import consolidate_labels, consolidate_labels_offline
 
-try:
-    db = FirestoreClient.get_instance()
-except Exception as e:
-    logging.error(f"Error initializing Firestore: {e}")
 
-try:
-    publisher, subscriber, project_id, topic_id, subscription_id, topic_path, subscription_path = PubSubClient.get_instance()
-except Exception as e:
-    logging.error(f"Error initializing Pub/Sub: {e}")
+# %%
+EXTRACTION_GPT_MODEL = 'gpt-3.5-turbo-0125'
+EXTRACTION_BATCH_MAX_TOKENS = 6000
+# 'embedding': consolidate the labels locally and only have the model name the groups (label_consolidation.py);
+# 'local': group them on the CPU without network calls, naming each group by its most central label;
+# 'llm': have the model merge the labels (aggregation_tree.py). Embedding and local fall back to llm for a category they cannot consolidate.
+AGGREGATION_MODE = os.getenv('AGGREGATION_MODE', 'embedding')
 
-try:
-    GAEClient.get_instance()
-except Exception as e:
-    logging.error(f"Error initializing GAE: {e}")
 
+def run_scheduled(coro, tenant=None):
+    """Run coro on the background event loop, with its GPT calls queued under tenant (see llm_scheduler.py)."""
+    return run_coroutine(run_as_tenant(coro, **tenant) if tenant else coro)
 
-# %%
-def process_reviews_with_gpt(reviewsList):
+
+def build_extraction_content(batch):
+    """Build the extraction messages for a batch of (uid, rating, text) tuples, e.g. a BatchView."""
+    batch_review = f"\n\n <Review uIds>  will be followed by <Review Rating> and than by  `review text`:"
+    batch_review += "\n\n".join([f"<{review_id}>\n,<{review_rating}>\n,`{review_text}`" for review_id, review_rating, review_text in batch])
+    return [
+        {"role": "user", "content": batch_review},
+    ]
+
+
+def get_extraction_functions():
+    """Return the functions run on every batch and the matching forced function calls."""
+    schemas = get_function_schemas()
+    return [schemas['market'], schemas['extractJobs']], [{"name": "market"}, {"name": "extractJobs"}]
+
+
+def get_reviews_checkpoint(investigationId, sampling=None):
+    """Return the stage checkpoints of an investigation (None when disabled), keyed to the extraction settings, function schemas and sampling budget."""
+    return get_investigation_checkpoint(investigationId, config={'model': EXTRACTION_GPT_MODEL, 'batchMaxTokens': EXTRACTION_BATCH_MAX_TOKENS, 'schemaVersion': get_schema_version(), 'nearDuplicateThreshold': NEAR_DUPLICATE_THRESHOLD, 'sampling': sampling})
+
+
+def save_batches_checkpoint(checkpoint, reviews, batches):
+    """Checkpoint the uid of every row of the ReviewTable reviews and the uids of every batch (BatchViews)."""
+    return checkpoint.save('batches', {'uids': reviews.rowUids.tolist(), 'batches': [batch.uids() for batch in batches]})
+
+
+def restore_batches_checkpoint(checkpoint, reviews):
+    """
+    Rebuild the batches of the ReviewTable reviews from their checkpoint.
+
+    Returns:
+    - list: BatchViews of the reviews.
+    - None: If there is no batches checkpoint for these reviews.
+    """
+    savedBatches = checkpoint.get('batches')
+    if savedBatches is None or savedBatches['uids'] != reviews.rowUids.tolist():
+        return None
+    # Batches of other near-duplicate representatives (or another sample) would tag the wrong clusters
+    if [uid for batchUids in savedBatches['batches'] for uid in batchUids] != reviews.extraction_uids().tolist():
+        return None
+    return reviews.batches_from_uids(savedBatches['batches'])
+
+
+async def run_checkpointed_extraction(contentList, functionsList, functionsCallList, checkpoint, savedResponses):
+    """
+    Run every extraction function on every batch, skipping the calls in savedResponses and
+    checkpointing each new response as it arrives.
+
+    Returns:
+    - list: Responses in get_completion_list_multifunction() order.
+    """
+    semaphore = asyncio.Semaphore(6)
+    session = get_http_session('openai')
+    progress_log = ProgressLog(len(functionsList) * len(contentList) - len(savedResponses))
+
+    async def extract(unitKey, content, functionIndex):
+        if unitKey in savedResponses:
+            return savedResponses[unitKey]
+        response = await get_completion(content, session, semaphore, progress_log, functions=functionsList[functionIndex], function_call=functionsCallList[functionIndex], GPT_MODEL=EXTRACTION_GPT_MODEL)
+        if response is not None:
+            await asyncio.to_thread(checkpoint.save, 'extraction', response, unitKey)
+        return response
+
+    return await asyncio.gather(*[extract(f"{functionIndex}-{batchIndex}", content, functionIndex) for functionIndex in range(len(functionsList)) for batchIndex, content in enumerate(contentList)])
+
+
+def process_reviews_with_gpt(reviewsList, tenant=None, checkpoint=None):
     """
     Process reviews using GPT and extract insights.
 
     Parameters:
-    - reviewsList (list): List of reviews to be processed.
-    - db: Firestore database instance.
+    - reviewsList (ReviewTable or list): Reviews to be processed; a list of review dicts is loaded into a ReviewTable.
+    - tenant (dict, optional): tenantId, userId and priority the GPT calls are scheduled under (see llm_scheduler.py).
+    - checkpoint (InvestigationCheckpoint, optional): Stage checkpoints to resume from and save to;
+      reviewsList must then be the checkpointed cleaned reviews.
 
     Returns:
-    - list: Updated reviews list with extracted insights.
+    - tuple: The ReviewTable tagged with the extracted insights, the frontend output per category
+      and the per-ASIN breakdowns ((None, None, None) on error).
     """
 
     print("started process_reviews_with_gpt")
     try:
+        begin_stage('clean', items=len(reviewsList))
         # Allocate short Ids to reviews
-        updatedReviewsList, uid_to_id_mapping = add_uid_to_reviews(reviewsList)
+        reviews = reviewsList if isinstance(reviewsList, ReviewTable) else ReviewTable.from_reviews(reviewsList, NEAR_DUPLICATE_THRESHOLD)
 
         # Prepare Review Batches
-        reviewBatches = generate_batches(updatedReviewsList, max_tokens=6000)
-        
+        begin_stage('batch')
+        reviewBatches = restore_batches_checkpoint(checkpoint, reviews) if checkpoint is not None else None
+        if reviewBatches is None:
+            reviewBatches = reviews.batches(EXTRACTION_BATCH_MAX_TOKENS)
+            if checkpoint is not None:
+                save_batches_checkpoint(checkpoint, reviews, reviewBatches)
+        add_stage_items(len(reviewBatches))
+
         # Generate Content List for Batches
-        contentList = []
-        for batch in reviewBatches:
-            batch_review = f"\n\n <Review uIds>  will be followed by <Review Rating> and than by  `review text`:"
-            batch_review += "\n\n".join([f"<{review_id}>\n,<{review_rating}>\n,`{review_text}`" for review_id, review_rating, review_text in batch])
-            
-            messages = [
-                {"role": "user", "content": batch_review},
-            ]
-            contentList.append(messages)
-        
-        # DECLARE FUNCTIONS 
-        marketFunctions,  extractJobsFunctions, marketResponseHealFunction, useCaseFunction, productComparisonFunction, featureRequestFunction, painPointsFunction, usageFrequencyFunction, usageTimeFunction, usageLocationFunction, customerDemographicsFunction, functionalJobFunction, socialJobFunction, emotionalJobFunction, supportingJobFunction = export_functions_for_reviews()
+        contentList = [build_extraction_content(batch) for batch in reviewBatches]
 
         # Check if contentList is None or empty
         if contentList is None or not contentList:
             raise ValueError("contentList is None or empty")
 
-        # print(contentList)
-
         print("before run GPT Calls")
         # Run GPT Calls for the Market function on the batches
+        functionsList, functionsCallList = get_extraction_functions()
 
-        functionsList = [marketFunctions, extractJobsFunctions]
-        functionsCallList = [{"name": "market"}, {"name": "extractJobs"}]
-        GPT_MODEL = 'gpt-3.5-turbo-0125'
+        begin_stage('extract', items=len(contentList) * len(functionsList))
+        savedResponses = checkpoint.get_stage('extraction') if checkpoint is not None else {}
+        if savedResponses:
+            print(f"Resuming extraction: {len(savedResponses)} of {len(contentList) * len(functionsList)} responses checkpointed")
 
         # Get responses from GPT
         async def main_for_data_extraction():
-            responses = await get_completion_list_multifunction(contentList, functions_list=functionsList, function_calls_list=functionsCallList, GPT_MODEL=GPT_MODEL)
+            if checkpoint is not None:
+                return await run_checkpointed_extraction(contentList, functionsList, functionsCallList, checkpoint, savedResponses)
+            responses = await get_completion_list_multifunction(contentList, functions_list=functionsList, function_calls_list=functionsCallList, GPT_MODEL=EXTRACTION_GPT_MODEL)
             return responses
 
-        responses = asyncio.run(main_for_data_extraction())
+        responses = run_scheduled(main_for_data_extraction(), tenant)
+    except Exception as e:
+        logging.error(f"Error in process_reviews_with_gpt: {e}")
+        return None, None, None  # Return None in case of error
+
+    return finish_reviews_processing(reviews, reviews.uid_to_id_mapping, responses, tenant=tenant, checkpoint=checkpoint)
+
+
+def finish_reviews_processing(reviews, uid_to_id_mapping, responses, tenant=None, checkpoint=None):
+    """
+    Aggregate the extraction responses per category and build the tagged reviews and frontend output.
+
+    Parameters:
+    - reviews (ReviewTable): The reviews.
+    - uid_to_id_mapping (Mapping): uid to review id.
+    - responses (list): Extraction responses, for every function in turn, one per batch.
+    - tenant (dict, optional): Scheduling tenant of the aggregation calls.
+    - checkpoint (InvestigationCheckpoint, optional): Resumes and saves the aggregated categories
+      and the aggregation result of each category.
+
+    Returns:
+    - tuple: Tagged ReviewTable, frontend output and per-ASIN breakdowns ((None, None, None) on error).
+    """
+    try:
+        begin_stage('aggregate', items=len(responses or []))
+        # DECLARE FUNCTIONS (built once per process, see function_schemas.py)
+        schemas = get_function_schemas()
+        marketResponseHealFunction = schemas['marketResponseHeal']
+        GPT_MODEL = EXTRACTION_GPT_MODEL
 
         print(responses)
 
@@ -117,24 +214,19 @@ def process_reviews_with_gpt(reviewsList):
                 pass
 
         # Aggregate the responses
-        aggregatedResponses = aggregate_all_categories(evalResponses)
+        if checkpoint is not None and checkpoint.has('aggregatedCategories'):
+            aggregatedResponses = checkpoint.get('aggregatedCategories')
+        else:
+            aggregatedResponses = aggregate_all_categories(evalResponses)
+            if checkpoint is not None:
+                checkpoint.save('aggregatedCategories', aggregatedResponses)
 
 
         print("after aggregate all categories")
 
         functionMapping = {
-            "useCase": useCaseFunction,
-            "productComparison": productComparisonFunction,
-            "featureRequest": featureRequestFunction,
-            "painPoints": painPointsFunction,
-            "usageFrequency": usageFrequencyFunction,
-            "usageTime": usageTimeFunction,
-            "usageLocation": usageLocationFunction,
-            "customerDemographics": customerDemographicsFunction,
-            "functionalJob": functionalJobFunction,
-            "socialJob": socialJobFunction,
-            "emotionalJob": emotionalJobFunction,
-            "supportingJob": supportingJobFunction
+            key: schemas[key]
+            for key in ("useCase", "productComparison", "featureRequest", "painPoints", "usageFrequency", "usageTime", "usageLocation", "customerDemographics", "functionalJob", "socialJob", "emotionalJob", "supportingJob")
         }
 
         
@@ -142,26 +234,48 @@ def process_reviews_with_gpt(reviewsList):
         async def main_for_data_aggregation():
             
             semaphore = asyncio.Semaphore(10)  # Adjust as needed
-            async with aiohttp.ClientSession() as session:
-                functionsResponses = []
-                for key, function in functionMapping.items():
-                    if key in aggregatedResponses:
-                        contentList = [
-                            {"role": "user", "content": f"You are the most awesome product researcher. Please process the results for key: {key}.  \n Aggregated observations are here: {aggregatedResponses[key]}"}
-                        ]
-                        print({"name": function[0]["name"]})
-
-                        # Replace with the async call
-                        progress_log = ProgressLog(len(contentList))
-                        response = await get_completion(contentList, session, semaphore, progress_log, functions=function, function_call={"name": function[0]["name"]}, TEMPERATURE=0.3)
-                        
-                        functionsResponses.append(response)
-
+            session = get_http_session('openai')
+            progress_log = ProgressLog(0)
+
+            async def aggregate_category(key, function):
+                if checkpoint is not None and checkpoint.has('aggregation', key):
+                    return checkpoint.get('aggregation', key)
+                functionCall = {"name": function[0]["name"]}
+                print(functionCall)
+
+                async def complete(contentList):
+                    progress_log.total += 1
+                    return await get_completion(contentList, session, semaphore, progress_log, functions=function, function_call=functionCall, TEMPERATURE=0.3)
+
+                response = None
+                if AGGREGATION_MODE == 'embedding':
+                    # Labels grouped locally, one call to name the groups (label_consolidation.py)
+                    response = await consolidate_labels(key, aggregatedResponses[key], get_embeddings, complete, function[0]["name"])
+                elif AGGREGATION_MODE == 'local':
+                    response = await asyncio.to_thread(consolidate_labels_offline, key, aggregatedResponses[key], function[0]["name"])
+                if response is None:
+                    # One call when the observations fit in a prompt, else a tree of calls (aggregation_tree.py)
+                    contentList = aggregation_content(key, aggregatedResponses[key])
+                    if num_tokens_from_string(contentList[0]["content"], encoding_name="cl100k_base") <= AGGREGATION_CHUNK_MAX_TOKENS:
+                        response = await complete(contentList)
+                    else:
+                        response, levels = await tree_reduce(key, aggregatedResponses[key], complete, function[0]["name"])
+                        print(f"Aggregated {key} in {levels} levels")
+                if checkpoint is not None and response is not None:
+                    await asyncio.to_thread(checkpoint.save, 'aggregation', response, key)
+                return response
+
+            # Categories are aggregated concurrently; every category finishes (and is checkpointed) before a failure is raised
+            functionsResponses = await asyncio.gather(*[aggregate_category(key, function) for key, function in functionMapping.items() if key in aggregatedResponses], return_exceptions=True)
+            for response in functionsResponses:
+                if isinstance(response, BaseException):
+                    raise response
             return functionsResponses
 
-        functionsResponses = asyncio.run(main_for_data_aggregation())
+        functionsResponses = run_scheduled(main_for_data_aggregation(), tenant)
 
         print("responses received")
+        begin_stage('postProcess', items=len(reviews))
         
         # Processes Results
         processedResults = []
@@ -196,317 +310,241 @@ def process_reviews_with_gpt(reviewsList):
 
         
 
-        def filter_uids(processedResults, uid_to_id_mapping):
-            filteredResults = []
-
-            for result_dict in processedResults:
-                if not isinstance(result_dict, dict):
-                    continue
-                new_dict = {}
-                for key, value in result_dict.items():
-                    new_value_list = []
-                    for sub_dict in value:
-                        filtered_uids = [uid for uid in sub_dict['uid'] if uid in uid_to_id_mapping.keys()]
-                        if filtered_uids:
-                            new_sub_dict = sub_dict.copy()
-                            new_sub_dict['uid'] = filtered_uids
-                            new_value_list.append(new_sub_dict)
-                    new_dict[key] = new_value_list
-                filteredResults.append(new_dict)
-            return filteredResults
-
-
-
-        filteredResults = filter_uids(processedResults, uid_to_id_mapping)
-
-        
-
-        # Initialize an empty list to hold the new filtered results
-        newFilteredResults = []
-
-        # Loop through each dictionary in the original filteredResults list
-        for result_dict in filteredResults:
-            # Create a new dictionary to store the de-duplicated lists for each key
-            new_dict = {}
-            
-            for key, value_list in result_dict.items():
-                # Initialize a set to keep track of seen items
-                seen = set()
-                
-                # Initialize a list to keep the unique items
-                unique_list = []
-                
-                for item in value_list:
-                    # Serialize the dictionary to a string to make it hashable
-                    item_str = json.dumps(item, sort_keys=True)
-                    
-                    # Add item to unique_list if not seen before
-                    if item_str not in seen:
-                        unique_list.append(item)
-                        seen.add(item_str)
-                
-                # Update the list for the current key with the de-duplicated list
-                new_dict[key] = unique_list
-            
-            # Add the new dictionary with all de-duplicated lists to the new filtered list
-            newFilteredResults.append(new_dict)
-
-
-        # Update filteredResults with the de-duplicated results
-        filteredResults = newFilteredResults
-
-
-        ##################
-        
-
-        # Rezultatul este o lista de dictionare in loc de un dictionar
-
-
-        
-        # Creeaza un dictionar cu un array de dictionare fiecare
-        print("changing dict structure")
-        processedData = {}
-        for item in filteredResults:
-            try:
-                key = list(item.keys())[0]
-                value = list(item.values())[0]
-                processedData[key] = value
-            except IndexError:
-                try:
-                    new_item = item[0]
-                    key = list(new_item.keys())[0]
-                    value = list(new_item.values())[0]
-                    processedData[key] = value
-                except IndexError:
-                    print("Error: Item does not have keys or values.")
-                    print(item)
-                except Exception as e:
-                    print(f"Unexpected error: {e}")
-                    print(item)
-            except Exception as e:
-                print(f"Unexpected error: {e}")
-                print(item)
-
-        
-
-        # Redenumeste cheile in 'header;
-        updatedOuterData = {}
-        for outer_key, inner_list in processedData.items():
-            updatedInnerList = []
-            for inner_dict in inner_list:
-                updatedInnerDict = {}
-
-                for key, value in inner_dict.items():
-                    if key == 'headerOfCategory (7 words)' or key == 'objectiveStatement' or key == 'headerOfCategory':
-                        new_key = 'label'
-                    else:
-                        new_key = key
-                    updatedInnerDict[new_key] = value
-                
-                updatedInnerList.append(updatedInnerDict)
-            updatedOuterData[outer_key] = updatedInnerList
-        processedData = updatedOuterData.copy()
-
-
-        ###############
-        
-        print("changing dict structure for reviews comprehension")
-        result = {}
-        for key, value_list in processedData.items():
-            try:
-                for value in value_list:
-                    try:
-                        label = value['headerOfCategory (7 words)']
-                    except:
-                        try:
-                            label = value['objectiveStatement']
-                        except:
-                            try:
-                                label = value['label']
-                            except:
-                                pass
-                    for uid in value['uid']:
-                        if uid in result:
-                            if key in result[uid]:
-                                result[uid][key].append(label)
-                            else:
-                                result[uid][key] = [label]
-                        else:
-                            result[uid] = {key: [label]}
-            except KeyError as e:
-                print(f"KeyError: Missing key {e} in dictionary.")
-            
-        # Sort the result dictionary by 'uid' keys
-        sortedResult = {k: result[k] for k in sorted(result)}
-
-
-
-
-        
-        print("Adding tags to reviews")
-        tagedReviews = updatedReviewsList.copy()
-
-        for review in tagedReviews:
-            # Get uid from the review
-            uid = review.get('uid')
-            # Fetch tags for the given uid from sortedResults
-            tags = sortedResult.get(uid, {})
-            # Add tags to the review
-            review['tags'] = tags
-
-
-        
-
-        # get the asin and review text for each uid
-        uid_to_asin = {review['uid']: review['asin'] for review in tagedReviews}
-        uid_to_text = {review['uid']: review['text'] for review in tagedReviews}
-        uid_to_rating = {review['uid']: review['rating'] for review in tagedReviews}
-
-
-        
-        # Add asin to each uid
-        print("Adding asin to each uid")
-        for key, value_list in processedData.items():
-            for item in value_list:
-                item['asin'] = [uid_to_asin[uid] for uid in item['uid']]
-
-
-        
-
-        # Add rating to each uid
-        for key, value_list in processedData.items():
-            for item in value_list:
-                item['rating'] = [int(uid_to_rating[uid]) for uid in item['uid']]
+        # Filter, deduplicate, label, tag and quantify in one pass (postprocessing.py)
+        return postprocess_extraction_results(processedResults, reviews, uid_to_id_mapping)
 
+    except Exception as e:
+        logging.error(f"Error in finish_reviews_processing: {e}")
+        return None, None, None  # Return None in case of error
 
 
-        
-        print("Quantifying data")
-        try:
-            quantifiedData = quantify_category_data(processedData)
-        except Exception as e:
-            print(f"Error in quantifying data: {e}")
-            quantifiedData = {}
+class StreamingReviewExtractor:
+    """
+    Extraction that starts while reviews are still being acquired.
 
+    add_reviews() appends reviews to a ReviewTable and packs them into token-bounded batches like
+    ReviewTable.batches(); each full batch has its extraction calls started right away. finish()
+    sends the last batch and returns the responses in get_completion_list_multifunction() order,
+    to be passed to finish_reviews_processing() with reviews and uid_to_id_mapping.
+    Runs on the background event loop: call add_reviews() from a coroutine on it.
+    """
 
+    def __init__(self, max_tokens=EXTRACTION_BATCH_MAX_TOKENS, GPT_MODEL=EXTRACTION_GPT_MODEL):
+        self.max_tokens = max_tokens
+        self.GPT_MODEL = GPT_MODEL
+        self.functionsList, self.functionsCallList = get_extraction_functions()
+        self.reviews = ReviewTable(NEAR_DUPLICATE_THRESHOLD)
+        self.uid_to_id_mapping = self.reviews.uid_to_id_mapping
+        self.batches = []  # BatchViews of every batch sent
+        self._batchStart = 0  # Position in reviews.representatives of the first review of the batch being filled
+        self._currentTokens = 0
+        self._tasks = [[] for _ in self.functionsList]  # Per function, one task per batch
+        self._semaphore = None
+        self._progressLog = ProgressLog(0)
+
+    def add_reviews(self, reviews):
+        """Add acquired reviews (dicts with 'id', 'text' and 'rating'), sending every batch that fills up."""
+        representatives = self.reviews.representatives
+        firstNew = len(representatives)
+        self.reviews.extend(reviews)
+        # Only reviews not seen before (on another variant), nor near-duplicates of one, are batched
+        for position in range(firstNew, len(representatives)):
+            reviewTokens = self.reviews.review_tokens(representatives[position])
+            if position > self._batchStart and self._currentTokens + reviewTokens + 1 > self.max_tokens:
+                self._send_batch(position)
+            self._currentTokens += reviewTokens + 1
+
+    def _send_batch(self, stop):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(6)
+        batch = BatchView(self.reviews, self.reviews.representatives[self._batchStart:stop])
+        content = build_extraction_content(batch)
+        session = get_http_session('openai')
+        for index, functions in enumerate(self.functionsList):
+            self._progressLog.total += 1
+            self._tasks[index].append(asyncio.ensure_future(get_completion(content, session, self._semaphore, self._progressLog, functions=functions, function_call=self.functionsCallList[index], GPT_MODEL=self.GPT_MODEL)))
+        self.batches.append(batch)
+        self._batchStart = stop
+        self._currentTokens = 0
+
+    async def finish(self):
+        """Send the last batch and wait for every extraction call."""
+        if len(self.reviews.representatives) > self._batchStart:
+            self._send_batch(len(self.reviews.representatives))
+        return await asyncio.gather(*[task for functionTasks in self._tasks for task in functionTasks])
+
+    def cancel(self):
+        """Cancel the extraction calls still running."""
+        for functionTasks in self._tasks:
+            for task in functionTasks:
+                task.cancel()
+
+    def save_checkpoint(self, checkpoint, responses):
+        """Checkpoint the acquired reviews, their batches and the responses returned by finish()."""
+        batchCount = len(self.batches)
+        extractionUnits = {f"{index // batchCount}-{index % batchCount}": response for index, response in enumerate(responses) if response is not None}
+        return checkpoint.save('cleanedReviews', self.reviews.to_columns()) and save_batches_checkpoint(checkpoint, self.reviews, self.batches) and checkpoint.save_many('extraction', extractionUnits)
 
-        
-        # Add the text from the reviews to each header
-        print("Adding text to each header")
-        uid_to_text = {review['uid']: review['text'] for review in tagedReviews}
 
-        for key, value_list in quantifiedData.items():
-            for item in value_list:
-                item['customerVoice'] = [uid_to_text[uid] for uid in item['uid']]
 
+# %%
 
-        # Add id to each uid
-        print("Adding id to each uid")
-        quantifiedDataId = quantifiedData.copy()
-        for key, value_list in quantifiedDataId.items():
-            for item in value_list:
-                item['id'] = [uid_to_id_mapping[uid] for uid in item['uid']]
 
+def run_reviews_investigation(userId: str, investigationId: str, statusTracker: InvestigationStatusTracker = None, asinList: list = None, priority: str = DEFAULT_PRIORITY, checkpoint=None, sampling: dict = None) -> bool:
 
-        
-        # Prepare the Frontend dataset
-        try:
-            frontendOutput = {
-                key: [
-                    {
-                        k: entry[k] if k != 'uid' else entry[k][:5]
-                        for k in ['label', 'numberOfObservations', 'percentage', 'rating', 'uid', 'negativeRatingsCount','positiveRatingsCount']
-                    }
-                    for entry in value
-                ]
-                for key, value in quantifiedData.items()
-            }
-        except KeyError as e:
-            print(f"KeyError: Missing key {e} in dictionary.")
-            frontendOutput = {}
-        except Exception as e:
-            print(f"Unexpected error: {e}")
-            frontendOutput = {}
+    if statusTracker is None:
+        statusTracker = InvestigationStatusTracker(userId, investigationId)
 
-        try:
-            for key, value_list in frontendOutput.items():
-                for item in value_list:
-                    item['customerVoice'] = [uid_to_text[uid] for uid in item['uid']]
-        except KeyError as e:
-            print(f"KeyError: Missing key {e} in dictionary.")
-        except Exception as e:
-            print(f"Unexpected error: {e}")
+    if not statusTracker.transition('startedReviews'):
+        logging.error(f"Error updating investigation status to 'startedReviews'.")
+        return False
 
-        try:
-            frontendOutput = {
-                key: [
-                    {
-                        k: entry[k]
-                        for k in ['label', 'numberOfObservations', 'percentage', 'rating', 'customerVoice', 'negativeRatingsCount','positiveRatingsCount' ]
-                    }
-                    for entry in value
-                ]
-                for key, value in frontendOutput.items()
-            }
-        except KeyError as e:
-            print(f"KeyError: Missing key {e} in dictionary.")
-        except Exception as e:
-            print(f"Unexpected error: {e}")
+    if checkpoint is None:
+        checkpoint = get_reviews_checkpoint(investigationId, sampling)
 
-        # Sort each category's list based on 'numberOfObservations'
+    begin_stage('load')
+    if checkpoint is not None and checkpoint.has('cleanedReviews'):
+        print('Resuming reviews processing from its checkpoints')
+        reviews = ReviewTable.from_columns(checkpoint.get('cleanedReviews'), NEAR_DUPLICATE_THRESHOLD)
+    else:
+        # Review dicts are only held until they are loaded into the table
         try:
-            for key, value_list in frontendOutput.items():
-                sorted_value_list = sorted(value_list, key=lambda x: x['numberOfObservations'], reverse=True)
-                frontendOutput[key] = sorted_value_list
-        except KeyError as e:
-            print(f"KeyError: Missing key {e} in dictionary.")
+            reviews = ReviewTable.from_reviews(get_clean_reviews(userId, investigationId, statusTracker=statusTracker, asinList=asinList), NEAR_DUPLICATE_THRESHOLD)
         except Exception as e:
-            print(f"Unexpected error: {e}")
-
-
-        return tagedReviews, frontendOutput
-
-    except Exception as e:
-        logging.error(f"Error in process_reviews_with_gpt: {e}")
-        return None, None  # Return None in case of error
-
-
-
-# %%
-
-
-def run_reviews_investigation(userId: str, investigationId: str) -> None:
-
-    if not update_investigation_status(userId, investigationId, 'startedReviews'):
-        logging.error(f"Error updating investigation status to 'startedReviews'.")
-        return
-
-    reviews = get_clean_reviews(userId, investigationId)
-    print('Processing ', len(reviews), ' reviews')
+            logging.error(f"Error loading reviews for investigation {investigationId}: {e}")
+            return False
+        if reviews and checkpoint is not None:
+            checkpoint.save('cleanedReviews', reviews.to_columns())
+    add_stage_items(len(reviews))
+    dedupeReport = reviews.dedupe_report()
+    print('Processing ', len(reviews), ' reviews (', dedupeReport['uniqueReviews'], ' unique, ', dedupeReport['representatives'], ' sent, ', dedupeReport['tokensSaved'], ' tokens saved)')
     if not reviews:
         logging.error("Error getting clean reviews.")
-        return
+        return False
+    statusFields = {'reviewDedupe': dedupeReport}
+    if sampling:
+        # Extraction runs on a stratified sample; the statistics are scaled back up
+        sampleReport = draw_stratified_sample(reviews, seed=sampling_seed(investigationId), **sampling)
+        if sampleReport is not None:
+            print('Sampled ', sampleReport['sampled'], ' of ', sampleReport['population'], ' reviews (', sampleReport['sampledTokens'], ' of ', sampleReport['populationTokens'], ' tokens)')
+            statusFields['reviewSample'] = sampleReport
     
 
-    tagedReviews, frontendOutput = process_reviews_with_gpt(reviews)
+    tenant = {'tenantId': investigationId, 'userId': userId, 'priority': priority}
+    tagedReviews, frontendOutput, asinBreakdowns = process_reviews_with_gpt(reviews, tenant=tenant, checkpoint=checkpoint)
     if not tagedReviews or not frontendOutput:
         logging.error("Error processing reviews with GPT.")
-        return
+        return False
     
-    if not write_insights_to_firestore(userId, investigationId, frontendOutput):
+    begin_stage('write', items=len(frontendOutput))
+    if not write_insights(userId, investigationId, frontendOutput):
         logging.error("Error writing quantified data to Firestore.")
-        return
+        return False
+    # The per-ASIN breakdowns are supplementary: the investigation stands without them
+    write_clusters_to_firestore(investigationId, frontendOutput, asinBreakdowns)
+    if checkpoint is not None:
+        checkpoint.mark_completed()
+    end_stage()
     
     """
-    if not write_reviews_to_firestore(tagedReviews):
+    if not write_reviews_to_firestore(tagedReviews.to_dicts()):
         logging.error("Error writing processed reviews to Firestore.")
-        return
+        return False
     """
 
-    if not update_investigation_status(userId, investigationId, 'finishedReviews'):
+    if not statusTracker.transition('finishedReviews', extraFields=statusFields):
         logging.error(f"Error updating investigation status to 'finishedReviews'.")
-        return
+        return False
 
     logging.info(f"Reviews investigation for UserId: {userId} and InvestigationId: {investigationId} completed successfully.")
+    return True
+
+
+def run_streaming_reviews_investigation(userId: str, investigationId: str, acquire_reviews, statusTracker: InvestigationStatusTracker = None, priority: str = DEFAULT_PRIORITY, check_cancelled=None, checkpoint=None) -> bool:
+    """
+    Reviews processing fed straight from data acquisition instead of reading the reviews back.
+
+    Reviews are batched and extracted as each ASIN lands (StreamingReviewExtractor) while the
+    acquisition persists them in parallel; aggregation starts once the last batch is extracted.
+    The reviews, batches and responses are checkpointed once extraction is done; a rerun that finds
+    them resumes like run_reviews_investigation() without acquiring again.
+
+    Parameters:
+    - userId (str): The ID of the user.
+    - investigationId (str): The ID of the investigation.
+    - acquire_reviews (callable): Coroutine function taking an on_reviews(reviews) callback and
+      returning False when acquisition failed, e.g. functools.partial(run_data_acquisition, asinList).
+    - statusTracker (InvestigationStatusTracker, optional): Tracker of the run.
+    - priority (str): LLM scheduling class of the run.
+    - check_cancelled (callable, optional): Called before aggregation; raises to stop the run.
+    - checkpoint (InvestigationCheckpoint, optional): Stage checkpoints of the investigation.
+
+    Returns:
+    - bool: True if the insights were written, False otherwise.
+    """
+    if statusTracker is None:
+        statusTracker = InvestigationStatusTracker(userId, investigationId)
+    if checkpoint is None:
+        checkpoint = get_reviews_checkpoint(investigationId)
+    if checkpoint is not None and checkpoint.has('cleanedReviews'):
+        return run_reviews_investigation(userId, investigationId, statusTracker=statusTracker, priority=priority, checkpoint=checkpoint)
+
+    if not statusTracker.transition('startedReviews'):
+        logging.error(f"Error updating investigation status to 'startedReviews'.")
+        return False
+
+    async def acquire_and_extract():
+        extractor = StreamingReviewExtractor()
+        acquired = await acquire_reviews(extractor.add_reviews)
+        if not acquired:
+            extractor.cancel()
+            return False, extractor, None
+        responses = await extractor.finish()
+        return True, extractor, responses
+
+    tenant = {'tenantId': investigationId, 'userId': userId, 'priority': priority}
+    begin_stage('extract')
+    try:
+        acquired, extractor, responses = run_scheduled(acquire_and_extract(), tenant)
+    except Exception as e:
+        logging.error(f"Error during pipelined extraction: {e}")
+        return False
+    if not acquired:
+        logging.error("Error during data acquisition.")
+        return False
+
+    add_stage_items(len(extractor.reviews))
+    dedupeReport = extractor.reviews.dedupe_report()
+    print('Processing ', len(extractor.reviews), ' reviews (', dedupeReport['uniqueReviews'], ' unique, ', dedupeReport['representatives'], ' sent, ', dedupeReport['tokensSaved'], ' tokens saved) in ', len(extractor.batches), ' batches')
+    if not extractor.reviews:
+        logging.error("No reviews acquired.")
+        return False
+    if checkpoint is not None:
+        extractor.save_checkpoint(checkpoint, responses)
+
+    if check_cancelled is not None:
+        check_cancelled()
+
+    tagedReviews, frontendOutput, asinBreakdowns = finish_reviews_processing(extractor.reviews, extractor.uid_to_id_mapping, responses, tenant=tenant, checkpoint=checkpoint)
+    if not tagedReviews or not frontendOutput:
+        logging.error("Error processing reviews with GPT.")
+        return False
+
+    begin_stage('write', items=len(frontendOutput))
+    if not write_insights(userId, investigationId, frontendOutput):
+        logging.error("Error writing quantified data to Firestore.")
+        return False
+    # The per-ASIN breakdowns are supplementary: the investigation stands without them
+    write_clusters_to_firestore(investigationId, frontendOutput, asinBreakdowns)
+    if checkpoint is not None:
+        checkpoint.mark_completed()
+    end_stage()
+
+    if not statusTracker.transition('finishedReviews', extraFields={'reviewDedupe': dedupeReport}):
+        logging.error(f"Error updating investigation status to 'finishedReviews'.")
+        return False
+
+    logging.info(f"Pipelined reviews investigation for UserId: {userId} and InvestigationId: {investigationId} completed successfully.")
+    return True
 
 # %%
\ No newline at end of file
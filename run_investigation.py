@@ -4,24 +4,31 @@
 # It will start an investigation, run data acquisition, run products processing, and run reviews processing.
 import logging
 logging.basicConfig(level=logging.INFO)
+import os
+from functools import partial
 
 
-from firebase_utils import start_investigation, update_investigation_status
-from data_acquisition import execute_data_acquisition
-from reviews_processing import run_reviews_investigation
+from firebase_utils import start_investigation, InvestigationStatusTracker
+from data_acquisition import execute_data_acquisition, run_data_acquisition
+from reviews_processing import run_reviews_investigation, run_streaming_reviews_investigation, get_reviews_checkpoint
+from job_queue import InvestigationJobQueue, JobCancelled, QueueFullError
+from llm_scheduler import normalize_priority
+from users import get_user_priority
+from review_sampling import normalize_sampling
+from profiler import run_profiled, profile_stage
 
-# utils.py or within your main Flask app module
+import threading
 
-import asyncio
+# 'staged' acquires every ASIN, then reads the reviews back to process them; 'pipelined' extracts
+# reviews as each ASIN lands (see run_pipelined_investigation_stages)
+END_TO_END_MODE = os.getenv('END_TO_END_MODE', 'staged')
 
-def ensure_event_loop():
+
+def mark_investigation_failed(statusTracker):
     try:
-        if not asyncio.get_event_loop().is_running():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-    except RuntimeError as e:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        statusTracker.transition("failed")
+    except Exception as e:
+        logging.error(f"Error marking investigation {statusTracker.investigationId} as failed: {e}")
 
 
 # %%
@@ -44,6 +51,57 @@ def run_end_to_end_investigation(data):
     if not asinList:
         print("No ASINs found for the investigation.")
         return False
+
+    # start_investigation just wrote 'started'; the tracker carries the status across the run
+    statusTracker = InvestigationStatusTracker(userId, investigationId, status='started')
+
+    return run_investigation_stages(userId, investigationId, asinList, statusTracker=statusTracker, priority=get_user_priority(userId), sampling=normalize_sampling(data.get('sampling')))
+
+
+def run_investigation_stages(userId, investigationId, asinList, statusTracker=None, should_cancel=None, priority=None, sampling=None):
+    """
+    Run data acquisition and reviews processing for an investigation that was already started.
+
+    Parameters:
+    - userId (str): The ID of the user.
+    - investigationId (str): The ID of the investigation.
+    - asinList (list): ASINs of the investigation.
+    - statusTracker (InvestigationStatusTracker, optional): Tracker of the run; a new one (with an
+      unknown current status) is created when not given, e.g. for recovered jobs.
+    - should_cancel (callable, optional): Returns True when the run should stop; checked between stages.
+    - priority (str, optional): LLM scheduling class of the run ('paid', 'standard', 'background').
+    - sampling (dict, optional): Review budget of the run (normalize_sampling()); reviews beyond it
+      are left out of a stratified sample and the statistics are scaled up. Sampled runs are staged,
+      since the sample is drawn from every review.
+
+    Returns:
+    - bool: True if the investigation finished, False otherwise.
+
+    Raises:
+    - JobCancelled: If should_cancel() turned True; the investigation is marked 'cancelled'.
+
+    The per-stage timing report of the run is written to the investigation document ('timingReport').
+    """
+    if statusTracker is None:
+        statusTracker = InvestigationStatusTracker(userId, investigationId)
+
+    if END_TO_END_MODE == 'pipelined' and not sampling:
+        return run_profiled(investigationId, statusTracker, run_pipelined_investigation_stages, userId, investigationId, asinList, statusTracker=statusTracker, should_cancel=should_cancel, priority=priority)
+    return run_profiled(investigationId, statusTracker, run_staged_investigation_stages, userId, investigationId, asinList, statusTracker=statusTracker, should_cancel=should_cancel, priority=priority, sampling=sampling)
+
+
+def run_staged_investigation_stages(userId, investigationId, asinList, statusTracker=None, should_cancel=None, priority=None, sampling=None):
+    """Acquire every ASIN, then process the reviews read back from storage (see run_investigation_stages)."""
+    if statusTracker is None:
+        statusTracker = InvestigationStatusTracker(userId, investigationId)
+
+    def check_cancelled():
+        if should_cancel is not None and should_cancel():
+            try:
+                statusTracker.transition("cancelled")
+            except Exception as e:
+                logging.error(f"Error marking investigation {investigationId} as cancelled: {e}")
+            raise JobCancelled(f"Investigation {investigationId} was cancelled")
     
     """    try:
             has_investigations_available(userId, db)
@@ -52,28 +110,44 @@ def run_end_to_end_investigation(data):
             return False
     """
 
-    try:
-        execute_data_acquisition(asinList)
-        print('Data acquisition completed successfully')
-    except Exception as e:
-        print(f"Error during data acquisition: {e}")
-        return False
+    check_cancelled()
+    # A rerun whose cleaned reviews were checkpointed resumes reviews processing without acquiring again
+    checkpoint = get_reviews_checkpoint(investigationId, sampling)
+    if checkpoint is not None and checkpoint.has('cleanedReviews'):
+        print('Reviews are checkpointed, skipping data acquisition')
+    else:
+        try:
+            with profile_stage('acquisition', items=len(asinList)):
+                execute_data_acquisition(asinList)
+            print('Data acquisition completed successfully')
+        except Exception as e:
+            print(f"Error during data acquisition: {e}")
+            mark_investigation_failed(statusTracker)
+            return False
 
+    check_cancelled()
 
     try:
-        run_reviews_investigation(userId, investigationId)
+        if not run_reviews_investigation(userId, investigationId, statusTracker=statusTracker, asinList=asinList, priority=normalize_priority(priority), checkpoint=checkpoint, sampling=sampling):
+            print("Reviews processing failed.")
+            mark_investigation_failed(statusTracker)
+            return False
         print('Reviews processing completed successfully')
     except Exception as e:
         print(f"Error during reviews processing: {e}")
+        mark_investigation_failed(statusTracker)
         return False
     
+    check_cancelled()
     try:
-        update_investigation_status(userId, investigationId, "finished")
+        statusTracker.transition("finished")
         print('Investigation completed successfully')
     except Exception as e:
         print(f"Error during updating investigation status: {e}")
         return False
 
+    return True
+
     """
     try:
         use_investigation(userId, db)
@@ -83,5 +157,119 @@ def run_end_to_end_investigation(data):
         return False
     return True
     """
+
+
+def run_pipelined_investigation_stages(userId, investigationId, asinList, statusTracker=None, should_cancel=None, priority=None):
+    """
+    Run an already started investigation with acquisition feeding extraction directly.
+
+    Reviews are batched and sent to the LLM as each ASIN lands, without the round-trip through
+    storage, while acquisition persists them in parallel; aggregation starts after the last batch.
+    Takes and returns the same as run_investigation_stages(); in its timing report the 'extract'
+    stage includes the acquisition.
+
+    Raises:
+    - JobCancelled: If should_cancel() turned True; the investigation is marked 'cancelled'.
+    """
+    if statusTracker is None:
+        statusTracker = InvestigationStatusTracker(userId, investigationId)
+
+    def check_cancelled():
+        if should_cancel is not None and should_cancel():
+            try:
+                statusTracker.transition("cancelled")
+            except Exception as e:
+                logging.error(f"Error marking investigation {investigationId} as cancelled: {e}")
+            raise JobCancelled(f"Investigation {investigationId} was cancelled")
+
+    check_cancelled()
+    try:
+        if not run_streaming_reviews_investigation(userId, investigationId, partial(run_data_acquisition, asinList), statusTracker=statusTracker, priority=normalize_priority(priority), check_cancelled=check_cancelled, checkpoint=get_reviews_checkpoint(investigationId)):
+            print("Pipelined reviews processing failed.")
+            mark_investigation_failed(statusTracker)
+            return False
+        print('Pipelined reviews processing completed successfully')
+    except JobCancelled:
+        raise
+    except Exception as e:
+        print(f"Error during pipelined reviews processing: {e}")
+        mark_investigation_failed(statusTracker)
+        return False
+
+    check_cancelled()
+    try:
+        statusTracker.transition("finished")
+        print('Investigation completed successfully')
+    except Exception as e:
+        print(f"Error during updating investigation status: {e}")
+        return False
+
+    return True
+
+
+########### BACKGROUND JOBS #############
+
+_jobQueue = None
+_jobQueueLock = threading.Lock()
+
+
+def run_investigation_job(job, should_cancel):
+    """Job runner for InvestigationJobQueue: runs the stages of an already started investigation."""
+    return run_investigation_stages(job['userId'], job['investigationId'], job['asinList'], should_cancel=should_cancel, priority=job.get('priority'), sampling=job.get('sampling'))
+
+
+def get_investigation_job_queue():
+    """Return the process-wide job queue, recovering jobs orphaned by a dead process on first use (and on every heartbeat after that)."""
+    global _jobQueue
+    with _jobQueueLock:
+        if _jobQueue is None:
+            _jobQueue = InvestigationJobQueue(run_investigation_job)
+            try:
+                recovered = _jobQueue.recover_jobs()
+                if recovered:
+                    logging.info(f"Recovered {len(recovered)} investigation jobs: {recovered}")
+            except Exception as e:
+                logging.error(f"Error recovering investigation jobs: {e}")
+        return _jobQueue
+
+
+def enqueue_end_to_end_investigation(data):
+    """
+    Start an investigation and enqueue the rest of the run as a background job.
+
+    Parameters:
+    - data (dict): userId, asinList and name of the investigation, and optionally sampling. The
+      scheduling priority comes from the user's record (users.get_user_priority()).
+
+    Returns:
+    - dict: The started investigation data with 'jobId' and 'jobStatus'.
+
+    Raises:
+    - QueueFullError: If the job queue is full (no investigation is started).
+    - ValueError: If the investigation could not be started.
+    """
+    jobQueue = get_investigation_job_queue()
+    if jobQueue.is_full():
+        raise QueueFullError(f"{jobQueue.max_queue_depth} investigation jobs are already queued")
+
+    investigationData = start_investigation(data)
+    if not investigationData:
+        raise ValueError("Failed to start the investigation.")
+
+    investigationId = investigationData['id']
+    try:
+        job = jobQueue.submit(investigationId, {
+            'userId': investigationData['userId'],
+            'investigationId': investigationId,
+            'asinList': investigationData['asinList'],
+            'priority': get_user_priority(investigationData['userId']),
+            'sampling': normalize_sampling(data.get('sampling')),
+        })
+    except Exception:
+        mark_investigation_failed(InvestigationStatusTracker(investigationData['userId'], investigationId, status='started'))
+        raise
+
+    return dict(investigationData, jobId=job['id'], jobStatus=job['status'])
+
 #%%
 # ====================
\ No newline at end of file
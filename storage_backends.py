@@ -0,0 +1,395 @@
+#####################
+# storage_backends.py
+# Storage backends for the document store behind firebase_utils, users and data_acquisition.
+#
+# The storage interface is the subset of the Firestore client API this repo uses for products,
+# reviews, investigations, insights and users: collection()/document() references, get/set/update/
+# delete, stream(), where()/limit() queries, batch(), get_all() and write_option() preconditions.
+# FirestoreClient (firebase_utils.py) is the Firestore implementation; LocalDocumentStore below
+# keeps documents in SQLite (in memory by default) so the pipeline can be run and benchmarked
+# without Google credentials. Select it with STORAGE_BACKEND=sqlite (see get_storage_backend_from_env).
+import os
+import pickle
+import random
+import sqlite3
+import string
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from google.api_core.exceptions import FailedPrecondition, NotFound
+from google.cloud.firestore_v1 import transforms
+
+
+def get_storage_backend_from_env():
+    """
+    Build a local backend when STORAGE_BACKEND asks for one.
+
+    Environment:
+    - STORAGE_BACKEND: 'firestore' (default), 'memory' or 'sqlite'.
+    - STORAGE_SQLITE_PATH: Database file for 'sqlite' (defaults to an in-memory database).
+    - STORAGE_LATENCY_MS: Latency injected into every round trip of the local backend.
+
+    Returns:
+    - LocalDocumentStore, or None when Firestore should be used.
+    """
+    backend = os.getenv('STORAGE_BACKEND', 'firestore').lower()
+    if backend == 'firestore':
+        return None
+    if backend not in ('memory', 'sqlite'):
+        raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+    path = os.getenv('STORAGE_SQLITE_PATH', ':memory:') if backend == 'sqlite' else ':memory:'
+    latency = float(os.getenv('STORAGE_LATENCY_MS', 0)) / 1000
+    return LocalDocumentStore(path=path, latency=latency)
+
+
+def _auto_id():
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=20))
+
+
+def _split_field_path(field_path):
+    return field_path.split('.')
+
+
+def _get_field(data, field_path):
+    value = data
+    for part in _split_field_path(field_path):
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(field_path)
+        value = value[part]
+    return value
+
+
+def _apply_value(current, value, now):
+    """Resolve Firestore sentinels and transforms against the current field value."""
+    if value is transforms.SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, transforms.Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, transforms.ArrayUnion):
+        result = list(current) if isinstance(current, list) else []
+        result.extend(item if item is not transforms.SERVER_TIMESTAMP else now for item in value.values if item not in result)
+        return result
+    if isinstance(value, transforms.ArrayRemove):
+        return [item for item in (current if isinstance(current, list) else []) if item not in value.values]
+    if isinstance(value, dict):
+        return {k: _apply_value(None, v, now) for k, v in value.items() if v is not transforms.DELETE_FIELD}
+    if isinstance(value, list):
+        return [_apply_value(None, v, now) for v in value]
+    return value
+
+
+def _merge(target, updates, now):
+    for key, value in updates.items():
+        if value is transforms.DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value, now)
+        else:
+            target[key] = _apply_value(target.get(key), value, now)
+
+
+def _set_field_path(target, field_path, value, now):
+    parts = _split_field_path(field_path)
+    for part in parts[:-1]:
+        if not isinstance(target.get(part), dict):
+            target[part] = {}
+        target = target[part]
+    if value is transforms.DELETE_FIELD:
+        target.pop(parts[-1], None)
+    else:
+        target[parts[-1]] = _apply_value(target.get(parts[-1]), value, now)
+
+
+class WriteResult:
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+class ExistsOption:
+    def __init__(self, exists):
+        self.exists = exists
+
+
+class LastUpdateOption:
+    def __init__(self, last_update_time):
+        self.last_update_time = last_update_time
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self._data = data
+        self.update_time = update_time
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return pickle.loads(pickle.dumps(self._data)) if self._data is not None else None
+
+    def get(self, field_path):
+        if self._data is None:
+            return None
+        return _get_field(self._data, field_path)
+
+
+class DocumentReference:
+    def __init__(self, store, path):
+        self._store = store
+        self.path = path
+
+    @property
+    def id(self):
+        return self.path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return CollectionReference(self._store, self.path.rsplit('/', 1)[0])
+
+    def collection(self, collection_id):
+        return CollectionReference(self._store, f"{self.path}/{collection_id}")
+
+    def get(self):
+        self._store._round_trip()
+        return self._store._read(self)
+
+    def set(self, document_data, merge=False):
+        self._store._round_trip()
+        return self._store._commit([('set', self, document_data, merge)])[0]
+
+    def update(self, field_updates, option=None):
+        self._store._round_trip()
+        return self._store._commit([('update', self, field_updates, option)])[0]
+
+    def delete(self, option=None):
+        self._store._round_trip()
+        return self._store._commit([('delete', self, None, option)])[0]
+
+
+class Query:
+    def __init__(self, store, collection_path, filters=(), limit_count=None):
+        self._store = store
+        self._collection_path = collection_path
+        self._filters = tuple(filters)
+        self._limit = limit_count
+
+    def where(self, field_path, op_string, value):
+        return Query(self._store, self._collection_path, self._filters + ((field_path, op_string, value),), self._limit)
+
+    def limit(self, count):
+        return Query(self._store, self._collection_path, self._filters, count)
+
+    def _matches(self, data):
+        for field_path, op, value in self._filters:
+            try:
+                fieldValue = _get_field(data, field_path)
+            except KeyError:
+                return False
+            if op == '==' and not fieldValue == value:
+                return False
+            if op == '!=' and not fieldValue != value:
+                return False
+            if op == 'in' and fieldValue not in value:
+                return False
+            if op == 'not-in' and fieldValue in value:
+                return False
+            if op == 'array_contains' and (not isinstance(fieldValue, list) or value not in fieldValue):
+                return False
+            if op in ('<', '<=', '>', '>='):
+                try:
+                    if not {'<': fieldValue < value, '<=': fieldValue <= value, '>': fieldValue > value, '>=': fieldValue >= value}[op]:
+                        return False
+                except TypeError:
+                    return False
+        return True
+
+    def stream(self):
+        self._store._round_trip()
+        snapshots = [snapshot for snapshot in self._store._list(self._collection_path) if self._matches(snapshot._data)]
+        if self._limit is not None:
+            snapshots = snapshots[:self._limit]
+        self._store._count_reads(len(snapshots))
+        return iter(snapshots)
+
+    def get(self):
+        return list(self.stream())
+
+
+class CollectionReference(Query):
+    def __init__(self, store, path):
+        super().__init__(store, path)
+        self.path = path
+
+    @property
+    def id(self):
+        return self.path.rsplit('/', 1)[-1]
+
+    def document(self, document_id=None):
+        return DocumentReference(self._store, f"{self.path}/{document_id or _auto_id()}")
+
+
+class WriteBatch:
+    def __init__(self, store):
+        self._store = store
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference, document_data, merge))
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(('update', reference, field_updates, option))
+
+    def delete(self, reference, option=None):
+        self._writes.append(('delete', reference, None, option))
+
+    def commit(self):
+        self._store._round_trip()
+        writes, self._writes = self._writes, []
+        return self._store._commit(writes)
+
+
+class LocalDocumentStore:
+    """
+    SQLite-backed implementation of the document store interface, with optional injected latency.
+
+    Args:
+    - path (str): SQLite database path, ':memory:' for an in-process store.
+    - latency (float): Seconds slept on every round trip (get, set, update, commit, stream, get_all),
+      to approximate a remote database when comparing storage layouts.
+    """
+
+    def __init__(self, path=':memory:', latency=0.0):
+        self.latency = latency
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS documents (path TEXT PRIMARY KEY, parent TEXT NOT NULL, data BLOB NOT NULL, update_time TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS documents_parent ON documents (parent)")
+        self._conn.commit()
+        self._lastUpdateTime = datetime.now(timezone.utc)
+        self.reset_stats()
+
+    # Client API
+
+    def collection(self, collection_id):
+        return CollectionReference(self, collection_id)
+
+    def document(self, document_path):
+        return DocumentReference(self, document_path)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def get_all(self, references):
+        self._round_trip()
+        return [self._read(reference) for reference in references]
+
+    @staticmethod
+    def write_option(**kwargs):
+        if 'last_update_time' in kwargs:
+            return LastUpdateOption(kwargs['last_update_time'])
+        if 'exists' in kwargs:
+            return ExistsOption(kwargs['exists'])
+        raise TypeError("write_option expects last_update_time or exists")
+
+    # Stats
+
+    def reset_stats(self):
+        self.round_trips = 0
+        self.document_reads = 0
+        self.document_writes = 0
+        self.bytes_written = 0
+
+    def stats(self):
+        return {
+            'roundTrips': self.round_trips,
+            'documentReads': self.document_reads,
+            'documentWrites': self.document_writes,
+            'bytesWritten': self.bytes_written,
+        }
+
+    # Internals
+
+    def _round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _count_reads(self, count):
+        self.document_reads += count
+
+    def _next_update_time(self):
+        now = datetime.now(timezone.utc)
+        if now <= self._lastUpdateTime:
+            now = self._lastUpdateTime + timedelta(microseconds=1)
+        self._lastUpdateTime = now
+        return now
+
+    def _load(self, path):
+        row = self._conn.execute("SELECT data, update_time FROM documents WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None, None
+        return pickle.loads(row[0]), datetime.fromisoformat(row[1])
+
+    def _read(self, reference):
+        with self._lock:
+            data, updateTime = self._load(reference.path)
+        self._count_reads(1)
+        return DocumentSnapshot(reference, data, updateTime)
+
+    def _list(self, collection_path):
+        with self._lock:
+            rows = self._conn.execute("SELECT path, data, update_time FROM documents WHERE parent = ? ORDER BY path", (collection_path,)).fetchall()
+        return [DocumentSnapshot(DocumentReference(self, path), pickle.loads(data), datetime.fromisoformat(updateTime)) for path, data, updateTime in rows]
+
+    def _check_option(self, path, option, currentTime):
+        if isinstance(option, LastUpdateOption) and currentTime != option.last_update_time:
+            raise FailedPrecondition(f"Document {path} was updated after {option.last_update_time}")
+        if isinstance(option, ExistsOption) and (currentTime is not None) != option.exists:
+            raise FailedPrecondition(f"Document {path} existence precondition failed")
+
+    def _commit(self, writes):
+        with self._lock:
+            now = self._next_update_time()
+            staged = {}
+            for kind, reference, payload, extra in writes:
+                path = reference.path
+                if path in staged:
+                    current, currentTime = staged[path]
+                else:
+                    current, currentTime = self._load(path)
+
+                if kind == 'set':
+                    data = {} if (current is None or not extra) else current
+                    _merge(data, payload, now)
+                elif kind == 'update':
+                    if current is None:
+                        raise NotFound(f"No document to update: {path}")
+                    self._check_option(path, extra, currentTime)
+                    data = current
+                    for fieldPath, value in payload.items():
+                        _set_field_path(data, fieldPath, value, now)
+                else:
+                    self._check_option(path, extra, currentTime)
+                    data = None
+                staged[path] = (data, now if data is not None else None)
+
+            for path, (data, _) in staged.items():
+                if data is None:
+                    self._conn.execute("DELETE FROM documents WHERE path = ?", (path,))
+                    continue
+                blob = pickle.dumps(data)
+                self.bytes_written += len(blob)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO documents (path, parent, data, update_time) VALUES (?, ?, ?, ?)",
+                    (path, path.rsplit('/', 1)[0], blob, now.isoformat()),
+                )
+            self._conn.commit()
+            self.document_writes += len(writes)
+
+        return [WriteResult(now) for _ in writes]
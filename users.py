@@ -6,6 +6,9 @@ from firebase_admin import firestore
 import logging
 logging.basicConfig(level=logging.INFO)
 
+from firebase_utils import db
+from llm_scheduler import DEFAULT_PRIORITY, normalize_priority
+
 def get_user_ref(userId):
     try:
         return db.collection('users').document(userId)
@@ -35,6 +38,22 @@ def get_user(userId):
         logging.error(f"Error fetching user {userId}: {e}")
         return None
 
+def get_user_priority(userId):
+    """
+    LLM scheduling class of a user's investigations, from their record: the 'llmPriority' an admin
+    set, else 'paid' while they have a package, else the default class. Never taken from a request.
+    """
+    try:
+        user = get_user(userId) if userId else None
+        if not user:
+            return DEFAULT_PRIORITY
+        if user.get('llmPriority'):
+            return normalize_priority(user['llmPriority'])
+        return 'paid' if user.get('currentPackage') else DEFAULT_PRIORITY
+    except Exception as e:
+        logging.error(f"Error fetching the priority of user {userId}: {e}")
+        return DEFAULT_PRIORITY
+
 def subscribe_user(userId, package):
     try:
         user_ref = get_user_ref(userId)